@@ -0,0 +1,400 @@
+"""
+accumulator.py: Incremental co-addition of the corrected images of a filter into a store
+per filter (`incremental = true` in the configuration file, see dresscode.uvotimsum).
+"""
+
+from __future__ import annotations
+
+import hashlib
+import os
+import shutil
+from dataclasses import dataclass, field
+from typing import Iterable, NamedTuple
+
+import numpy as np
+from astropy.io import fits
+from astropy.wcs import WCS
+from numpy.typing import DTypeLike
+
+from dresscode.coadd import (
+    PIXSIZE,
+    deposit,
+    frame_values,
+    frame_wcs,
+    grid_bounds,
+    grid_header,
+    is_excluded,
+    sky_grid,
+)
+from dresscode.utils import writeto
+
+SUMS_FNAME = "sums.fits"
+# the number of images that cover each pixel, the pixels that are no longer covered by
+# any image are set to 0, whatever the rounding errors of the subtractions
+COVERAGE_EXTNAME = "NIMAGES"
+IMAGES_EXTNAME = "IMAGES"
+
+
+class ImageEntry(NamedTuple):
+    """An image in the store"""
+
+    fingerprint: str
+    n_frames: int
+    exposure: float
+    # the lowest (x, y) pixel of its contribution on the grid
+    x0: int = 0
+    y0: int = 0
+
+
+@dataclass
+class Store:
+    """The co-added images of a filter (see the module docstring)"""
+
+    grid_wcs: WCS
+    # the summed images by type
+    sums: dict[str, np.ndarray]
+    coverage: np.ndarray
+    images: dict[str, ImageEntry] = field(default_factory=dict)
+
+    @property
+    def shape(self) -> tuple[int, int]:
+        return self.coverage.shape
+
+
+def image_fingerprint(fnames: Iterable[str]) -> str:
+    """Fingerprint of the files of an image: their size and modification time"""
+
+    digest = hashlib.sha256()
+    for fname in sorted(fnames):
+        stat = os.stat(fname)
+        digest.update(
+            f"{os.path.basename(fname)} {stat.st_size} {stat.st_mtime_ns}\n".encode()
+        )
+    return digest.hexdigest()
+
+
+def contribution_fname(store_dir: str, name: str, entry: ImageEntry) -> str:
+    """The file with the contribution of an image, a changed image is written to a new
+    file, so the store stays consistent until its sums are written"""
+
+    return os.path.join(store_dir, f"{name}.{entry.fingerprint[:12]}.fits")
+
+
+def load_store(store_dir: str, pixsize: float = PIXSIZE) -> Store | None:
+    """Read the store of a filter, None if there is none"""
+
+    fname = os.path.join(store_dir, SUMS_FNAME)
+    if not os.path.isfile(fname):
+        return None
+    with fits.open(fname, memmap=False) as hdulist:
+        if not np.isclose(hdulist[0].header.get("PIXSIZE", 0.0), pixsize):
+            raise ValueError(
+                f"{fname} has a pixel size of {hdulist[0].header.get('PIXSIZE')}, not "
+                f"{pixsize}, remove {store_dir} to co-add all images again"
+            )
+        table = hdulist[IMAGES_EXTNAME].data
+        return Store(
+            grid_wcs=frame_wcs(hdulist[0].header),
+            sums={
+                hdu.name.lower(): hdu.data
+                for hdu in hdulist[1:]
+                if hdu.name not in (COVERAGE_EXTNAME, IMAGES_EXTNAME)
+            },
+            coverage=hdulist[COVERAGE_EXTNAME].data,
+            images={
+                str(row["NAME"]): ImageEntry(
+                    str(row["FINGERPRINT"]),
+                    int(row["NFRAMES"]),
+                    float(row["EXPOSURE"]),
+                    int(row["X0"]),
+                    int(row["Y0"]),
+                )
+                for row in table
+            },
+        )
+
+
+def save_store(
+    store_dir: str,
+    store: Store,
+    pixsize: float = PIXSIZE,
+    scratch_dir: str | None = None,
+):
+    """Write the sums of the store, and remove the contributions of the images that are
+    no longer in it"""
+
+    header = store.grid_wcs.to_header()
+    header["PIXSIZE"] = (pixsize, "pixel size of the grid (degrees)")
+    names = sorted(store.images)
+    entries = [store.images[name] for name in names]
+    table = fits.BinTableHDU.from_columns(
+        [
+            fits.Column("NAME", "80A", array=names),
+            fits.Column("FINGERPRINT", "64A", array=[e.fingerprint for e in entries]),
+            fits.Column("NFRAMES", "J", array=[e.n_frames for e in entries]),
+            fits.Column("EXPOSURE", "D", array=[e.exposure for e in entries]),
+            fits.Column("X0", "J", array=[e.x0 for e in entries]),
+            fits.Column("Y0", "J", array=[e.y0 for e in entries]),
+        ],
+        name=IMAGES_EXTNAME,
+    )
+    hdulist = fits.HDUList(
+        [fits.PrimaryHDU(header=header)]
+        + [fits.ImageHDU(data, name=sum_type) for sum_type, data in store.sums.items()]
+        + [fits.ImageHDU(store.coverage, name=COVERAGE_EXTNAME), table]
+    )
+    writeto(hdulist, os.path.join(store_dir, SUMS_FNAME), scratch_dir=scratch_dir)
+
+    current = {
+        os.path.basename(contribution_fname(store_dir, name, entry))
+        for name, entry in store.images.items()
+    }
+    for fname in os.listdir(store_dir):
+        if fname.endswith(".fits") and fname != SUMS_FNAME and fname not in current:
+            os.remove(os.path.join(store_dir, fname))
+
+
+def frame_footprints(fname: str) -> list[tuple[WCS, tuple[int, int]]]:
+    """The WCS and shape of the frames of an image that are co-added"""
+
+    with fits.open(fname) as hdulist:
+        return [
+            (frame_wcs(hdu.header), (hdu.header["NAXIS2"], hdu.header["NAXIS1"]))
+            for hdu in hdulist[1:]
+            if not is_excluded(hdu.header)
+        ]
+
+
+def extend_grid(store: Store, low: np.ndarray, high: np.ndarray):
+    """Extend the grid of the store to cover the pixels from low to high (x, y), the
+    sums are padded with 0"""
+
+    pad_low = np.maximum(-low, 0)
+    pad_high = np.maximum(high - (np.array(store.shape[::-1]) - 1), 0)
+    if not (pad_low.any() or pad_high.any()):
+        return
+    pad = ((pad_low[1], pad_high[1]), (pad_low[0], pad_high[0]))
+    store.sums = {sum_type: np.pad(data, pad) for sum_type, data in store.sums.items()}
+    store.coverage = np.pad(store.coverage, pad)
+    store.grid_wcs.wcs.crpix = store.grid_wcs.wcs.crpix + pad_low
+    store.images = {
+        name: entry._replace(
+            x0=entry.x0 + int(pad_low[0]), y0=entry.y0 + int(pad_low[1])
+        )
+        for name, entry in store.images.items()
+    }
+
+
+def add_image(
+    store_dir: str,
+    store: Store,
+    name: str,
+    fnames: dict[str, str],
+    mask_fname: str,
+    methods: dict[str, str],
+    fingerprint: str,
+    pixsize: float = PIXSIZE,
+    scratch_dir: str | None = None,
+):
+    """Co-add the frames of an image on the part of the grid that they cover, write its
+    contribution and add it to the sums"""
+
+    footprints = [fp for fname in fnames.values() for fp in frame_footprints(fname)]
+    if not footprints:
+        store.images[name] = ImageEntry(fingerprint, 0, 0.0)
+        return
+
+    # the pixels covered by the frames, with the pixels next to them that the values at
+    # the edges of the frames are spread over
+    low, high = grid_bounds(store.grid_wcs, footprints)
+    low = np.maximum(low - 1, 0)
+    high = np.minimum(high + 1, np.array(store.shape[::-1]) - 1)
+    sub_wcs = store.grid_wcs.deepcopy()
+    sub_wcs.wcs.crpix = store.grid_wcs.wcs.crpix - low
+    nx, ny = high - low + 1
+    sub_shape = (int(ny), int(nx))
+
+    with fits.open(mask_fname) as mask_hdulist:
+        masks = [hdu.data for hdu in mask_hdulist[1:]]
+    contribution = {}
+    for sum_type, method in methods.items():
+        with fits.open(fnames[sum_type]) as hdulist:
+            if len(hdulist) - 1 != len(masks):
+                raise ValueError(
+                    f"{os.path.basename(fnames[sum_type])} has {len(hdulist) - 1} "
+                    f"frames, the mask {os.path.basename(mask_fname)} {len(masks)}"
+                )
+            frames = [
+                (hdu, mask)
+                for hdu, mask in zip(hdulist[1:], masks)
+                if not is_excluded(hdu.header)
+            ]
+            total = np.zeros(sub_shape, dtype=np.float64)
+            for frame, mask in frames:
+                wcs = frame_wcs(frame.header)
+                values = frame_values(frame.data, mask, wcs, method, pixsize)
+                deposit(values, wcs, sub_wcs, sub_shape, out=total)
+            contribution[sum_type] = total
+            # the same frames of every type are co-added
+            n_frames = len(frames)
+            exposure = sum(frame.header.get("EXPOSURE", 0.0) for frame, _ in frames)
+
+    entry = ImageEntry(fingerprint, n_frames, exposure, int(low[0]), int(low[1]))
+    writeto(
+        fits.HDUList(
+            [fits.PrimaryHDU()]
+            + [
+                fits.ImageHDU(data, name=sum_type)
+                for sum_type, data in contribution.items()
+            ]
+        ),
+        contribution_fname(store_dir, name, entry),
+        scratch_dir=scratch_dir,
+    )
+    region = np.s_[
+        entry.y0 : entry.y0 + sub_shape[0], entry.x0 : entry.x0 + sub_shape[1]
+    ]
+    for sum_type, data in contribution.items():
+        store.sums[sum_type][region] += data
+    store.coverage[region] += np.any([data != 0 for data in contribution.values()], 0)
+    store.images[name] = entry
+
+
+def remove_image(store_dir: str, store: Store, name: str):
+    """Subtract the contribution of an image from the sums"""
+
+    entry = store.images.pop(name)
+    if not entry.n_frames:
+        return
+    fname = contribution_fname(store_dir, name, entry)
+    if not os.path.isfile(fname):
+        raise ValueError(
+            f"The contribution of {name} ({os.path.basename(fname)}) is missing, "
+            f"remove {store_dir} to co-add all images again"
+        )
+    with fits.open(fname, memmap=False) as hdulist:
+        contribution = {sum_type: hdulist[sum_type].data for sum_type in store.sums}
+    ny, nx = next(iter(contribution.values())).shape
+    region = np.s_[entry.y0 : entry.y0 + ny, entry.x0 : entry.x0 + nx]
+    for sum_type, data in contribution.items():
+        store.sums[sum_type][region] -= data
+    store.coverage[region] -= np.any([data != 0 for data in contribution.values()], 0)
+
+
+def update_store(
+    store_dir: str,
+    images: dict[str, dict[str, str]],
+    masks: dict[str, str],
+    methods: dict[str, str],
+    pixsize: float = PIXSIZE,
+    scratch_dir: str | None = None,
+) -> Store | None:
+    """Bring the store of a filter up to date with its images, given as {name: {type:
+    file name}}, their masks ({name: file name}) and the co-addition method of every
+    type: the images that have been removed or have changed are subtracted from the
+    sums, the new and changed images are co-added and added to the sums.
+
+    Returns the updated store, None if there are no images (the store is removed)"""
+
+    store = load_store(store_dir, pixsize)
+    fingerprints = {
+        name: image_fingerprint([*fnames.values(), masks[name]])
+        for name, fnames in images.items()
+    }
+    store_name = os.path.basename(os.path.normpath(store_dir))
+
+    stale = []
+    if store is not None:
+        stale = [
+            name
+            for name, entry in store.images.items()
+            if fingerprints.get(name) != entry.fingerprint
+        ]
+    for name in stale:
+        print(f"Removing {name} from {store_name}...")
+        remove_image(store_dir, store, name)
+
+    new = [name for name in sorted(images) if store is None or name not in store.images]
+    if new:
+        footprints = [
+            fp
+            for name in new
+            for fname in images[name].values()
+            for fp in frame_footprints(fname)
+        ]
+        if store is None:
+            if not footprints:
+                raise ValueError(f"The images of {store_name} have no frames to co-add")
+            grid_wcs, grid_shape = sky_grid(footprints, pixsize)
+            store = Store(
+                grid_wcs,
+                {sum_type: np.zeros(grid_shape) for sum_type in methods},
+                np.zeros(grid_shape, dtype=np.int32),
+            )
+            os.makedirs(store_dir, exist_ok=True)
+        elif footprints:
+            extend_grid(store, *grid_bounds(store.grid_wcs, footprints))
+    for name in new:
+        print(f"Co-adding {name} into {store_name}...")
+        add_image(
+            store_dir,
+            store,
+            name,
+            images[name],
+            masks[name],
+            methods,
+            fingerprints[name],
+            pixsize,
+            scratch_dir,
+        )
+
+    if store is None:
+        return None
+    if not store.images:
+        shutil.rmtree(store_dir)
+        print(f"Removed {store_name}, it has no images")
+        return None
+    for data in store.sums.values():
+        data[store.coverage == 0] = 0
+    if stale or new:
+        save_store(store_dir, store, pixsize, scratch_dir)
+    replaced = len([name for name in stale if name in images])
+    print(
+        f"{store_name} has {len(store.images)} images: {len(new) - replaced} added, "
+        f"{replaced} replaced, {len(stale) - replaced} removed"
+    )
+    return store
+
+
+def write_sums(
+    store: Store,
+    images: dict[str, dict[str, str]],
+    out_fnames: dict[str, str],
+    dtype: DTypeLike = None,
+    scratch_dir: str | None = None,
+):
+    """Write the co-added image of every type (in float32 by default), with the headers
+    of the first image, like `dresscode.coadd.coadd`, through scratch_dir if given"""
+
+    names = [name for name in sorted(store.images) if store.images[name].n_frames]
+    if not names:
+        raise ValueError("The images have no frames to co-add")
+    n_frames = sum(store.images[name].n_frames for name in names)
+    exposure = sum(store.images[name].exposure for name in names)
+    for sum_type, data in store.sums.items():
+        with fits.open(images[names[0]][sum_type]) as hdulist:
+            primary_header = hdulist[0].header
+            frame_header = next(
+                hdu.header for hdu in hdulist[1:] if not is_excluded(hdu.header)
+            )
+            header = grid_header(frame_header, store.grid_wcs, exposure, n_frames)
+        writeto(
+            fits.HDUList(
+                [
+                    fits.PrimaryHDU(header=primary_header),
+                    fits.ImageHDU(data.astype(dtype or np.float32), header),
+                ]
+            ),
+            out_fnames[sum_type],
+            scratch_dir=scratch_dir,
+        )
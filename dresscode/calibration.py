@@ -11,11 +11,12 @@ from typing import Optional, Sequence
 
 from astropy.io import fits
 
-from dresscode.utils import load_config
+from dresscode.config import add_performance_arguments, read_config
+from dresscode.utils import AsyncWriter, writeto
 
 
-# Function to convert the units of an image.
-def convert(filename, factor, galaxy):
+# Function to convert the units of an image (written in the background with a writer).
+def convert(filename, factor, galaxy, writer=None):
     # Open the image and convert the units.
     hdulist = fits.open(filename)
     header = hdulist[0].header
@@ -32,10 +33,12 @@ def convert(filename, factor, galaxy):
     new_hdu = fits.PrimaryHDU(
         [primary, hdulist[0].data[1], coicorr_unc, hdulist[0].data[3], poisson], header
     )
-    new_hdu.writeto(
+    writeto(
+        new_hdu,
         filename.replace("total_sum", galaxy + "_final").replace("nm", "Jy"),
-        overwrite=True,
+        writer,
     )
+    hdulist.close()
 
 
 def main(argv: Optional[Sequence[str]] = None) -> int:
@@ -43,12 +46,13 @@ def main(argv: Optional[Sequence[str]] = None) -> int:
     parser.add_argument(
         "-c", "--config", help="path to config.txt", default="config.txt"
     )
+    add_performance_arguments(parser)
     args = parser.parse_args(argv)
 
-    config = load_config(args.config)
+    config = read_config(args.config, "calibration", args)
 
-    galaxy = config["galaxy"]
-    path = config["path"] + galaxy + "/working_dir/"
+    galaxy = config.galaxy
+    path = config.path + galaxy + "/working_dir/"
 
     print(
         "Converting the units of the final image from counts/s to Jy and correcting "
@@ -66,13 +70,14 @@ def main(argv: Optional[Sequence[str]] = None) -> int:
     factor_UVM2 = factor_UVM2 / 1.1777
     factor_UVW1 = factor_UVW1 / 1.1567
 
-    # Convert the units of the images.
-    if os.path.isfile(path + "total_sum_uw2_nm.fits"):
-        convert(path + "total_sum_uw2_nm.fits", factor_UVW2, galaxy)
-    if os.path.isfile(path + "total_sum_um2_nm.fits"):
-        convert(path + "total_sum_um2_nm.fits", factor_UVM2, galaxy)
-    if os.path.isfile(path + "total_sum_uw1_nm.fits"):
-        convert(path + "total_sum_uw1_nm.fits", factor_UVW1, galaxy)
+    # Convert the units of the images, an image is written while the next is converted.
+    with AsyncWriter(scratch_dir=config.performance.scratch_dir) as writer:
+        if os.path.isfile(path + "total_sum_uw2_nm.fits"):
+            convert(path + "total_sum_uw2_nm.fits", factor_UVW2, galaxy, writer)
+        if os.path.isfile(path + "total_sum_um2_nm.fits"):
+            convert(path + "total_sum_um2_nm.fits", factor_UVM2, galaxy, writer)
+        if os.path.isfile(path + "total_sum_uw1_nm.fits"):
+            convert(path + "total_sum_uw1_nm.fits", factor_UVW1, galaxy, writer)
 
     return 0
 
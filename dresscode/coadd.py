@@ -0,0 +1,265 @@
+"""
+coadd.py: Co-addition of the frames of an "all" image onto a common sky grid, in Python,
+as an alternative to HEASoft uvotimsum (`coadd = native` in the configuration file).
+
+Every frame is reprojected onto a tangent plane grid with the pixel size of uvotimsum
+(`pixsize`), using the WCS of the frame. The value of each pixel of a frame is spread
+over the 4 output pixels around the position of its centre, with bilinear weights that
+sum to 1 (cloud-in-cell), so the total counts of a frame are kept. Exposure maps
+(method `expmap`) are spread the same way and scaled by the ratio of the pixel areas,
+so the summed exposure matches the summed counts, also at the edges of the frames.
+Masked pixels (0 in the mask) don't contribute, and like uvotimsum's `exclude=DEFAULT`
+the frames without an aspect correction (ASPCORR missing or NONE) are skipped.
+"""
+
+from __future__ import annotations
+
+import os
+import re
+import warnings
+
+import numpy as np
+from astropy.io import fits
+from astropy.wcs import WCS, FITSFixedWarning
+from astropy.wcs.utils import proj_plane_pixel_area
+from numpy.typing import DTypeLike
+
+from dresscode.utils import row_tiles, writeto
+
+# output pixel size of the co-added images (degrees)
+PIXSIZE = 0.00027888888381462
+
+# co-addition methods: the sum of images in counts, or the sum of exposure maps
+METHODS = ["grid", "expmap"]
+
+# rows of a frame that are reprojected at a time, to bound the memory use
+COADD_TILE_ROWS = 256
+
+# the WCS keywords of the frames (also of the alternate WCSs, e.g. the physical and
+# detector coordinates), which don't apply to the grid of the co-added image
+WCS_KEYWORD = re.compile(
+    r"(WCSAXES|WCSNAME|(CTYPE|CRVAL|CRPIX|CDELT|CUNIT|CROTA|LTV)\d+|(PC|CD|LTM)\d+_\d+"
+    r"|LONPOLE|LATPOLE|RADESYS|EQUINOX)[A-Z]?"
+)
+
+
+def is_excluded(header: fits.Header) -> bool:
+    """Whether uvotimsum's exclude=DEFAULT skips a frame: if it isn't aspect corrected"""
+
+    return str(header.get("ASPCORR", "NONE")).strip().upper() == "NONE"
+
+
+def frame_wcs(header: fits.Header) -> WCS:
+    """The (celestial) WCS of a frame"""
+
+    with warnings.catch_warnings():
+        # e.g. the DATE-OBS of the frames, which doesn't matter here
+        warnings.simplefilter("ignore", FITSFixedWarning)
+        wcs = WCS(header)
+    if not wcs.has_celestial:
+        raise ValueError("the frame has no sky coordinates (WCS)")
+    return wcs.celestial
+
+
+def sky_grid(
+    frames: list[tuple[WCS, tuple[int, int]]], pixsize: float = PIXSIZE
+) -> tuple[WCS, tuple[int, int]]:
+    """The WCS and shape of the tangent plane grid (north up) that covers the frames,
+    given as (WCS, shape) pairs, with the reference point of the first frame, so a first
+    frame that is north up with the pixel size of the grid is on the grid"""
+
+    first_wcs = frames[0][0]
+    grid_wcs = WCS(naxis=2)
+    grid_wcs.wcs.ctype = ["RA---TAN", "DEC--TAN"]
+    grid_wcs.wcs.crval = first_wcs.wcs.crval
+    grid_wcs.wcs.cdelt = [-pixsize, pixsize]
+    grid_wcs.wcs.crpix = first_wcs.wcs.crpix
+
+    low, high = grid_bounds(grid_wcs, frames)
+    grid_wcs.wcs.crpix = first_wcs.wcs.crpix - low
+    nx, ny = high - low + 1
+    return grid_wcs, (int(ny), int(nx))
+
+
+def grid_bounds(
+    grid_wcs: WCS, frames: list[tuple[WCS, tuple[int, int]]]
+) -> tuple[np.ndarray, np.ndarray]:
+    """The lowest and highest (x, y) pixels of the grid covered by the frames, given as
+    (WCS, shape) pairs, they can be outside of the grid"""
+
+    # the corners of the frames on the grid
+    corners = np.concatenate(
+        [
+            grid_wcs.all_world2pix(
+                wcs.calc_footprint(axes=(shape[1], shape[0]), center=False), 0
+            )
+            for wcs, shape in frames
+        ]
+    )
+    # the pixels whose centres are inside the corners (with a margin for the small
+    # differences between the tangent planes of the frames)
+    low = np.floor(corners.min(axis=0) + 0.51).astype(int)
+    high = np.ceil(corners.max(axis=0) - 0.51).astype(int)
+    return low, high
+
+
+def frame_values(
+    data: np.ndarray,
+    mask: np.ndarray,
+    wcs: WCS,
+    method: str,
+    pixsize: float = PIXSIZE,
+) -> np.ndarray:
+    """The values of a frame that are spread over the grid: 0 for the masked pixels, and
+    exposure maps scaled by the ratio of the pixel areas"""
+
+    values = np.where(mask != 0, data, 0)
+    if method == "expmap":
+        # unlike the counts, the exposure of a pixel doesn't scale with its area:
+        # spreading it over the grid adds up (pixsize**2 / area) pixels
+        values = values * (proj_plane_pixel_area(wcs) / pixsize**2)
+    return values
+
+
+def deposit(
+    data: np.ndarray,
+    wcs: WCS,
+    grid_wcs: WCS,
+    grid_shape: tuple[int, int],
+    out: np.ndarray | None = None,
+    tile_rows: int | None = COADD_TILE_ROWS,
+) -> np.ndarray:
+    """Spread the pixel values of a frame over the pixels of the grid (cloud-in-cell)
+    and add them to out (a float64 image of grid_shape), NaNs count as 0"""
+
+    if out is None:
+        out = np.zeros(grid_shape, dtype=np.float64)
+    ny, nx = data.shape
+    gy, gx = grid_shape
+    for tile in row_tiles(ny, tile_rows):
+        values = np.nan_to_num(np.asarray(data[tile], dtype=np.float64), nan=0.0)
+        y, x = np.mgrid[tile, :nx]
+        world = wcs.all_pix2world(np.column_stack([x.ravel(), y.ravel()]), 0)
+        pos = grid_wcs.all_world2pix(world, 0)
+        x0 = np.floor(pos[:, 0]).astype(int)
+        y0 = np.floor(pos[:, 1]).astype(int)
+        fx = pos[:, 0] - x0
+        fy = pos[:, 1] - y0
+        values = values.ravel()
+
+        indices, weights = [], []
+        for dx, dy, weight in [
+            (0, 0, (1 - fx) * (1 - fy)),
+            (1, 0, fx * (1 - fy)),
+            (0, 1, (1 - fx) * fy),
+            (1, 1, fx * fy),
+        ]:
+            xi, yi = x0 + dx, y0 + dy
+            inside = (xi >= 0) & (xi < gx) & (yi >= 0) & (yi < gy) & (values != 0)
+            indices.append(yi[inside] * gx + xi[inside])
+            weights.append(weight[inside] * values[inside])
+        out += np.bincount(
+            np.concatenate(indices), np.concatenate(weights), minlength=gy * gx
+        ).reshape(grid_shape)
+    return out
+
+
+def coadd(
+    allfile: str,
+    maskfile: str,
+    method: str,
+    pixsize: float = PIXSIZE,
+    dtype: DTypeLike = None,
+) -> fits.HDUList:
+    """Co-add the frames of an "all" image, with the frames of the mask in maskfile,
+    on a common sky grid; returns the summed image (in float32 by default)"""
+
+    if method not in METHODS:
+        raise ValueError(f"Unknown method {method}, expected one of {METHODS}")
+
+    with fits.open(allfile) as all_hdul, fits.open(maskfile) as mask_hdul:
+        if len(mask_hdul) != len(all_hdul):
+            raise ValueError(
+                f"{os.path.basename(allfile)} has {len(all_hdul) - 1} frames, "
+                f"the mask {os.path.basename(maskfile)} {len(mask_hdul) - 1}"
+            )
+        frames = [
+            (frame, mask_frame)
+            for frame, mask_frame in zip(all_hdul[1:], mask_hdul[1:])
+            if not is_excluded(frame.header)
+        ]
+        if not frames:
+            raise ValueError(f"{os.path.basename(allfile)} has no frames to co-add")
+        wcs_list = [frame_wcs(frame.header) for frame, _ in frames]
+        grid_wcs, grid_shape = sky_grid(
+            [
+                (wcs, (frame.header["NAXIS2"], frame.header["NAXIS1"]))
+                for wcs, (frame, _) in zip(wcs_list, frames)
+            ],
+            pixsize,
+        )
+
+        total = np.zeros(grid_shape, dtype=np.float64)
+        for wcs, (frame, mask_frame) in zip(wcs_list, frames):
+            data = frame_values(frame.data, mask_frame.data, wcs, method, pixsize)
+            deposit(data, wcs, grid_wcs, grid_shape, out=total)
+
+        header = grid_header(
+            frames[0][0].header,
+            grid_wcs,
+            sum(frame.header.get("EXPOSURE", 0.0) for frame, _ in frames),
+            len(frames),
+        )
+
+        return fits.HDUList(
+            [
+                fits.PrimaryHDU(header=all_hdul[0].header),
+                fits.ImageHDU(total.astype(dtype or np.float32), header),
+            ]
+        )
+
+
+def grid_header(
+    header: fits.Header, grid_wcs: WCS, exposure: float, n_frames: int
+) -> fits.Header:
+    """The header of a co-added image: the header of its first frame, with the WCS of
+    the grid, the total exposure time and the number of co-added frames"""
+
+    header = header.copy()
+    for key in {key for key in header if WCS_KEYWORD.fullmatch(key)}:
+        header.remove(key, remove_all=True)
+    header.update(grid_wcs.to_header())
+    if "EXPOSURE" in header:
+        header["EXPOSURE"] = exposure
+    header["NFRAMES"] = (n_frames, "number of co-added frames")
+    return header
+
+
+def coadd_frames(
+    allfile: str,
+    maskfile: str,
+    outfile: str,
+    method: str,
+    pixsize: float = PIXSIZE,
+    dtype: DTypeLike = None,
+    scratch_dir: str | None = None,
+) -> bool:
+    """co-add all frames of an image (see `coadd`), a drop-in for
+    `dresscode.uvotimsum.coaddframes`
+
+    Returns a bool indicating if an error occurred"""
+
+    try:
+        writeto(
+            coadd(allfile, maskfile, method, pixsize, dtype),
+            outfile,
+            scratch_dir=scratch_dir,
+        )
+    except (OSError, ValueError) as e:
+        print(f"An error has occurred in creating {allfile}: {e}")
+        return True
+    print(
+        f"All frames in {os.path.basename(allfile)} have been co-added into "
+        f"{os.path.basename(outfile)}."
+    )
+    return False
@@ -10,7 +10,8 @@ import shutil
 from argparse import ArgumentParser
 from typing import Optional, Sequence
 
-from dresscode.utils import listdir_nohidden, load_config
+from dresscode.config import add_performance_arguments, read_config
+from dresscode.utils import listdir_nohidden
 
 
 def main(argv: Optional[Sequence[str]] = None) -> int:
@@ -18,12 +19,13 @@ def main(argv: Optional[Sequence[str]] = None) -> int:
     parser.add_argument(
         "-c", "--config", help="path to config.txt", default="config.txt"
     )
+    add_performance_arguments(parser)
     args = parser.parse_args(argv)
 
-    config = load_config(args.config)
+    config = read_config(args.config, "collect_images", args)
 
-    galaxy = config["galaxy"]
-    path = config["path"] + galaxy
+    galaxy = config.galaxy
+    path = config.path + galaxy
 
     # Define the paths of the raw data and of the new directory with raw images.
     rawpath = path + "/Raw_data/"
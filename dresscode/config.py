@@ -0,0 +1,275 @@
+"""
+config.py: The configuration of the pipeline, read from the configuration file
+(config.txt) by every step.
+
+The configuration file has `key = value` lines with the path of the main directory and
+the name of the galaxy, followed by an optional [performance] section with the
+throughput settings of the steps. A [performance.<step>] section overrides the
+[performance] section for one step (e.g. [performance.corrections] for dc-corrections),
+and the command line options of a step override both:
+
+    path = /data/SWIFT_data/
+    galaxy = NGC0628
+
+    [performance]
+    dtype = float32
+
+    [performance.corrections]
+    threads = 4
+"""
+
+from __future__ import annotations
+
+from argparse import ArgumentParser, Namespace
+from dataclasses import dataclass, field, fields, replace
+from typing import Callable
+
+import numpy as np
+
+# the steps of the pipeline, dc-<step> runs dresscode.<step>.main
+STEPS = [
+    "collect_images",
+    "header_info",
+    "uvotimage",
+    "uvotskycorr",
+    "uvotattcorr",
+    "uvotimage2",
+    "uvotbadpix",
+    "uvotexpmap",
+    "uvotskycorr2",
+    "uvotskylss",
+    "corrections",
+    "uvotimsum",
+    "calibration",
+]
+
+# how the frames are co-added by dc-uvotimsum: with HEASoft uvotimsum, or in Python
+# (see dresscode.coadd)
+COADD_ENGINES = ["uvotimsum", "native"]
+
+
+def _positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise ValueError(f"{value} is not a positive integer")
+    return number
+
+
+def _non_negative_int(value: str) -> int:
+    number = int(value)
+    if number < 0:
+        raise ValueError(f"{value} is not a non-negative integer")
+    return number
+
+
+def _float_dtype(value: str) -> np.dtype:
+    dtype = np.dtype(value)
+    if dtype not in (np.float32, np.float64):
+        raise ValueError(f"{value} is not float32 or float64")
+    return dtype
+
+
+def _coadd_engine(value: str) -> str:
+    if value not in COADD_ENGINES:
+        raise ValueError(f"{value} is not one of {', '.join(COADD_ENGINES)}")
+    return value
+
+
+def _bool(value: str) -> bool:
+    if value.lower() in ("true", "yes", "1"):
+        return True
+    if value.lower() in ("false", "no", "0"):
+        return False
+    raise ValueError(f"{value} is not true or false")
+
+
+@dataclass(frozen=True)
+class PerformanceProfile:
+    """Throughput settings of a step, the defaults keep the standard behaviour. Steps
+    ignore the settings that don't apply to them."""
+
+    # number of processes that correct images in parallel, or of images that are
+    # co-added in parallel
+    workers: int = 1
+    # number of threads that correct the frames of an image in parallel
+    threads: int = 1
+    # process the frames in tiles of this many rows, to bound the memory use
+    tile_rows: int | None = None
+    # compute and write the corrected and summed images in this precision
+    dtype: np.dtype | None = None
+    # directory for temporary files, default: the working directory
+    scratch_dir: str | None = None
+    # write the intermediate images of the corrections, not only the ones needed by the
+    # next steps
+    keep_intermediates: bool = False
+    # interpolate the coincidence loss correction factors in a lookup table
+    coicorr_lut: bool = False
+    # number of frames that are read ahead in a background thread, while the current
+    # frames are corrected (0: read the frames when they are corrected)
+    prefetch: int = 0
+    # co-add the frames with HEASoft uvotimsum or in Python (dresscode.coadd)
+    coadd: str = "uvotimsum"
+    # keep the co-added images of every filter in a store, and only add the new images
+    # and remove the removed or changed images (dresscode.accumulator)
+    incremental: bool = False
+
+
+# how to parse each setting of the performance profile from the configuration file
+PROFILE_PARSERS: dict[str, Callable[[str], object]] = {
+    "workers": _positive_int,
+    "threads": _positive_int,
+    "tile_rows": _positive_int,
+    "dtype": _float_dtype,
+    "scratch_dir": str,
+    "keep_intermediates": _bool,
+    "coicorr_lut": _bool,
+    "prefetch": _non_negative_int,
+    "coadd": _coadd_engine,
+    "incremental": _bool,
+}
+
+
+@dataclass(frozen=True)
+class Config:
+    """The configuration of a step of the pipeline"""
+
+    # path of the main directory, in which the galaxy directories are located
+    path: str
+    galaxy: str
+    # the performance profile of this step
+    performance: PerformanceProfile = field(default_factory=PerformanceProfile)
+
+
+def read_sections(config_file: str) -> dict[str, dict[str, str]]:
+    """Read the `key = value` lines of the configuration file per section, the lines
+    before the first section are in section ""."""
+
+    sections: dict[str, dict[str, str]] = {"": {}}
+    section = sections[""]
+    with open(config_file) as configfile:
+        for line in (
+            line.strip()
+            for line in configfile
+            if line.strip() and not line.startswith("#")
+        ):
+            if line.startswith("[") and line.endswith("]"):
+                section = sections.setdefault(line[1:-1].strip(), {})
+                continue
+            if "=" not in line:
+                raise ValueError(f"{config_file}: expected 'key = value', got '{line}'")
+            key, value = line.split("=", 1)
+            section[key.strip()] = value.strip()
+    return sections
+
+
+def parse_profile(
+    settings: dict[str, str], profile: PerformanceProfile, section: str
+) -> PerformanceProfile:
+    """Update the performance profile with the settings of a section"""
+
+    changes = {}
+    for key, value in settings.items():
+        if key not in PROFILE_PARSERS:
+            raise ValueError(
+                f"Unknown setting '{key}' in [{section}], "
+                f"expected one of {', '.join(PROFILE_PARSERS)}"
+            )
+        try:
+            changes[key] = PROFILE_PARSERS[key](value)
+        except (TypeError, ValueError) as e:
+            raise ValueError(f"Invalid {key} in [{section}]: {e}") from None
+    return replace(profile, **changes)
+
+
+def add_performance_arguments(parser: ArgumentParser):
+    """Add the command line options that override the performance profile"""
+
+    group = parser.add_argument_group(
+        "performance", "override the performance profile of the configuration file"
+    )
+    group.add_argument("--workers", type=_positive_int, help="number of processes")
+    group.add_argument("--threads", type=_positive_int, help="threads per image")
+    group.add_argument("--tile-rows", type=_positive_int, help="rows per tile")
+    group.add_argument(
+        "--dtype", type=_float_dtype, help="precision of the images (float32/float64)"
+    )
+    group.add_argument("--scratch-dir", help="directory for temporary files")
+    group.add_argument(
+        "--keep-intermediates",
+        action="store_true",
+        default=None,
+        help="write the intermediate images of the corrections (for debugging)",
+    )
+    group.add_argument(
+        "--no-keep-intermediates",
+        action="store_false",
+        dest="keep_intermediates",
+        help="only write the images that are needed by the next steps",
+    )
+    group.add_argument(
+        "--coicorr-lut",
+        action="store_true",
+        default=None,
+        help="interpolate the coincidence loss correction factors in a lookup table",
+    )
+    group.add_argument(
+        "--prefetch", type=_non_negative_int, help="frames to read ahead"
+    )
+    group.add_argument(
+        "--coadd", choices=COADD_ENGINES, help="how to co-add the frames"
+    )
+    group.add_argument(
+        "--incremental",
+        action="store_true",
+        default=None,
+        help="only co-add the new images, and remove the removed or changed images",
+    )
+
+
+def read_config(config_file: str, step: str, args: Namespace | None = None) -> Config:
+    """Read and validate the configuration of a step of the pipeline
+
+    The performance profile of the step is the [performance] section, updated with the
+    [performance.<step>] section and the command line options in args (see
+    `add_performance_arguments`)."""
+
+    if step not in STEPS:
+        raise ValueError(f"Unknown step {step}")
+
+    sections = read_sections(config_file)
+    settings = sections.pop("")
+    missing = {"path", "galaxy"} - set(settings)
+    if missing:
+        raise ValueError(f"{config_file}: missing {', '.join(sorted(missing))}")
+    unknown = set(settings) - {"path", "galaxy"}
+    if unknown:
+        raise ValueError(
+            f"{config_file}: unknown setting(s) {', '.join(sorted(unknown))}, "
+            "performance settings go in the [performance] section"
+        )
+    valid_sections = ["performance"] + [f"performance.{name}" for name in STEPS]
+    for section in sections:
+        if section not in valid_sections:
+            raise ValueError(f"{config_file}: unknown section [{section}]")
+
+    performance = parse_profile(
+        sections.get("performance", {}), PerformanceProfile(), "performance"
+    )
+    step_section = f"performance.{step}"
+    performance = parse_profile(
+        sections.get(step_section, {}), performance, step_section
+    )
+    if args is not None:
+        performance = replace(
+            performance,
+            **{
+                profile_field.name: getattr(args, profile_field.name)
+                for profile_field in fields(PerformanceProfile)
+                if getattr(args, profile_field.name, None) is not None
+            },
+        )
+
+    path = settings["path"]
+    if not path.endswith("/"):
+        path += "/"
+    return Config(path=path, galaxy=settings["galaxy"], performance=performance)
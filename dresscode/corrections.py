@@ -6,209 +6,634 @@ corrections.py: Script to apply corrections to the images.
 
 from __future__ import annotations
 
+import hashlib
+import io
+import json
 import os
+import time
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import ExitStack, closing, redirect_stdout
 from datetime import date, datetime
-from typing import Optional, Sequence
+from functools import lru_cache
+from itertools import islice
+from typing import Iterator, NamedTuple, Optional, Sequence
 
 import numpy as np
 from astropy.io import fits
 from astropy.io.fits.hdu.hdulist import HDUList
+from numpy.typing import DTypeLike
 
+from dresscode import utils
+from dresscode.config import (
+    PerformanceProfile,
+    add_performance_arguments,
+    read_config,
+)
+from dresscode.instrumentation import ImageStats, print_stats, write_stats
 from dresscode.utils import (
-    apply_mask,
+    AsyncWriter,
+    FrameWriter,
+    LazyFrames,
+    WindowedMoments,
+    apply_mask_data,
     check_filter,
-    load_config,
-    norm,
-    update_mask,
-    windowed_finite_vals,
-    windowed_std,
-    windowed_sum,
+    finite_bbox,
+    norm_data,
+    paste,
+    prefetch,
+    row_tiles,
+    temp_fname,
+    update_mask_data,
+    windowed_moment_tiles,
 )
 
+# radius of the 9x9 box of the coincidence loss correction
+COICORR_RADIUS = 4
+
+# rows per block of the coincidence loss correction, the temporary arrays of a block
+# fit in the CPU cache
+COICORR_BLOCK_ROWS = 16
+
+# number of points of the coincidence loss correction lookup table, the interpolated
+# correction factors have a relative error below COICORR_LUT_MAX_ERROR (5.5e-7 for
+# DEADC between 0.9 and 1, see tests/test_corrections.py)
+COICORR_LUT_POINTS = 2**16
+COICORR_LUT_MAX_ERROR = 1e-6
+
 ZEROPOINT_PARAMS = {
     "um2": (-2.330e-3, -1.361e-3),
     "uw2": (1.108e-3, -1.960e-3),
     "uw1": (2.041e-3, -1.748e-3),
 }
 
+# the images written for a sky image (*_sk_corr.img -> *<suffix>), the products are
+# needed by uvotimsum, the intermediate images are only written if they are kept
+PRODUCT_SUFFIXES = [
+    "_mk_corr_new.img",
+    "_sk_corr_coi_lss_zp_dn.img",
+    "_sk_corr_coi_lss_zp_dn_oc.img",
+    "_sk_corr_coicorr_unc_sq_cts.img",
+    "_sk_corr_zp_cts.img",
+]
+INTERMEDIATE_SUFFIXES = [
+    "_sk_corr_mk.img",
+    "_sk_corr_nm.img",
+    "_sk_corr_coi.img",
+    "_sk_corr_coi_corrfactor.img",
+    "_sk_corr_coi_coicorr_unc.img",
+    "_sk_corr_coi_lss.img",
+    "_sk_corr_coi_lss_zp.img",
+]
+
+# the fingerprints of the inputs of the corrected images, in the working directory
+MANIFEST_FNAME = "corrections_manifest.json"
+# the time, bytes read and written and peak memory of the stages of the last run
+STATS_FNAME = "corrections_stats.json"
+
 
 def main(argv: Optional[Sequence[str]] = None) -> int:
     parser = ArgumentParser()
     parser.add_argument(
         "-c", "--config", help="path to config.txt", default="config.txt"
     )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="correct all images, also the ones whose inputs haven't changed",
+    )
+    add_performance_arguments(parser)
     args = parser.parse_args(argv)
 
-    config = load_config(args.config)
-
-    galaxy = config["galaxy"]
-    path = config["path"] + galaxy + "/working_dir/"
+    config = read_config(args.config, "corrections", args)
 
+    galaxy = config.galaxy
+    path = config.path + galaxy + "/working_dir/"
     file_patt_to_corr = ("sk_corr.img",)
     filenames = [
         filename
         for filename in sorted(os.listdir(path))
         if filename.endswith(file_patt_to_corr)
     ]
-    for i, fname in enumerate(filenames):
-        fname = path + fname
-
-        # update the masks
-        # remove pixels that are NaN in the exposure map and pixels that have very low exposure times
-        mask_fname = fname.replace("_sk_corr.img", "_mk_corr.img")
-        exp_fname = mask_fname.replace("mk", "ex")
-        new_mask_fname = mask_fname.replace(".img", "_new.img")
-        new_mask_hdul = update_mask(mask_fname, exp_fname, new_mask_fname)
-
-        # we manipulate the data directly, so open it in memory
-        unmasked_hdul = fits.open(fname)
-
-        # apply mask to data, set 0's in mask to nan's
-        # coincidence loss correction factor & uncertainties need to take into account missing data
-        masked_hdul_fname = fname.replace(".img", "_mk.img")
-        masked_hdul = apply_mask(unmasked_hdul, new_mask_hdul, masked_hdul_fname)
-
-        # apply normalization to data to convert to counts/sec
-        norm_hdul_fname = fname.replace(".img", "_nm.img")
-        exp_hdul = fits.open(exp_fname)
-        norm_hdul = norm(masked_hdul, exp_hdul, norm_hdul_fname)
-
-        # Apply a coincidence loss correction, saving "planes" as separate files
-        print("Applying coincidence loss corrections...")
-        coicorr_hdul, coicorr_fname, corrfactor_hdul, corrfactor_unc_hdul = coicorr(
-            norm_hdul, fname
+
+    # skip the images whose inputs haven't changed since they were corrected
+    manifest = load_manifest(path)
+    fingerprints = {
+        fname: input_fingerprint(path + fname, config.performance)
+        for fname in filenames
+    }
+    if not args.force:
+        up_to_date = [
+            fname
+            for fname in filenames
+            if is_up_to_date(
+                path + fname,
+                fingerprints[fname],
+                manifest,
+                config.performance.keep_intermediates,
+            )
+        ]
+        if up_to_date:
+            print(
+                f"Skipping {len(up_to_date)}/{len(filenames)} images whose inputs "
+                "haven't changed (use --force to correct them again)."
+            )
+        filenames = [fname for fname in filenames if fname not in up_to_date]
+
+    def record(fname: str):
+        # record the fingerprint of the inputs of a corrected image
+        manifest[fname] = {
+            "fingerprint": fingerprints[fname],
+            "outputs": output_fnames(fname, config.performance.keep_intermediates),
+        }
+        save_manifest(path, manifest)
+
+    # the time, bytes read and written and peak memory of the stages of every image
+    start = time.perf_counter()
+    image_stats: dict[str, dict] = {}
+
+    workers = config.performance.workers
+    failed = []
+    n_corrected = 0
+
+    def corrected(fname: str, stats: dict):
+        nonlocal n_corrected
+        image_stats[fname] = stats
+        record(fname)
+        n_corrected += 1
+        print(f"Corrected image {n_corrected}/{len(filenames)}.")
+
+    def error(fname: str, e: str):
+        failed.append(fname)
+        print(f"An error has occurred in correcting {fname}: {e}")
+
+    if workers == 1:
+        # optionally read the frames ahead in a background thread, the frames of the
+        # next image are read while the last frames of an image are corrected
+        def read_ahead(fnames: list[str]) -> Optional[Iterator[FrameInputs]]:
+            if not config.performance.prefetch:
+                return None
+            images = (frame for fname in fnames for frame in read_frames(path + fname))
+            return prefetch(images, config.performance.prefetch)
+
+        frames = read_ahead(filenames)
+        try:
+            for i, fname in enumerate(filenames):
+                stats = ImageStats()
+                try:
+                    correct_image(path + fname, config.performance, frames, stats)
+                except Exception as e:
+                    error(fname, repr(e))
+                    # skip the frames of the image that are still read ahead
+                    if frames is not None:
+                        frames.close()
+                        frames = read_ahead(filenames[i + 1 :])
+                else:
+                    corrected(fname, stats.to_dict())
+        finally:
+            if frames is not None:
+                frames.close()
+    else:
+        # correct the images in a pool of processes, the output of an image is printed
+        # when it has been corrected
+        print(f"Correcting {len(filenames)} images in {workers} processes...")
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(
+                    correct_image_logged, path + fname, config.performance
+                ): fname
+                for fname in filenames
+            }
+            for future in as_completed(futures):
+                fname = futures[future]
+                try:
+                    log, image, e = future.result()
+                except Exception as pool_error:
+                    # e.g. the process has been killed
+                    log, image, e = "", {}, repr(pool_error)
+                print(log, end="")
+                if e is None:
+                    corrected(fname, image)
+                else:
+                    error(fname, e)
+
+    if image_stats:
+        stats_fname = path + STATS_FNAME
+        print_stats(
+            write_stats(
+                stats_fname,
+                image_stats,
+                wall=time.perf_counter() - start,
+                workers=workers,
+                threads=config.performance.threads,
+                prefetch=config.performance.prefetch,
+            )
         )
+        print(f"The time and memory use per stage have been written to {STATS_FNAME}")
+
+    if failed:
+        print(f"{len(failed)}/{len(filenames)} images could not be corrected.")
+        return 1
+    return 0
+
+
+def output_fnames(fname: str, keep_intermediates: bool = False) -> list[str]:
+    """The images written by correct_image for a sky image"""
+
+    suffixes = PRODUCT_SUFFIXES + (INTERMEDIATE_SUFFIXES if keep_intermediates else [])
+    return [fname.replace("_sk_corr.img", suffix) for suffix in suffixes]
 
-        # Apply a large scale sensitivity correction.
-        print("Applying large scale sensitivity corrections...")
-        lsscorr_hdul, lsscorr_fname = lsscorr(coicorr_hdul, coicorr_fname)
 
-        # Apply a zero point correction
-        print("Applying zero point corrections...")
-        zp_corr_fname = lsscorr_fname.replace(".img", "_zp.img")
-        zp_corr_hdul = zeropoint(
-            lsscorr_hdul, zp_corr_fname, *ZEROPOINT_PARAMS[check_filter(fname)]
+@lru_cache(maxsize=None)
+def code_version() -> str:
+    """A digest of the code of the corrections (also changes between releases)"""
+
+    digest = hashlib.sha256()
+    for module_fname in [__file__, utils.__file__]:
+        with open(module_fname, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:12]
+
+
+def input_fingerprint(fname: str, performance: PerformanceProfile) -> str | None:
+    """Fingerprint of the inputs of the corrections of a sky image: the sky image, mask,
+    exposure map and large scale sensitivity map (their size and modification time),
+    the zero point parameters, the code version and the settings that change the
+    output. None if an input is missing."""
+
+    digest = hashlib.sha256()
+    for file_type in ["sk", "mk", "ex", "lss"]:
+        input_fname = fname.replace("_sk_corr.img", f"_{file_type}_corr.img")
+        try:
+            stat = os.stat(input_fname)
+        except FileNotFoundError:
+            return None
+        digest.update(
+            f"{os.path.basename(input_fname)} {stat.st_size} {stat.st_mtime_ns}\n".encode()
         )
+    digest.update(repr(ZEROPOINT_PARAMS[check_filter(fname)]).encode())
+    digest.update(
+        f"{code_version()} {performance.dtype} {performance.coicorr_lut}".encode()
+    )
+    return digest.hexdigest()
+
+
+def is_up_to_date(
+    fname: str,
+    fingerprint: str | None,
+    manifest: dict,
+    keep_intermediates: bool = False,
+) -> bool:
+    """Whether the sky image has been corrected with the same inputs (fingerprint) and
+    the outputs of the current settings exist (the intermediate images only with
+    keep_intermediates, which doesn't change the other outputs)"""
+
+    entry = manifest.get(os.path.basename(fname))
+    return (
+        fingerprint is not None
+        and entry is not None
+        and entry["fingerprint"] == fingerprint
+        and all(
+            os.path.isfile(output_fname)
+            for output_fname in output_fnames(fname, keep_intermediates)
+        )
+    )
 
-        # remove normalization to convert back to counts (needed for uvotimsum)
-        print("Removing normalization to convert back to counts...")
-        primary_cts_fname = zp_corr_fname.replace(".img", "_dn.img")
-        primary_cts_hdul = convert_to_cts(zp_corr_hdul, exp_hdul, primary_cts_fname)
 
-        # calc orig counts for each frame (needed for uvotimsum)
-        print("Removing correction factor to get uncorrected orig. counts...")
-        orig_cts_fname = primary_cts_fname.replace(".img", "_oc.img")
-        rem_corr_factor(primary_cts_hdul, corrfactor_hdul, orig_cts_fname)
+def load_manifest(path: str) -> dict:
+    """The manifest of the corrected images in the working directory"""
 
-        # calc the squared coincidence loss uncertainty in counts
-        print("Calculating squared coincidence loss uncertainty in counts...")
-        sq_coicorr_unc_fname = fname.replace(".img", "_coicorr_unc_sq_cts.img")
-        coicorr_uncert_cts(primary_cts_hdul, corrfactor_unc_hdul, sq_coicorr_unc_fname)
+    manifest_fname = os.path.join(path, MANIFEST_FNAME)
+    if not os.path.isfile(manifest_fname):
+        return {}
+    with open(manifest_fname) as f:
+        return json.load(f)
 
-        print("Calculating the zero point correction in counts...")
-        zp_corr_cts_fname = fname.replace(".img", "_zp_cts.img")
-        zp_corr_cts(primary_cts_hdul, zp_corr_cts_fname)
 
-        print(f"Corrected image {i + 1}/{len(filenames)}.")
+def save_manifest(path: str, manifest: dict):
+    """Write the manifest of the corrected images, replacing the previous one at once"""
 
-        # close all the hdu lists
-        unmasked_hdul.close()
-        exp_hdul.close()
+    manifest_fname = os.path.join(path, MANIFEST_FNAME)
+    tmp_fname = temp_fname(manifest_fname)
+    try:
+        with open(tmp_fname, "w") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_fname, manifest_fname)
+    finally:
+        if os.path.exists(tmp_fname):
+            os.remove(tmp_fname)
 
-    return 0
 
+def correct_image(
+    fname: str,
+    performance: PerformanceProfile = PerformanceProfile(),
+    frames: Optional[Iterator[FrameInputs]] = None,
+    stats: Optional[ImageStats] = None,
+):
+    """Apply the corrections to a sky image (*_sk_corr.img) frame by frame, taking its
+    frames from `frames` if given"""
+
+    if stats is None:
+        stats = ImageStats()
+    start = time.perf_counter()
+
+    # optionally process the frames in tiles of rows, to bound the memory use, compute
+    # and write the corrected images in a fixed precision (float32) and correct the
+    # frames of an image in a pool of threads
+    tile_rows = performance.tile_rows
+    dtype = performance.dtype
+    threads = performance.threads
+    # only write the images that are needed by uvotimsum, unless the intermediate images
+    # of the chain are kept (for debugging)
+    suffixes = PRODUCT_SUFFIXES + (
+        INTERMEDIATE_SUFFIXES if performance.keep_intermediates else []
+    )
+    # optionally interpolate the coincidence loss correction factors in a lookup table
+    lut = performance.coicorr_lut
+    zp_params = ZEROPOINT_PARAMS[check_filter(fname)]
+
+    def correct(inputs: FrameInputs) -> CorrectedFrame:
+        return correct_frame(
+            inputs.sky,
+            inputs.sky_header,
+            inputs.mask,
+            inputs.mask_header,
+            inputs.exp,
+            inputs.lss,
+            zp_params,
+            tile_rows=tile_rows,
+            dtype=dtype,
+            lut=lut,
+            stats=stats,
+        )
+
+    def read(frames: Iterator[FrameInputs], n_frames: int) -> list[FrameInputs]:
+        # the time waiting for the frames: reading them, or waiting for the background
+        # thread that reads them
+        with stats.stage("read") as stage:
+            inputs = list(islice(frames, n_frames))
+            stage.bytes_read += sum(
+                data.nbytes
+                for frame in inputs
+                for data in (frame.sky, frame.mask, frame.exp, frame.lss)
+            )
+        return inputs
+
+    with ExitStack() as stack:
+        # the corrected frames are written in the background, while the next frames
+        # are corrected
+        writer = stack.enter_context(AsyncWriter(scratch_dir=performance.scratch_dir))
+        if frames is None:
+            frames = stack.enter_context(closing(read_frames(fname)))
+            if performance.prefetch:
+                frames = stack.enter_context(
+                    closing(prefetch(frames, performance.prefetch))
+                )
+
+        first = next(iter(read(frames, 1)), None)
+        if first is None or first.fname != fname:
+            raise ValueError(f"No frames to correct in {os.path.basename(fname)}")
+
+        print("Applying the corrections frame by frame...")
+        sky_primary_header, mask_primary_header = first.primary_headers
+        writers = {
+            suffix: FrameWriter(
+                fname.replace("_sk_corr.img", suffix),
+                mask_primary_header if suffix.startswith("_mk") else sky_primary_header,
+                writer,
+            )
+            for suffix in suffixes
+        }
+
+        # the frames are corrected in batches of `threads` frames, in a pool of threads
+        # (numpy releases the GIL in the array operations)
+        executor = (
+            stack.enter_context(ThreadPoolExecutor(max_workers=threads))
+            if threads > 1
+            else None
+        )
+        # the other frames of this image
+        image = islice(frames, first.n_frames - 1)
+        batch = [first] + read(image, threads - 1)
+        while batch:
+            if executor is None:
+                batch_corrected = map(correct, batch)
+            else:
+                batch_corrected = executor.map(correct, batch)
+            for corrected in batch_corrected:
+                print_coicorr_stats(fname, *corrected.coicorr_stats)
+                # the time waiting to hand over the frames to the background writer
+                with stats.stage("write"):
+                    for suffix, frame_writer in writers.items():
+                        frame_writer.append(*corrected.images[suffix])
+            batch = read(image, threads)
+
+        # the time waiting for the files to be written
+        with stats.stage("write") as stage:
+            for frame_writer in writers.values():
+                frame_writer.close()
+            writer.wait()
+            stage.bytes_written += sum(
+                os.path.getsize(frame_writer.fname) for frame_writer in writers.values()
+            )
 
-def coicorr(hdulist: HDUList, fname: str):
-    """Coincidence loss correction"""
+    stats.wall += time.perf_counter() - start
+
+    print(
+        os.path.basename(fname)
+        + " has been corrected for coincidence loss, large scale sensitivity variations"
+        + " and sensitivity loss of the detector over time, and converted back to counts"
+        + " (for summing)."
+    )
+
+
+class FrameInputs(NamedTuple):
+    """A frame of a sky image, with the frames of its mask, exposure map and large scale
+    sensitivity map, and the primary headers of the sky image and the mask"""
+
+    fname: str
+    n_frames: int
+    primary_headers: tuple[fits.Header, fits.Header]
+    sky: np.ndarray
+    sky_header: fits.Header
+    mask: np.ndarray
+    mask_header: fits.Header
+    exp: np.ndarray
+    lss: np.ndarray
+
+
+def read_frames(fname: str) -> Iterator[FrameInputs]:
+    """The frames of a sky image (*_sk_corr.img) and of its mask, exposure map and large
+    scale sensitivity map, one at a time, read into memory"""
+
+    input_fnames = [
+        fname.replace("_sk_corr.img", f"_{file_type}_corr.img")
+        for file_type in ["sk", "mk", "ex", "lss"]
+    ]
+    with LazyFrames(*input_fnames) as frames:
+        primary_headers = frames.primary_headers
+        for sk_frame, mk_frame, ex_frame, lss_frame in frames:
+            sky, mask, exp, lss = (
+                np.array(frame.data)
+                for frame in (sk_frame, mk_frame, ex_frame, lss_frame)
+            )
+            yield FrameInputs(
+                fname,
+                len(frames),
+                (primary_headers[0], primary_headers[1]),
+                sky,
+                sk_frame.header,
+                mask,
+                mk_frame.header,
+                exp,
+                lss,
+            )
+
+
+class CorrectedFrame(NamedTuple):
+    """The corrected images of a frame (data and header by the suffix of the image, see
+    PRODUCT_SUFFIXES and INTERMEDIATE_SUFFIXES) and the coincidence loss correction
+    factor, its relative uncertainty and the pixels with a very high flux"""
+
+    images: dict[str, tuple[np.ndarray, fits.Header]]
+    coicorr_stats: tuple[np.ndarray, np.ndarray, np.ndarray]
+
+
+def correct_frame(
+    sky: np.ndarray,
+    sky_header: fits.Header,
+    mask: np.ndarray,
+    mask_header: fits.Header,
+    exp: np.ndarray,
+    lss: np.ndarray,
+    zp_params: tuple[float, float],
+    tile_rows: int | None = None,
+    dtype: DTypeLike = None,
+    lut: bool = False,
+    stats: Optional[ImageStats] = None,
+) -> CorrectedFrame:
+    """Apply the chain of corrections to a frame of a sky image, with its mask, exposure
+    map and large scale sensitivity map, the same as correcting the frame with update_mask,
+    apply_mask, norm, coicorr, lsscorr, zeropoint, convert_to_cts, rem_corr_factor,
+    coicorr_uncert_cts and zp_corr_cts. The time of each correction is added to stats."""
+
+    if stats is None:
+        stats = ImageStats()
+
+    # update the mask: remove pixels that are NaN in the exposure map and pixels that
+    # have very low exposure times
+    with stats.stage("update_mask"):
+        new_mask = update_mask_data(mask, exp, out=mask)
+
+    # apply the mask to the data, set 0's in mask to NaN's
+    with stats.stage("apply_mask"):
+        masked = apply_mask_data(sky, new_mask, dtype)
+        # the corrections are computed on the bounding box of the finite pixels (plus
+        # the radius of the box of the coincidence loss correction), the pixels outside
+        # of it are NaN (and 0 in the images in counts)
+        region = finite_bbox(masked, COICORR_RADIUS)
+        exp_region = exp[region]
+
+    # normalize the data to counts/s
+    with stats.stage("norm"):
+        normed = norm_data(masked[region], exp_region, dtype=dtype)
+
+    # coincidence loss correction
+    alpha = sky_header["DEADC"]
+    ft = sky_header["FRAMTIME"]
+    with stats.stage("coicorr"):
+        coicorr_data, corrfactor, coicorr_rel, high_flux = coicorr_frame(
+            normed, alpha, ft, tile_rows=tile_rows, dtype=dtype, lut=lut
+        )
+
+    # large scale sensitivity and zero point correction
+    with stats.stage("lsscorr"):
+        lsscorr = lsscorr_data(coicorr_data, lss[region], dtype)
+    with stats.stage("zeropoint"):
+        zp_header = sky_header.copy()
+        zp_header["ZPCORR"] = zeropoint_factor(sky_header["DATE-OBS"], *zp_params)
+        zp_corr = zeropoint_data(lsscorr, zp_header["ZPCORR"])
+
+    # back to counts (needed for uvotimsum), the original counts, the squared coincidence
+    # loss uncertainty and the zero point correction in counts
+    with stats.stage("convert_to_cts"):
+        primary_cts = cts_data(zp_corr, exp_region, dtype)
+    with stats.stage("rem_corr_factor"):
+        orig_counts = orig_counts_data(primary_cts, corrfactor)
+    with stats.stage("coicorr_uncert_cts"):
+        coicorr_unc_sq_cts = coicorr_uncert_cts_data(primary_cts, coicorr_rel)
+    with stats.stage("zp_corr_cts"):
+        zp_cts = zp_corr_cts_data(primary_cts, zp_header["ZPCORR"])
+
+    def uncrop(data: np.ndarray, fill_value: float = np.nan) -> np.ndarray:
+        return paste(data, sky.shape, region, fill_value)
+
+    images = {
+        "_mk_corr_new.img": (new_mask, mask_header),
+        "_sk_corr_coi_lss_zp_dn.img": (uncrop(primary_cts, 0), zp_header),
+        "_sk_corr_coi_lss_zp_dn_oc.img": (uncrop(orig_counts, 0), zp_header),
+        "_sk_corr_coicorr_unc_sq_cts.img": (uncrop(coicorr_unc_sq_cts, 0), zp_header),
+        "_sk_corr_zp_cts.img": (uncrop(zp_cts, 0), zp_header),
+        "_sk_corr_mk.img": (masked, sky_header),
+        "_sk_corr_nm.img": (uncrop(normed), sky_header),
+        "_sk_corr_coi.img": (uncrop(coicorr_data), sky_header),
+        "_sk_corr_coi_corrfactor.img": (uncrop(corrfactor), sky_header),
+        "_sk_corr_coi_coicorr_unc.img": (uncrop(coicorr_rel), sky_header),
+        "_sk_corr_coi_lss.img": (uncrop(lsscorr), sky_header),
+        "_sk_corr_coi_lss_zp.img": (uncrop(zp_corr), zp_header),
+    }
+    # the pixels outside of the region are NaN, they don't change the medians
+    return CorrectedFrame(images, (corrfactor, coicorr_rel, uncrop(high_flux, False)))
+
+
+def correct_image_logged(
+    fname: str, performance: PerformanceProfile
+) -> tuple[str, dict, Optional[str]]:
+    """Apply the corrections to a sky image, returning the output instead of printing
+    it, so the output of images corrected in parallel isn't interleaved, the stats of
+    the stages (see `ImageStats`) and the error, if the image couldn't be corrected"""
+
+    stats = ImageStats()
+    with io.StringIO() as log, redirect_stdout(log):
+        try:
+            correct_image(fname, performance, stats=stats)
+        except Exception as e:
+            return log.getvalue(), stats.to_dict(), repr(e)
+        return log.getvalue(), stats.to_dict(), None
+
+
+def coicorr(
+    hdulist: HDUList,
+    fname: str,
+    tile_rows: int | None = None,
+    dtype: DTypeLike = None,
+    lut: bool = False,
+):
+    """Coincidence loss correction of every frame (see `coicorr_frame`, which is also
+    applied by `correct_frame`)
+
+    With tile_rows set, the frames are processed in tiles of rows to bound the memory
+    of the windowed sums and temporary arrays, with a bit-identical result. The windowed
+    sums are always
+    accumulated in float64, the correction is computed in float64 unless dtype is given.
+    With lut, the correction factors are interpolated in a lookup table (see
+    `coicorr_lut`).
+    """
     new_hdu_header = fits.PrimaryHDU(header=hdulist[0].header)
     coi_loss_corr_hdl = fits.HDUList([new_hdu_header])
     corrfactor_hdl = fits.HDUList([new_hdu_header])
     coicorr_unc_hdl = fits.HDUList([new_hdu_header])
 
     for frame in hdulist[1:]:
-        data = frame.data
         header = frame.header
-
-        # Sum the flux densities (count rates) of the 9x9 surrounding pixels: Craw (counts/s).
-        size = 9
-        radius = (size - 1) // 2
-        window_pixels = windowed_finite_vals(data, radius)
-        total_flux = windowed_sum(data, radius)
-
-        # standard deviation of the flux densities in the 9x9 pixels box.
-        std = windowed_std(data, radius, win_finite_vals=window_pixels)
-
         # Get dead time correction factor and frame time (in s)
         alpha = header["DEADC"]
         ft = header["FRAMTIME"]  # normally 11 ms, time between readouts
-
-        # Calculate the total number of counts in the 9x9 pixels box: x = Craw*ft (counts).
-        total_counts = ft * total_flux
-        # Calculate the minimum and maximum possible number of counts in the 9x9 pixels box.
-        total_counts_min = ft * (total_flux - window_pixels * std)
-        total_counts_max = ft * (total_flux + window_pixels * std)
-
-        # Calculate the polynomial correction factor and the minimum and maximum possible
-        # polynomial correction factor.
-        f = polynomial(total_counts)
-        f_min = polynomial(total_counts_min)
-        f_max = polynomial(total_counts_max)
-
-        # If alpha*total_counts_max is larger than 1, replace this value by 0.99. Otherwise,
-        # the maximum possible theoretical coincidence-loss-corrected count rate will be NaN
-        # in these pixels.
-        # todo: ask Marjorie: Could `total_counts_min` also be > 1?
-        # todo: they aren't replaced by 0.99, but instead by 0.99 / alpha ... ?
-        if np.sum(alpha * total_counts_max >= 1.0) != 0:
-            print(
-                "Warning: The following pixels have very high fluxes. The uncertainty on "
-                "the correction factor for these pixels is not to be trusted!",
-                np.where(alpha * total_counts_max >= 1.0),
-            )
-        total_counts_max[alpha * total_counts_max >= 1.0] = 0.99 / alpha
-
-        # Calculate the theoretical coincidence-loss-corrected count rate:
-        # Ctheory = -ln(1 - alpha*Craw*ft) / (alpha*ft) (counts/s).
-        # Calculate the minimum and maximum possible theoretical coincidence-loss-corrected
-        # count rate.
-        Ctheory = -np.log1p(-alpha * total_counts) / (alpha * ft)
-        Ctheory_min = -np.log1p(-alpha * total_counts_min) / (alpha * ft)
-        Ctheory_max = -np.log1p(-alpha * total_counts_max) / (alpha * ft)
-
-        # Calculate the coincidence loss correction factor:
-        # Ccorrfactor = Ctheory*f(x)/Craw.
-        # Calculate the minimum and maximum possible coincidence loss correction factor.
-        # todo: handle NaN's
-        corrfactor = (Ctheory * f) / total_flux
-        corrfactor_min = (Ctheory_min * f_min) / (total_flux - window_pixels * std)
-        corrfactor_max = (Ctheory_max * f_max) / (total_flux + window_pixels * std)
-
-        # Apply the coincidence loss correction to the data. Apply the minimum and maximum
-        # coincidence loss correction to the data.
-        new_data = corrfactor * data
-        new_data_min = corrfactor_min * data
-        new_data_max = corrfactor_max * data
-
-        # Calculate the uncertainty and the relative uncertainty on the coincidence loss
-        # correction. Put the relative uncertainty to 0 if the uncertainty is 0 (because in
-        # those pixels the flux is also 0 and the relative uncertainty would be NaN).
-        coicorr_unc = np.maximum(
-            np.abs(new_data - new_data_min), np.abs(new_data_max - new_data)
+        new_data, corrfactor, coicorr_rel, high_flux = coicorr_frame(
+            frame.data, alpha, ft, tile_rows=tile_rows, dtype=dtype, lut=lut
         )
-        # todo: handle NaN's
-        coicorr_rel = coicorr_unc / new_data
-        coicorr_rel[coicorr_unc == 0.0] = 0.0
 
-        print(
-            "The median coincidence loss correction factor for image "
-            + os.path.basename(fname)
-            + " is "
-            + str(np.nanmedian(corrfactor))
-            + " and the median relative uncertainty on the corrected data is "
-            + str(np.nanmedian(coicorr_rel))
-            + "."
-        )
+        print_coicorr_stats(fname, corrfactor, coicorr_rel, high_flux)
 
         # todo: should we keep these in the header somewhere?
         # header["PLANE0"] = "primary (counts/s)"
@@ -232,36 +657,316 @@ def coicorr(hdulist: HDUList, fname: str):
     return coi_loss_corr_hdl, new_fname, corrfactor_hdl, coicorr_unc_hdl
 
 
-def polynomial(x):
+def print_coicorr_stats(
+    fname: str, corrfactor: np.ndarray, coicorr_rel: np.ndarray, high_flux: np.ndarray
+):
+    """Print the median coincidence loss correction factor and relative uncertainty of a
+    frame, and the pixels whose uncertainty is not to be trusted"""
+
+    if np.sum(high_flux) != 0:
+        print(
+            "Warning: The following pixels have very high fluxes. The uncertainty on "
+            "the correction factor for these pixels is not to be trusted!",
+            np.where(high_flux),
+        )
+
+    print(
+        "The median coincidence loss correction factor for image "
+        + os.path.basename(fname)
+        + " is "
+        + str(np.nanmedian(corrfactor))
+        + " and the median relative uncertainty on the corrected data is "
+        + str(np.nanmedian(coicorr_rel))
+        + "."
+    )
+
+
+def coicorr_frame(
+    data: np.ndarray,
+    alpha: float,
+    ft: float,
+    tile_rows: int | None = None,
+    dtype: DTypeLike = None,
+    lut: bool = False,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Coincidence loss correction of a frame, with dead time correction factor alpha
+    and frame time ft (in s)
+
+    Returns the corrected data, the correction factor, the relative uncertainty and the
+    pixels with a flux too high to trust the uncertainty."""
+
+    new_data = np.empty(data.shape, dtype=dtype or np.float64)
+    corrfactor = np.empty_like(new_data)
+    coicorr_rel = np.empty_like(new_data)
+    high_flux = np.empty(data.shape, dtype=bool)
+    # Sum the flux densities (count rates) of the 9x9 surrounding pixels: Craw (counts/s).
+    # The number of finite pixels, the sum and the sum of squares of the 9x9 box are
+    # computed together in one pass, a tile of rows at a time.
+    for rows, moments in windowed_moment_tiles(data, COICORR_RADIUS, tile_rows):
+        (
+            new_data[rows],
+            corrfactor[rows],
+            coicorr_rel[rows],
+            high_flux[rows],
+        ) = coicorr_factor(data[rows], moments, alpha, ft, dtype, lut)
+
+    return new_data, corrfactor, coicorr_rel, high_flux
+
+
+def coicorr_factor(
+    data: np.ndarray,
+    moments: WindowedMoments,
+    alpha: float,
+    ft: float,
+    dtype: DTypeLike = None,
+    lut: bool = False,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Coincidence loss correction of (a tile of) a frame, given the windowed moments of
+    the 9x9 box around each pixel
+
+    Returns the corrected data, the correction factor, the relative uncertainty and the
+    pixels with a flux too high to trust the uncertainty. With lut, the correction
+    factors are interpolated in a lookup table (see `coicorr_lut`)."""
+
+    window_pixels = moments.count
+    total_flux = moments.total
+
+    # standard deviation of the flux densities in the 9x9 pixels box.
+    # (always from the float64 moments, the variance is prone to cancellation)
+    std = moments.std()
+
+    if dtype is not None:
+        data = data.astype(dtype, copy=False)
+        window_pixels = window_pixels.astype(dtype)
+        total_flux = total_flux.astype(dtype)
+        std = std.astype(dtype)
+
+    # The correction is computed in blocks of rows, in buffers that are allocated once,
+    # with the same operations (in the same order) as the full-frame expressions in the
+    # comments.
+    new_data = np.empty_like(total_flux, dtype=np.result_type(total_flux, data))
+    corrfactor = np.empty_like(total_flux)
+    coicorr_rel = np.empty_like(new_data)
+    high_flux = np.empty(total_flux.shape, dtype=bool)
+    table = coicorr_lut(alpha) if lut else None
+
+    block_shape = (min(COICORR_BLOCK_ROWS, total_flux.shape[0]),) + total_flux.shape[1:]
+    buffers = [np.empty(block_shape, dtype=total_flux.dtype) for _ in range(7)] + [
+        np.empty(block_shape, dtype=new_data.dtype) for _ in range(2)
+    ]
+
+    for rows in row_tiles(total_flux.shape[0], COICORR_BLOCK_ROWS):
+        (
+            flux_min,
+            flux_max,
+            counts,
+            f,
+            tmp,
+            corrfactor_min,
+            corrfactor_max,
+            new_data_min,
+            new_data_max,
+        ) = (buffer[: rows.stop - rows.start] for buffer in buffers)
+
+        # The minimum and maximum possible flux in the 9x9 pixels box:
+        # total_flux -/+ window_pixels * std
+        np.multiply(window_pixels[rows], std[rows], out=tmp)
+        np.subtract(total_flux[rows], tmp, out=flux_min)
+        np.add(total_flux[rows], tmp, out=flux_max)
+
+        # Calculate the coincidence loss correction factor: Ccorrfactor = Ctheory*f(x)/Craw,
+        # with the total number of counts in the 9x9 pixels box: x = Craw*ft (counts), the
+        # polynomial correction factor f(x) and the theoretical coincidence-loss-corrected
+        # count rate: Ctheory = -ln(1 - alpha*Craw*ft) / (alpha*ft) (counts/s).
+        # Calculate the minimum and maximum possible coincidence loss correction factor.
+        _corrfactor(
+            total_flux[rows], alpha, ft, corrfactor[rows], counts, f, tmp, lut=table
+        )
+        _corrfactor(flux_min, alpha, ft, corrfactor_min, counts, f, tmp, lut=table)
+        # If alpha*total_counts_max is larger than 1, replace this value by 0.99 / alpha
+        # (after the polynomial correction factor). Otherwise, the maximum possible
+        # theoretical coincidence-loss-corrected count rate will be NaN in these pixels.
+        # todo: ask Marjorie: Could `total_counts_min` also be > 1?
+        _corrfactor(
+            flux_max,
+            alpha,
+            ft,
+            corrfactor_max,
+            counts,
+            f,
+            tmp,
+            high_flux=high_flux[rows],
+            lut=table,
+        )
+
+        # Apply the coincidence loss correction to the data. Apply the minimum and
+        # maximum coincidence loss correction to the data.
+        np.multiply(corrfactor[rows], data[rows], out=new_data[rows])
+        np.multiply(corrfactor_min, data[rows], out=new_data_min)
+        np.multiply(corrfactor_max, data[rows], out=new_data_max)
+
+        # Calculate the uncertainty and the relative uncertainty on the coincidence loss
+        # correction: max(|new_data - new_data_min|, |new_data_max - new_data|). Put the
+        # relative uncertainty to 0 if the uncertainty is 0 (because in those pixels the
+        # flux is also 0 and the relative uncertainty would be NaN).
+        np.subtract(new_data[rows], new_data_min, out=new_data_min)
+        np.abs(new_data_min, out=new_data_min)
+        np.subtract(new_data_max, new_data[rows], out=new_data_max)
+        np.abs(new_data_max, out=new_data_max)
+        coicorr_unc = np.maximum(new_data_min, new_data_max, out=new_data_min)
+        # todo: handle NaN's
+        np.divide(coicorr_unc, new_data[rows], out=coicorr_rel[rows])
+        np.copyto(coicorr_rel[rows], 0.0, where=coicorr_unc == 0.0)
+
+    return new_data, corrfactor, coicorr_rel, high_flux
+
+
+def _corrfactor(
+    flux: np.ndarray,
+    alpha: float,
+    ft: float,
+    out: np.ndarray,
+    counts: np.ndarray,
+    f: np.ndarray,
+    tmp: np.ndarray,
+    high_flux: np.ndarray | None = None,
+    lut: CoicorrLUT | None = None,
+) -> np.ndarray:
+    """The coincidence loss correction factor for the flux in the 9x9 pixels box,
+    Ctheory*f(x)/Craw, in the buffer out, using the buffers counts, f and tmp
+
+    If high_flux is given, it is set to alpha * x >= 1 and x is replaced by 0.99 / alpha
+    in those pixels (after the polynomial correction factor). If a lookup table is
+    given, the factor is interpolated, and only evaluated outside of the table."""
+
+    # x = ft * Craw
+    np.multiply(ft, flux, out=counts)
+    if lut is not None:
+        outside = lut(counts, out)
+        if high_flux is not None:
+            np.multiply(alpha, counts, out=tmp)
+            np.greater_equal(tmp, 1.0, out=high_flux)
+            outside |= high_flux
+        if outside.any():
+            flux_outside = flux[outside]
+            out[outside] = _corrfactor(
+                flux_outside,
+                alpha,
+                ft,
+                *(np.empty_like(flux_outside) for _ in range(4)),
+                high_flux=None if high_flux is None else outside[outside],
+            )
+        return out
+
+    polynomial(counts, out=f, tmp=tmp)
+    if high_flux is not None:
+        np.multiply(alpha, counts, out=tmp)
+        np.greater_equal(tmp, 1.0, out=high_flux)
+        np.copyto(counts, 0.99 / alpha, where=high_flux)
+    # Ctheory = -log1p(-alpha * x) / (alpha * ft)
+    np.multiply(-alpha, counts, out=tmp)
+    np.log1p(tmp, out=tmp)
+    np.negative(tmp, out=tmp)
+    np.divide(tmp, alpha * ft, out=tmp)
+    # (Ctheory * f) / Craw
+    # todo: handle NaN's
+    np.multiply(tmp, f, out=tmp)
+    return np.divide(tmp, flux, out=out)
+
+
+class CoicorrLUT(NamedTuple):
+    """Lookup table of the coincidence loss correction factor as a function of the
+    number of counts x = Craw*ft in the 9x9 pixels box, on a uniform grid of x"""
+
+    x_min: float
+    x_max: float
+    values: np.ndarray
+    # difference between consecutive values
+    slopes: np.ndarray
+
+    def __call__(self, counts: np.ndarray, out: np.ndarray) -> np.ndarray:
+        """Interpolate the correction factor linearly at counts (x), into out
+
+        Returns the pixels whose (finite) counts are outside of the table, for which
+        out is NaN, as it is for NaN counts and zero counts (Craw = 0)."""
+
+        in_table = (counts >= self.x_min) & (counts <= self.x_max)
+        # position in the table, in float64, also for float32 counts
+        step = (self.x_max - self.x_min) / len(self.slopes)
+        position = np.subtract(counts, self.x_min, dtype=np.float64)
+        np.divide(position, step, out=position)
+        np.copyto(position, 0.0, where=~in_table)
+        index = position.astype(np.intp)
+        np.minimum(index, len(self.slopes) - 1, out=index)
+        np.subtract(position, index, out=position)
+        np.multiply(self.slopes.take(index), position, out=position)
+        np.add(self.values.take(index), position, out=out)
+        np.copyto(out, np.nan, where=~in_table | (counts == 0))
+        return ~in_table & ~np.isnan(counts)
+
+
+@lru_cache(maxsize=None)
+def coicorr_lut(alpha: float) -> CoicorrLUT:
+    """Lookup table of the coincidence loss correction factor for dead time correction
+    factor alpha (DEADC)
+
+    In terms of the number of counts in the 9x9 pixels box, x = Craw*ft, the correction
+    factor Ctheory*f(x)/Craw = -ln(1 - alpha*x) * f(x) / (alpha*x) does not depend on
+    the frame time, so there is a table per DEADC value (cached). The table covers x
+    from -2 (the minimum correction factor of pixels near bright sources) to
+    0.99 / alpha, the maximum correction factor of the high flux pixels."""
+
+    x = np.linspace(-2.0, 0.99 / alpha, COICORR_LUT_POINTS)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        values = -np.log1p(-alpha * x) * polynomial(x) / (alpha * x)
+    # the limit for x -> 0
+    values[x == 0] = 1.0
+    return CoicorrLUT(x[0], x[-1], values, np.diff(values))
+
+
+def polynomial(
+    x: np.ndarray, out: np.ndarray | None = None, tmp: np.ndarray | None = None
+) -> np.ndarray:
     """Function to calculate the empirical polynomial correction to account for the
     differences between the observed and theoretical coincidence loss correction:
 
     `f(x) = 1 + a1x + a2x**2 + a3x**3 + a4x**4`
+
+    If out is given, the result is written to out, with tmp (of the same shape) as the
+    only temporary array.
     """
     a1 = 0.0658568
     a2 = -0.0907142
     a3 = 0.0285951
     a4 = 0.0308063
-    return 1 + (a1 * x) + (a2 * x**2) + (a3 * x**3) + (a4 * x**4)
+    if out is None:
+        return 1 + (a1 * x) + (a2 * x**2) + (a3 * x**3) + (a4 * x**4)
 
+    # the same operations, in place (x**2 is evaluated as np.square(x) by numpy)
+    np.multiply(a1, x, out=out)
+    np.add(1, out, out=out)
+    np.square(x, out=tmp)
+    np.multiply(a2, tmp, out=tmp)
+    np.add(out, tmp, out=out)
+    for a, power in [(a3, 3), (a4, 4)]:
+        np.power(x, power, out=tmp)
+        np.multiply(a, tmp, out=tmp)
+        np.add(out, tmp, out=out)
+    return out
 
-def lsscorr(hdulist: HDUList, fname: str):
-    """Large scale sensitivity correction"""
+
+def lsscorr(hdulist: HDUList, fname: str, dtype: DTypeLike = None):
+    """Large scale sensitivity correction of every frame (see `lsscorr_data`)"""
 
     new_hdu_header = fits.PrimaryHDU(header=hdulist[0].header)
     new_hdulist = fits.HDUList([new_hdu_header])
 
-    lss_hdulist = fits.open(fname.replace("sk_corr_coi.img", "lss_corr.img"))
-
-    for frame, lss_frame in zip(hdulist[1:], lss_hdulist[1:]):
-        data = frame.data
-        header = frame.header
-
-        # Apply the large scale sensitivity correction to the data
-        new_data = data / lss_frame.data
-
-        new_hdu = fits.ImageHDU(new_data, header)
-        new_hdulist.append(new_hdu)
+    # the lss frames are read one at a time
+    with LazyFrames(fname.replace("sk_corr_coi.img", "lss_corr.img")) as lss_frames:
+        for frame, (lss_frame,) in zip(hdulist[1:], lss_frames):
+            # Apply the large scale sensitivity correction to the data
+            new_data = lsscorr_data(frame.data, lss_frame.data, dtype)
+            new_hdulist.append(fits.ImageHDU(new_data, frame.header))
 
     # Write the corrected data to a new image.
     new_fname = fname.replace(".img", "_lss.img")
@@ -272,40 +977,38 @@ def lsscorr(hdulist: HDUList, fname: str):
         + " has been corrected for large scale sensitivity variations."
     )
 
-    lss_hdulist.close()
-
     return new_hdulist, new_fname
 
 
+def lsscorr_data(
+    data: np.ndarray, lss_data: np.ndarray, dtype: DTypeLike = None
+) -> np.ndarray:
+    """Large scale sensitivity correction of a frame"""
+
+    new_data = data / lss_data
+    if dtype is not None:
+        new_data = new_data.astype(dtype, copy=False)
+    return new_data
+
+
 def zeropoint(hdulist: HDUList, out_fname: str, param1: float, param2: float):
-    """Zero point correction (sensitivity loss over time)"""
+    """Zero point correction (sensitivity loss over time) of every frame (see
+    `zeropoint_data`)"""
 
     new_hdu_header = fits.PrimaryHDU(header=hdulist[0].header)
     new_hdulist = fits.HDUList([new_hdu_header])
 
     for frame in hdulist[1:]:
-        data = frame.data
         header = frame.header
 
-        obs_date = datetime.fromisoformat(header["DATE-OBS"]).date()
-        # Calculate the number of years that have elapsed since the 1st of January 2005.
-        first_date = date(2005, 1, 1)
-        elapsed_time = obs_date - first_date
-        # todo: update to correctly account for leap years
-        years_passed = elapsed_time.days / 365.25
-
         # Calculate the zero point correction.
-        zerocorr = 1 + param1 * years_passed + param2 * years_passed**2
-
-        # Apply the correction to the data.
-        new_data = data / zerocorr
+        zerocorr = zeropoint_factor(header["DATE-OBS"], param1, param2)
 
         # Adapt the header.
         header["ZPCORR"] = zerocorr
 
-        # Write the corrected data to a new image
-        new_hdu = fits.ImageHDU(new_data, header)
-        new_hdulist.append(new_hdu)
+        # Apply the correction to the data.
+        new_hdulist.append(fits.ImageHDU(zeropoint_data(frame.data, zerocorr), header))
 
     new_hdulist.writeto(out_fname, overwrite=True)
 
@@ -316,22 +1019,36 @@ def zeropoint(hdulist: HDUList, out_fname: str, param1: float, param2: float):
     return new_hdulist
 
 
-def convert_to_cts(data_hdulist: HDUList, exp_hdul: HDUList, out_fname: str):
-    """Convert corrected normalized data back to counts"""
+def zeropoint_factor(date_obs: str, param1: float, param2: float) -> float:
+    """The zero point correction factor at the observation date (DATE-OBS)"""
 
-    new_hdu_header = fits.PrimaryHDU(header=data_hdulist[0].header)
-    new_hdulist = fits.HDUList([new_hdu_header])
+    obs_date = datetime.fromisoformat(date_obs).date()
+    # Calculate the number of years that have elapsed since the 1st of January 2005.
+    first_date = date(2005, 1, 1)
+    elapsed_time = obs_date - first_date
+    # todo: update to correctly account for leap years
+    years_passed = elapsed_time.days / 365.25
+
+    return 1 + param1 * years_passed + param2 * years_passed**2
 
-    # denorm
-    primary_cts_hdul = norm(data_hdulist, exp_hdul, denorm=True, dry_run=True)
 
-    # set any NaNs to zero
-    for primary_cts_frame in primary_cts_hdul[1:]:
-        primary_cts_data = primary_cts_frame.data
-        primary_cts_data[np.isnan(primary_cts_data)] = 0
+def zeropoint_data(data: np.ndarray, zerocorr: float) -> np.ndarray:
+    """Zero point correction of a frame, with the correction factor at its date"""
 
-        new_hdu = fits.ImageHDU(primary_cts_data, primary_cts_frame.header)
-        new_hdulist.append(new_hdu)
+    return data / zerocorr
+
+
+def convert_to_cts(
+    data_hdulist: HDUList, exp_hdul: HDUList, out_fname: str, dtype: DTypeLike = None
+):
+    """Convert corrected normalized data back to counts (see `cts_data`)"""
+
+    new_hdu_header = fits.PrimaryHDU(header=data_hdulist[0].header)
+    new_hdulist = fits.HDUList([new_hdu_header])
+
+    for frame, exp_frame in zip(data_hdulist[1:], exp_hdul[1:]):
+        new_data = cts_data(frame.data, exp_frame.data, dtype)
+        new_hdulist.append(fits.ImageHDU(new_data, frame.header))
 
     # Write the counts data to a new image
     new_hdulist.writeto(out_fname, overwrite=True)
@@ -341,8 +1058,23 @@ def convert_to_cts(data_hdulist: HDUList, exp_hdul: HDUList, out_fname: str):
     return new_hdulist
 
 
+def cts_data(data: np.ndarray, exp: np.ndarray, dtype: DTypeLike = None) -> np.ndarray:
+    """The counts of a frame in counts/s (denormalized by the exposure map), with the
+    NaNs set to zero for summing"""
+
+    return nan_to_zero(norm_data(data, exp, denorm=True, dtype=dtype))
+
+
+def nan_to_zero(data: np.ndarray) -> np.ndarray:
+    """Set the NaNs in the data to zero (in place), for summing"""
+
+    data[np.isnan(data)] = 0
+    return data
+
+
 def rem_corr_factor(data_hdulist: HDUList, corrfactor_hdul: HDUList, out_fname: str):
-    """Remove the correction factor on count data for uvotimsum to yield original counts"""
+    """Remove the correction factor on count data for uvotimsum to yield original counts
+    (see `orig_counts_data`)"""
 
     # "coincidence loss correction factor" cannot simply be summed
     # What we want is a weighted average of the factors (weighted by counts).
@@ -357,19 +1089,8 @@ def rem_corr_factor(data_hdulist: HDUList, corrfactor_hdul: HDUList, out_fname:
     new_hdulist = fits.HDUList([new_hdu_header])
 
     for primary_frame, corr_factor_frame in zip(data_hdulist[1:], corrfactor_hdul[1:]):
-        isfinite = (
-            np.isfinite(primary_frame.data)
-            & np.isfinite(corr_factor_frame.data)
-            & (corr_factor_frame.data > 0)
-        )
-        orig_counts = np.full_like(primary_frame.data, 0)
-        orig_counts[isfinite] = (
-            primary_frame.data[isfinite] / corr_factor_frame.data[isfinite]
-        )
-        header = primary_frame.header
-
-        new_hdu = fits.ImageHDU(orig_counts, header)
-        new_hdulist.append(new_hdu)
+        orig_counts = orig_counts_data(primary_frame.data, corr_factor_frame.data)
+        new_hdulist.append(fits.ImageHDU(orig_counts, primary_frame.header))
 
     # Write the original counts data to a new image.
     new_hdulist.writeto(out_fname, overwrite=True)
@@ -377,14 +1098,21 @@ def rem_corr_factor(data_hdulist: HDUList, corrfactor_hdul: HDUList, out_fname:
     return new_hdulist
 
 
+def orig_counts_data(primary: np.ndarray, corrfactor: np.ndarray) -> np.ndarray:
+    """The counts of a frame without the coincidence loss correction (0 where the
+    correction factor isn't valid)"""
+
+    isfinite = np.isfinite(primary) & np.isfinite(corrfactor) & (corrfactor > 0)
+    orig_counts = np.full_like(primary, 0)
+    orig_counts[isfinite] = primary[isfinite] / corrfactor[isfinite]
+    return orig_counts
+
+
 def coicorr_uncert_cts(
     data_hdulist: HDUList, corrfactor_unc_hdul: HDUList, out_fname: str
 ):
-    """Convert the coincidence loss correction uncertainty in counts, squared"""
-
-    # "coincidence loss correction uncertainty":
-    # convert the uncertainty from a relative fraction to an uncertainty in counts
-    # multiply the rel_unc frame with the primary frame (in counts).
+    """Convert the coincidence loss correction uncertainty in counts, squared (see
+    `coicorr_uncert_cts_data`)"""
 
     new_hdu_header = fits.PrimaryHDU(header=data_hdulist[0].header)
     new_hdulist = fits.HDUList([new_hdu_header])
@@ -392,15 +1120,12 @@ def coicorr_uncert_cts(
     for primary_frame, corr_factor_rel_unc_frame in zip(
         data_hdulist[1:], corrfactor_unc_hdul[1:]
     ):
-        header = primary_frame.header
-
-        coi_loss_corr_unc_cts_squared = np.square(
-            primary_frame.data * corr_factor_rel_unc_frame.data
+        coi_loss_corr_unc_cts_squared = coicorr_uncert_cts_data(
+            primary_frame.data, corr_factor_rel_unc_frame.data
+        )
+        new_hdulist.append(
+            fits.ImageHDU(coi_loss_corr_unc_cts_squared, primary_frame.header)
         )
-        coi_loss_corr_unc_cts_squared[np.isnan(coi_loss_corr_unc_cts_squared)] = 0
-
-        new_hdu = fits.ImageHDU(coi_loss_corr_unc_cts_squared, header)
-        new_hdulist.append(new_hdu)
 
     # write the squared coincidence loss correction uncertainty to a new image
     new_hdulist.writeto(out_fname, overwrite=True)
@@ -413,8 +1138,21 @@ def coicorr_uncert_cts(
     return new_hdulist
 
 
+def coicorr_uncert_cts_data(
+    primary_cts: np.ndarray, coicorr_rel: np.ndarray
+) -> np.ndarray:
+    """The squared coincidence loss correction uncertainty of a frame in counts (0 where
+    it isn't finite)"""
+
+    # "coincidence loss correction uncertainty":
+    # convert the uncertainty from a relative fraction to an uncertainty in counts
+    # multiply the rel_unc frame with the primary frame (in counts).
+    return nan_to_zero(np.square(primary_cts * coicorr_rel))
+
+
 def zp_corr_cts(data_hdulist: HDUList, out_fname: str):
     """undo the zero point correction for summing / later calculation of weighted factor
+    (see `zp_corr_cts_data`)
 
     data_hdulist (in counts)
         needs to contain the ZPCORR header
@@ -425,10 +1163,8 @@ def zp_corr_cts(data_hdulist: HDUList, out_fname: str):
 
     for primary_frame in data_hdulist[1:]:
         header = primary_frame.header
-        zp_corr_cts_data = primary_frame.data * header["ZPCORR"]
-        zp_corr_cts_data[np.isnan(zp_corr_cts_data)] = 0
-        new_hdu = fits.ImageHDU(zp_corr_cts_data, header)
-        new_hdulist.append(new_hdu)
+        zp_cts = zp_corr_cts_data(primary_frame.data, header["ZPCORR"])
+        new_hdulist.append(fits.ImageHDU(zp_cts, header))
 
     # Write the zero point correction counts to a new image.
     new_hdulist.writeto(out_fname, overwrite=True)
@@ -441,5 +1177,11 @@ def zp_corr_cts(data_hdulist: HDUList, out_fname: str):
     return new_hdulist
 
 
+def zp_corr_cts_data(primary_cts: np.ndarray, zerocorr: float) -> np.ndarray:
+    """The zero point correction of a frame in counts (0 where it isn't finite)"""
+
+    return nan_to_zero(primary_cts * zerocorr)
+
+
 if __name__ == "__main__":
     exit(main())
@@ -11,7 +11,7 @@ from typing import Optional, Sequence
 
 from astropy.io import fits
 
-from dresscode.utils import load_config
+from dresscode.config import add_performance_arguments, read_config
 
 
 def main(argv: Optional[Sequence[str]] = None) -> int:
@@ -19,13 +19,14 @@ def main(argv: Optional[Sequence[str]] = None) -> int:
     parser.add_argument(
         "-c", "--config", help="path to config.txt", default="config.txt"
     )
+    add_performance_arguments(parser)
     args = parser.parse_args(argv)
 
-    config = load_config(args.config)
+    config = read_config(args.config, "header_info", args)
 
     # Specify the galaxy and the path to the raw images.
-    galaxy = config["galaxy"]
-    path = config["path"] + galaxy + "/Raw_images/"
+    galaxy = config.galaxy
+    path = config.path + galaxy + "/Raw_images/"
 
     # Print titles of columns.
     print("filename\t\t\t#frames\tfilter\tdate\n")
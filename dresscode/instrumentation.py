@@ -0,0 +1,208 @@
+"""
+instrumentation.py: Wall time, CPU time, bytes read and written and peak memory of the
+stages of a step, per image, to tell whether the step is I/O-bound or compute-bound.
+
+The peak memory of a stage is the peak resident set size of the process while the stage
+ran, sampled every 10 ms on Linux. Elsewhere, it is the peak of the process so far.
+
+    stats = ImageStats()
+    with stats.stage("read") as stage:
+        data = ...
+        stage.bytes_read += data.nbytes
+    write_stats(stats_fname, {fname: stats.to_dict()})
+"""
+
+from __future__ import annotations
+
+import json
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from datetime import datetime
+from typing import Iterator
+
+# ru_maxrss is in kilobytes on Linux and in bytes on macOS
+_MAXRSS_UNIT = 1 if sys.platform == "darwin" else 1024
+
+
+def peak_rss() -> int:
+    """The peak resident set size (memory) of this process so far, in bytes"""
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * _MAXRSS_UNIT
+
+
+def current_rss() -> int | None:
+    """The resident set size (memory) of this process, in bytes, None if it isn't
+    available (not on Linux)"""
+
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+class PeakMemory:
+    """The peak resident set size of the process while each of the running calls ran
+
+    The size is sampled in a background thread while calls are running, and when a call
+    starts or stops. Every sample is added to all calls that are running, so the calls
+    that run at the same time (in several threads) share their peaks."""
+
+    # time between the samples (s)
+    interval = 0.01
+
+    def __init__(self):
+        self._running: dict[int, StageStats] = {}
+        self._lock = threading.Lock()
+        self._busy = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self, call: StageStats):
+        with self._lock:
+            self._running[id(call)] = call
+            self._sample()
+            self._busy.set()
+            # the thread isn't copied to the processes that are forked from this one
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def stop(self, call: StageStats):
+        with self._lock:
+            self._sample()
+            del self._running[id(call)]
+            if not self._running:
+                self._busy.clear()
+
+    def _run(self):
+        while True:
+            self._busy.wait()
+            with self._lock:
+                self._sample()
+            time.sleep(self.interval)
+
+    def _sample(self):
+        rss = current_rss()
+        if rss is None:
+            rss = peak_rss()
+        for call in self._running.values():
+            call.peak_rss = max(call.peak_rss, rss)
+
+
+# the peak memory of the stages of this process
+_peak_memory = PeakMemory()
+
+
+@dataclass
+class StageStats:
+    """The totals of the calls of a stage"""
+
+    calls: int = 0
+    # wall time (s)
+    wall: float = 0.0
+    # CPU time of the threads that ran the stage (s)
+    cpu: float = 0.0
+    bytes_read: int = 0
+    bytes_written: int = 0
+    # peak memory of the process while the calls ran (bytes)
+    peak_rss: int = 0
+
+    def add(self, other: StageStats):
+        self.calls += other.calls
+        self.wall += other.wall
+        self.cpu += other.cpu
+        self.bytes_read += other.bytes_read
+        self.bytes_written += other.bytes_written
+        self.peak_rss = max(self.peak_rss, other.peak_rss)
+
+
+class ImageStats:
+    """The stats of the stages of an image, the stages can run in several threads"""
+
+    def __init__(self):
+        self.stages: dict[str, StageStats] = {}
+        # wall time of the image (s), the stages can overlap
+        self.wall = 0.0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[StageStats]:
+        """Measure a call of a stage, the bytes read and written can be added to the
+        yielded stats"""
+
+        call = StageStats(calls=1)
+        _peak_memory.start(call)
+        start_wall, start_cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield call
+        finally:
+            call.wall = time.perf_counter() - start_wall
+            call.cpu = time.thread_time() - start_cpu
+            _peak_memory.stop(call)
+            self.add(name, call)
+
+    def add(self, name: str, stats: StageStats):
+        with self._lock:
+            self.stages.setdefault(name, StageStats()).add(stats)
+
+    def to_dict(self) -> dict:
+        return {
+            "wall": self.wall,
+            "stages": {name: asdict(stats) for name, stats in self.stages.items()},
+        }
+
+
+def summarize(images: dict[str, dict]) -> dict[str, dict]:
+    """The totals per stage over all images (see `ImageStats.to_dict`)"""
+
+    totals: dict[str, StageStats] = {}
+    for image in images.values():
+        for name, stats in image["stages"].items():
+            totals.setdefault(name, StageStats()).add(StageStats(**stats))
+    return {name: asdict(stats) for name, stats in totals.items()}
+
+
+def write_stats(fname: str, images: dict[str, dict], **run_info) -> dict:
+    """Write the stats of the images, with their totals per stage and information about
+    the run (e.g. the settings and the wall time), to a JSON file"""
+
+    stats = {
+        "date": datetime.now().isoformat(timespec="seconds"),
+        **run_info,
+        "peak_rss": max(
+            (
+                stage["peak_rss"]
+                for image in images.values()
+                for stage in image["stages"].values()
+            ),
+            default=0,
+        ),
+        "stages": summarize(images),
+        "images": images,
+    }
+    with open(fname, "w") as f:
+        json.dump(stats, f, indent=2)
+    return stats
+
+
+def print_stats(stats: dict):
+    """Print the totals per stage of the stats written by `write_stats`"""
+
+    print(
+        f"{'stage':>20} {'wall (s)':>9} {'cpu (s)':>9} {'read (MB)':>10} {'written (MB)':>13}"
+        f" {'peak (MB)':>10}"
+    )
+    for name, stage in stats["stages"].items():
+        print(
+            f"{name:>20} {stage['wall']:9.2f} {stage['cpu']:9.2f} "
+            f"{stage['bytes_read'] / 1e6:10.1f} {stage['bytes_written'] / 1e6:13.1f} "
+            f"{stage['peak_rss'] / 1e6:10.0f}"
+        )
+    print(f"Peak memory: {stats['peak_rss'] / 1e6:.0f} MB")
@@ -1,11 +1,19 @@
 from __future__ import annotations
 
+import errno
 import os
+import queue
+import shutil
+import tempfile
+import threading
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Callable, Hashable, Iterable, Iterator, NamedTuple, Sequence
 
 import numpy as np
-from astropy.convolution import convolve
 from astropy.io import fits
 from astropy.io.fits.hdu.hdulist import HDUList
+from astropy.io.fits.hdu.image import ImageHDU
+from numpy.typing import DTypeLike
 
 
 def listdir_nohidden(path):
@@ -15,21 +23,6 @@ def listdir_nohidden(path):
             yield f
 
 
-def load_config(config_file):
-    """Function to open and read the configuration file"""
-    config = {}
-    with open(config_file) as configfile:
-        for line in (
-            line.strip()
-            for line in configfile
-            if line.strip() and not line.startswith("#")
-        ):
-            splitline = line.split("=")
-            key, value = splitline[0].strip(), splitline[1].strip()
-            config[key] = value
-    return config
-
-
 def check_filter(filename: str) -> str:
     """Check the filter of the image and return a filter label"""
     if "_um2_" in filename:
@@ -41,79 +34,630 @@ def check_filter(filename: str) -> str:
     raise ValueError(f"Unknown filter for {filename}")
 
 
-def windowed_sum(arr: np.ndarray, radius: int) -> np.ndarray:
+def _running_sum_x(arr: np.ndarray, radius: int) -> np.ndarray:
+    """Sum over a window of `radius` pixels on either side along the last axis (x)
+
+    Pixels beyond the edges of the array are treated as 0. This is the x pass of a
+    summed-area table: a cumulative sum followed by the difference of the cumulative sum
+    at both ends of the window, so the cost does not depend on the radius.
+    """
+
+    n = arr.shape[-1]
+    width = 2 * radius + 1
+    # cumsum[..., k] is the sum of the zero-padded row up to (not including) index k
+    cumsum = np.zeros(arr.shape[:-1] + (n + width,), dtype=np.float64)
+    np.cumsum(arr, axis=-1, out=cumsum[..., radius + 1 : radius + 1 + n])
+    cumsum[..., radius + 1 + n :] = cumsum[..., radius + n, np.newaxis]
+    return cumsum[..., width : width + n] - cumsum[..., :n]
+
+
+def row_tiles(n_rows: int, tile_rows: int | None = None) -> Iterator[slice]:
+    """Split n_rows rows into tiles of at most tile_rows rows (one tile if None)"""
+
+    tile_rows = n_rows if tile_rows is None else max(int(tile_rows), 1)
+    for start in range(0, n_rows, tile_rows):
+        yield slice(start, min(start + tile_rows, n_rows))
+
+
+def _moment_planes(arr: np.ndarray, orders: Sequence[int]) -> np.ndarray:
+    """Stack the finite values (order 0), zero-filled values (order 1) and their squares
+    (order 2) of an array into float64 planes"""
+
+    finite_vals = np.isfinite(arr)
+    planes = np.zeros((len(orders),) + arr.shape, dtype=np.float64)
+    for plane, order in zip(planes, orders):
+        if order == 0:
+            plane[...] = finite_vals
+        else:
+            np.copyto(plane, arr, where=finite_vals)
+            if order == 2:
+                np.multiply(plane, plane, out=plane)
+    return planes
+
+
+def _windowed_plane_tiles(
+    arr: np.ndarray, radius: int, orders: Sequence[int], tile_rows: int | None = None
+) -> Iterator[tuple[slice, np.ndarray]]:
+    """Box sums of the moment planes (see `_moment_planes`) of an array, with pixels
+    beyond the edges treated as 0, one tile of tile_rows rows at a time
+
+    Implementation: summed-area table, separated in an x and a y pass. The y pass is
+    accumulated one row at a time (which numpy vectorizes much better than a cumulative
+    sum along a non-contiguous axis), so the rows can be processed in tiles of tile_rows
+    rows: the cumulative sum carries over from one tile to the next as a halo of
+    2*radius+1 rows. The additions are the same and in the same order as for a single
+    tile, so the result is bit-identical to the full-frame result, while the arrays only
+    hold a tile (plus halo).
+    """
+
+    n_rows = arr.shape[-2]
+    width = 2 * radius + 1
+    planes_shape = (len(orders),) + arr.shape[:-2]
+
+    # cumsum[..., k - first, :] is the sum of the x pass of the zero-padded array up to
+    # (not including) row k, for first <= k < last. The first radius + 1 rows are the
+    # zero padding.
+    first, last = 0, radius + 1
+    cumsum = np.zeros(planes_shape + (last, arr.shape[-1]), dtype=np.float64)
+    for rows in row_tiles(n_rows, tile_rows):
+        # extend the cumulative sum to the bottom of the window of the last row
+        stop = rows.stop + width
+        new_cumsum = np.empty(planes_shape + (stop - first, arr.shape[-1]))
+        new_cumsum[..., : last - first, :] = cumsum
+        in_rows = slice(last - radius - 1, min(stop - radius - 1, n_rows))
+        x_sum = _running_sum_x(_moment_planes(arr[..., in_rows, :], orders), radius)
+        for k in range(last, stop):
+            if k - radius - 1 < n_rows:
+                np.add(
+                    new_cumsum[..., k - 1 - first, :],
+                    x_sum[..., k - last, :],
+                    out=new_cumsum[..., k - first, :],
+                )
+            else:
+                new_cumsum[..., k - first, :] = new_cumsum[..., k - 1 - first, :]
+
+        yield rows, (
+            new_cumsum[..., rows.start + width - first : stop - first, :]
+            - new_cumsum[..., rows.start - first : rows.stop - first, :]
+        )
+        # only keep the halo of the cumulative sum needed for the next tile
+        cumsum = new_cumsum[..., rows.stop - first :, :].copy()
+        first, last = rows.stop, stop
+
+
+def _windowed_planes(
+    arr: np.ndarray, radius: int, orders: Sequence[int], tile_rows: int | None = None
+) -> np.ndarray:
+    """Box sums of the moment planes of an array (see `_windowed_plane_tiles`)"""
+
+    output = np.empty((len(orders),) + arr.shape, dtype=np.float64)
+    for rows, planes in _windowed_plane_tiles(arr, radius, orders, tile_rows):
+        output[..., rows, :] = planes
+    return output
+
+
+def windowed_sum(
+    arr: np.ndarray, radius: int, tile_rows: int | None = None
+) -> np.ndarray:
     """Sum around a radius of each element in an array
     radius is number of pixels in x/y around each pixel to include
     e.g. radius=1 means the pixel itself and the 8 surrounding pixels
 
-    Implementation: convolution
+    NaN's are treated as 0 in the sum and are preserved in the output, pixels beyond the
+    edges of the array are treated as 0.
+
+    arr can be a single frame (ny, nx) or a stack of frames (n_frames, ny, nx). With
+    tile_rows set, the rows are processed in
+    tiles to bound the memory of the temporary arrays, with a bit-identical result.
+
+    Implementation: summed-area table
     """
 
-    kernel = np.ones((radius * 2 + 1, radius * 2 + 1), dtype=int)
-    return convolve(
-        arr,
-        kernel,
-        boundary="fill",
-        fill_value=0.0,
-        nan_treatment="fill",
-        normalize_kernel=False,
-        preserve_nan=True,
-    )
+    output = _windowed_planes(arr, radius, (1,), tile_rows)[0]
+    output[~np.isfinite(arr)] = np.nan
+    return output
+
+
+class WindowedMoments(NamedTuple):
+    """Number of finite values, sum and sum of squares in a window around each pixel"""
+
+    count: np.ndarray
+    total: np.ndarray
+    total_sq: np.ndarray
+
+    def var(
+        self, count: np.ndarray | None = None, tile_rows: int | None = None
+    ) -> np.ndarray:
+        """Variance in the window around each pixel, optionally normalized by another
+        count of (finite) values"""
+
+        if count is None:
+            count = self.count
+        output = np.empty_like(self.total)
+        for rows in row_tiles(output.shape[-2], tile_rows):
+            rows = (Ellipsis, rows, slice(None))
+            output[rows] = (
+                self.total_sq[rows] - self.total[rows] * self.total[rows] / count[rows]
+            ) / count[rows]
+        # round-off in the summed-area tables can make a zero variance slightly negative
+        output[output < 0] = 0.0
+        return output
+
+    def std(
+        self, count: np.ndarray | None = None, tile_rows: int | None = None
+    ) -> np.ndarray:
+        """Standard deviation in the window around each pixel"""
+
+        return np.sqrt(self.var(count, tile_rows))
+
+
+def windowed_moments(
+    arr: np.ndarray, radius: int, tile_rows: int | None = None
+) -> WindowedMoments:
+    """Number of finite values, sum and sum of squares around a radius of each element
+    in an array, computed in a single pass over the three stacked planes
+
+    The sums follow the same conventions as `windowed_sum`: NaN's are treated as 0 and
+    are preserved in the output, pixels beyond the edges are treated as 0. arr can be a
+    single frame (ny, nx) or a stack of frames (n_frames, ny, nx).
+    """
+
+    count, total, total_sq = _windowed_planes(arr, radius, (0, 1, 2), tile_rows)
+    nan_vals = ~np.isfinite(arr)
+    total[nan_vals] = np.nan
+    total_sq[nan_vals] = np.nan
+    return WindowedMoments(count, total, total_sq)
+
+
+def windowed_moment_tiles(
+    arr: np.ndarray, radius: int, tile_rows: int | None = None
+) -> Iterator[tuple[slice, WindowedMoments]]:
+    """The windowed moments of an array (see `windowed_moments`), one tile of tile_rows
+    rows at a time, so only a tile of the moments is held in memory"""
+
+    for rows, (count, total, total_sq) in _windowed_plane_tiles(
+        arr, radius, (0, 1, 2), tile_rows
+    ):
+        nan_vals = ~np.isfinite(arr[..., rows, :])
+        total[nan_vals] = np.nan
+        total_sq[nan_vals] = np.nan
+        yield rows, WindowedMoments(count, total, total_sq)
 
 
 def windowed_var(
-    arr: np.ndarray, radius: int, win_finite_vals: np.ndarray | None = None
+    arr: np.ndarray,
+    radius: int,
+    win_finite_vals: np.ndarray | None = None,
+    tile_rows: int | None = None,
 ) -> np.ndarray:
     """Calculate the variance of a window around each pixel in an array
     Adapted from the this SO: https://stackoverflow.com/a/18423835/532963
-    We use our windowed_sum convolution calc. which can handle nan's
+    We use our windowed_moments summed-area table calc. which can handle nan's
 
     This is the same algorithm as https://stackoverflow.com/a/18422519/532963
     to computer the variance using just the sum of squares and sum of values in a window
     however we need to add a normalization because we aren't using uniform_filter
-
-    Note: this returns smaller in size than the input array (by radius)
     """
 
-    if win_finite_vals is None:
-        win_finite_vals = windowed_finite_vals(arr, radius)
-    win_sum = windowed_sum(arr, radius)
-    win_sum_2 = windowed_sum(arr * arr, radius)
-    output = (win_sum_2 - win_sum * win_sum / win_finite_vals) / win_finite_vals
-    return output
+    return windowed_moments(arr, radius, tile_rows).var(win_finite_vals, tile_rows)
 
 
 def windowed_std(
-    arr: np.ndarray, radius: int, win_finite_vals: np.ndarray | None = None
+    arr: np.ndarray,
+    radius: int,
+    win_finite_vals: np.ndarray | None = None,
+    tile_rows: int | None = None,
 ) -> np.ndarray:
-    """Standard deviation around a radius of each elemnt in an array"""
+    """Standard deviation around a radius of each elemnt in an array
 
-    var_arr = windowed_var(arr, radius, win_finite_vals)
+    arr can be a single frame (ny, nx) or a stack of frames (n_frames, ny, nx)
+    """
+
+    var_arr = windowed_var(arr, radius, win_finite_vals, tile_rows)
     std_arr = np.sqrt(var_arr)
 
     return std_arr
 
 
-def windowed_finite_vals(arr: np.ndarray, radius: int) -> np.ndarray:
-    """Number of finite values around a radius of each element in an array"""
+def windowed_finite_vals(
+    arr: np.ndarray, radius: int, tile_rows: int | None = None
+) -> np.ndarray:
+    """Number of finite values around a radius of each element in an array
+
+    The count is exact: the summed-area table of a 0/1 array only holds integers
+    """
 
-    finite_arr = np.isfinite(arr).astype(int)
-    output = windowed_sum(finite_arr, radius)
+    output = _windowed_planes(arr, radius, (0,), tile_rows)[0]
 
     return output
 
 
+class LazyFrames:
+    """Lazy, memory-mapped access to the image extensions (frames) of FITS files
+
+    Iterating yields a tuple with the frame of each file, extension by extension. The
+    data of a frame is read through a memory map when it is first accessed, and the
+    frames are released when the next tuple is requested, so only one frame per file is
+    held in memory at a time. Arrays that are kept (e.g. in a new HDUList) stay valid.
+
+    with LazyFrames(mask_fname, exp_fname) as frames:
+        for mk_frame, ex_frame in frames:
+            ...
+    """
+
+    def __init__(self, *fnames: str):
+        self.hduls = [fits.open(fname, memmap=True) for fname in fnames]
+
+    @property
+    def primary_headers(self) -> list[fits.Header]:
+        """The primary headers (extension 0) of the files"""
+        return [hdul[0].header for hdul in self.hduls]
+
+    def __len__(self) -> int:
+        return len(self.hduls[0]) - 1
+
+    def __iter__(self) -> Iterator[tuple[ImageHDU, ...]]:
+        for i in range(1, len(self) + 1):
+            frames = tuple(hdul[i] for hdul in self.hduls)
+            yield frames
+            for frame in frames:
+                # drop the reference to the (memory mapped) data
+                if "data" in frame.__dict__:
+                    del frame.data
+
+    def close(self):
+        for hdul in self.hduls:
+            hdul.close()
+
+    def __enter__(self) -> LazyFrames:
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def temp_fname(fname: str, scratch_dir: str | None = None) -> str:
+    """The temporary file in which fname is written, a hidden file next to it (so it can
+    be renamed to fname at once, see `listdir_nohidden`), or a new file in scratch_dir"""
+
+    dirname, basename = os.path.split(fname)
+    if scratch_dir is None:
+        return os.path.join(dirname, f".{basename}.tmp")
+    # the images of several working directories can have the same name
+    fd, tmp_fname = tempfile.mkstemp(
+        suffix=".tmp", prefix=f".{basename}.", dir=scratch_dir
+    )
+    os.close(fd)
+    return tmp_fname
+
+
+def replace_file(tmp_fname: str, fname: str):
+    """Rename a temporary file to fname at once, a temporary file on another file system
+    (e.g. in a scratch directory on a local disk) is first copied next to fname"""
+
+    try:
+        os.replace(tmp_fname, fname)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    local_fname = temp_fname(fname)
+    try:
+        shutil.copyfile(tmp_fname, local_fname)
+        os.replace(local_fname, fname)
+    finally:
+        if os.path.exists(local_fname):
+            os.remove(local_fname)
+    os.remove(tmp_fname)
+
+
+def atomic_writeto(
+    hdulist: HDUList | fits.PrimaryHDU, fname: str, scratch_dir: str | None = None
+):
+    """Write an HDUList (or HDU) to fname, through a temporary file (in scratch_dir, if
+    given) that is renamed to fname when it is complete, so fname is never left
+    half-written"""
+
+    tmp_fname = temp_fname(fname, scratch_dir)
+    try:
+        hdulist.writeto(tmp_fname, overwrite=True)
+        replace_file(tmp_fname, fname)
+    finally:
+        if os.path.exists(tmp_fname):
+            os.remove(tmp_fname)
+
+
+class AsyncWriter:
+    """Write FITS files atomically in a small pool of background threads, the errors are
+    raised by `wait`"""
+
+    def __init__(
+        self, threads: int = 2, depth: int = 16, scratch_dir: str | None = None
+    ):
+        self.scratch_dir = scratch_dir
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.pending = threading.BoundedSemaphore(depth)
+        self.futures: list[Future] = []
+        # the last write of each key
+        self.last: dict[str, Future] = {}
+
+    def submit(self, func: Callable, *args, key: str | None = None, **kwargs):
+        """Call func(*args, **kwargs) in the background, after the previous call with the
+        same key"""
+
+        previous = self.last.get(key) if key is not None else None
+
+        def write():
+            if previous is not None:
+                # raises the error of the previous write, e.g. a frame isn't appended to
+                # a file that couldn't be created
+                previous.result()
+            func(*args, **kwargs)
+
+        self.pending.acquire()
+        future = self.executor.submit(write)
+        future.add_done_callback(lambda _: self.pending.release())
+        self.futures.append(future)
+        if key is not None:
+            self.last[key] = future
+
+    def writeto(self, hdulist: HDUList | fits.PrimaryHDU, fname: str):
+        """Write an HDUList (or HDU) to fname in the background"""
+
+        self.submit(atomic_writeto, hdulist, fname, self.scratch_dir, key=fname)
+
+    def wait(self):
+        """Wait until all files have been written, raise the first error"""
+
+        futures, self.futures, self.last = self.futures, [], {}
+        errors = [future.exception() for future in futures]
+        for error in errors:
+            if error is not None:
+                raise error
+
+    def close(self):
+        try:
+            self.wait()
+        finally:
+            self.executor.shutdown()
+
+    def __enter__(self) -> AsyncWriter:
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+        else:
+            # don't hide the error of the with block
+            self.executor.shutdown()
+
+
+def writeto(
+    hdulist: HDUList | fits.PrimaryHDU,
+    fname: str,
+    writer: AsyncWriter | None = None,
+    scratch_dir: str | None = None,
+):
+    """Write an HDUList (or HDU) to fname atomically, in the background with a writer"""
+
+    if writer is None:
+        atomic_writeto(hdulist, fname, scratch_dir)
+    else:
+        writer.writeto(hdulist, fname)
+
+
+class FrameWriter:
+    """Write a FITS file frame by frame
+
+    The primary header (extension 0) is written when the writer is created, and every
+    frame is appended to the end of the file as it is written, so the frames that have
+    been written don't need to be kept in memory. The file is the same as writing an
+    HDUList with the same frames. The frames are written to a temporary file, which is
+    renamed to fname when the writer is closed. With an AsyncWriter, the file is written
+    in the background.
+
+    writer = FrameWriter(output_fname, primary_header)
+    for data, header in frames:
+        writer.append(data, header)
+    writer.close()
+    """
+
+    def __init__(
+        self,
+        fname: str,
+        primary_header: fits.Header,
+        writer: AsyncWriter | None = None,
+        scratch_dir: str | None = None,
+    ):
+        if writer is not None:
+            scratch_dir = writer.scratch_dir
+        self.fname = fname
+        self.tmp_fname = temp_fname(fname, scratch_dir)
+        self.writer = writer
+        primary_hdu = fits.PrimaryHDU(header=primary_header)
+        # the primary header announces the extensions, as in HDUList.writeto
+        n_axes = primary_hdu.header["NAXIS"]
+        primary_hdu.header.set(
+            "EXTEND", True, after=f"NAXIS{n_axes}" if n_axes else "NAXIS"
+        )
+        self._write(primary_hdu.writeto, self.tmp_fname, overwrite=True)
+
+    def append(self, data: np.ndarray, header: fits.Header):
+        # the file isn't parsed again, the frame is written at its end
+        self._write(fits.append, self.tmp_fname, data, header, verify=False)
+
+    def close(self):
+        self._write(replace_file, self.tmp_fname, self.fname)
+
+    def _write(self, func: Callable, *args, **kwargs):
+        if self.writer is None:
+            func(*args, **kwargs)
+        else:
+            self.writer.submit(func, *args, key=self.fname, **kwargs)
+
+
+class Job(NamedTuple):
+    """A job for `run_jobs`: func(*args), after the jobs with the keys in after"""
+
+    func: Callable
+    args: tuple = ()
+    after: tuple = ()
+
+
+def run_jobs(jobs: dict[Hashable, Job], workers: int = 1) -> dict[Hashable, object]:
+    """Run the jobs in a pool of threads, each as soon as the jobs it depends on have
+    finished, returning the results of the jobs by key
+
+    With workers=1 the jobs run one by one, in the order of the dict among the jobs that
+    can run. An error of a job is raised when the running jobs have finished, the jobs
+    that haven't started yet aren't run.
+    """
+
+    unknown = {key for job in jobs.values() for key in job.after} - set(jobs)
+    if unknown:
+        raise ValueError(f"Unknown jobs {', '.join(map(str, unknown))}")
+
+    results: dict[Hashable, object] = {}
+    waiting = dict(jobs)
+    running: dict[Future, Hashable] = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while waiting or running:
+            for key, job in list(waiting.items()):
+                if all(dependency in results for dependency in job.after):
+                    running[executor.submit(job.func, *job.args)] = key
+                    del waiting[key]
+            if not running:
+                raise ValueError(
+                    f"Circular dependencies between the jobs {', '.join(map(str, waiting))}"
+                )
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future)] = future.result()
+    return results
+
+
+# marks the end of the items in the queue of `prefetch`
+_END = object()
+
+
+def prefetch(iterable: Iterable, depth: int) -> Iterator:
+    """Iterate over an iterable in a background thread, reading up to `depth` items ahead
+
+    The items are produced in the background thread (e.g. the frames are read from disk)
+    while the caller processes the previous items, and are passed on through a queue of
+    at most `depth` items, so at most depth + 1 items are held in memory. An exception
+    in the background thread is raised in the caller. The background thread is stopped
+    (and the iterable is closed) when the returned generator is closed.
+    """
+
+    if depth < 1:
+        raise ValueError(f"Can't prefetch {depth} items")
+    items: queue.Queue = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        # wait for room in the queue, unless the caller has stopped iterating
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read():
+        iterator = iter(iterable)
+        try:
+            for item in iterator:
+                if not put((item, None)):
+                    return
+            put((_END, None))
+        except BaseException as e:
+            put((_END, e))
+        finally:
+            # close the iterable (e.g. its files) in the thread that iterated over it
+            if hasattr(iterator, "close"):
+                iterator.close()
+
+    thread = threading.Thread(target=read, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is _END:
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def finite_bbox(arr: np.ndarray, margin: int = 0) -> tuple[slice, slice]:
+    """The bounding box of the finite pixels of a frame, extended by margin pixels on
+    every side (within the frame), as a pair of slices. The whole frame if there are no
+    finite pixels."""
+
+    finite_vals = np.isfinite(arr)
+    rows = np.flatnonzero(finite_vals.any(axis=1))
+    cols = np.flatnonzero(finite_vals.any(axis=0))
+    if rows.size == 0:
+        return slice(None), slice(None)
+    return (
+        slice(max(rows[0] - margin, 0), min(rows[-1] + margin + 1, arr.shape[0])),
+        slice(max(cols[0] - margin, 0), min(cols[-1] + margin + 1, arr.shape[1])),
+    )
+
+
+def paste(
+    data: np.ndarray,
+    shape: tuple[int, ...],
+    region: tuple[slice, slice],
+    fill_value: float = np.nan,
+) -> np.ndarray:
+    """Paste the data of a region (see `finite_bbox`) into a frame of the given shape
+    filled with fill_value"""
+
+    if data.shape == tuple(shape):
+        return data
+    frame = np.full(shape, fill_value, dtype=data.dtype)
+    frame[region] = data
+    return frame
+
+
+def apply_mask_data(
+    data: np.ndarray,
+    mask: np.ndarray,
+    dtype: DTypeLike = None,
+    out: np.ndarray | None = None,
+) -> np.ndarray:
+    """Set the data to NaN where the mask is 0, for a single frame or a stack of frames
+
+    The output has the data type of the data, unless dtype is given. The output is
+    written to `out` if given, which can be `data` itself to mask in place."""
+
+    if out is None:
+        out = np.empty_like(data, dtype=dtype)
+    data_vals = mask.astype(bool, copy=False)
+    np.copyto(out, data, where=data_vals)
+    np.copyto(out, np.nan, where=~data_vals)
+    return out
+
+
 def apply_mask(
-    hdulist: HDUList, mask: HDUList, output_fname: str, dry_run: bool = False
+    hdulist: HDUList,
+    mask: HDUList,
+    output_fname: str,
+    dry_run: bool = False,
+    dtype: DTypeLike = None,
 ) -> HDUList:
-    """apply the mask to the image frames"""
+    """apply the mask to the image frames (see `apply_mask_data`)"""
     new_hdu_header = fits.PrimaryHDU(header=hdulist[0].header)
     new_hdulist = fits.HDUList([new_hdu_header])
 
     for frame, mask_frame in zip(hdulist[1:], mask[1:]):
-        new_frame = np.full_like(frame.data, np.nan)
-        data_vals = mask_frame.data.astype(bool)
-        new_frame[data_vals] = frame.data[data_vals]
+        new_frame = apply_mask_data(frame.data, mask_frame.data, dtype)
         new_hdu = fits.ImageHDU(new_frame, frame.header)
         new_hdulist.append(new_hdu)
 
@@ -124,6 +668,22 @@ def apply_mask(
     return new_hdulist
 
 
+def update_mask_data(
+    mask: np.ndarray, exp: np.ndarray, out: np.ndarray | None = None
+) -> np.ndarray:
+    """Set the mask to 0 where the exposure map is NaN or the exposure time is very small
+
+    The output is written to `out` if given, which can be `mask` itself to update the
+    mask in place."""
+
+    if out is None:
+        out = mask.copy()
+    elif out is not mask:
+        np.copyto(out, mask)
+    np.copyto(out, 0, where=np.isnan(exp) | (exp <= 1))
+    return out
+
+
 def update_mask(
     mask_fname: str, exp_fname: str, output_fname: str, dry_run: bool = False
 ) -> HDUList:
@@ -131,29 +691,48 @@ def update_mask(
     that have very low exposure times."""
 
     # Open the mask file and the exposure map and copy the primary header (extension 0
-    # of hdulist) to a new hdulist
-    hdulist_mk = fits.open(mask_fname)
-    hdulist_ex = fits.open(exp_fname)
-    new_hdu_header = fits.PrimaryHDU(header=hdulist_mk[0].header)
-    new_hdulist = fits.HDUList([new_hdu_header])
+    # of hdulist) to a new hdulist, the frames are read one at a time
+    with LazyFrames(mask_fname, exp_fname) as frames:
+        new_hdu_header = fits.PrimaryHDU(header=frames.primary_headers[0])
+        new_hdulist = fits.HDUList([new_hdu_header])
+
+        for mk_frame, ex_frame in frames:
+            # set mask pixels to 0 that are NaN in the exposure map or whose exposure time is very small
+            new_mask = update_mask_data(mk_frame.data, ex_frame.data, out=mk_frame.data)
+            new_hdu = fits.ImageHDU(new_mask, mk_frame.header)
+            new_hdulist.append(new_hdu)
+
+        # Write the new hdulist to new mask file
+        if not dry_run:
+            new_hdulist.writeto(output_fname, overwrite=True)
+            print(f"Updated exposure map in {os.path.basename(output_fname)}")
 
-    for mk_frame, ex_frame in zip(hdulist_mk[1:], hdulist_ex[1:]):
-        # set mask pixels to 0 that are NaN in the exposure map or whose exposure time is very small
-        new_mask = mk_frame.data
-        excl_vals = np.isnan(ex_frame.data) | (ex_frame.data <= 1)
-        new_mask[excl_vals] = 0
-        new_hdu = fits.ImageHDU(new_mask, mk_frame.header)
-        new_hdulist.append(new_hdu)
+    return new_hdulist
 
-    # Write the new hdulist to new mask file
-    if not dry_run:
-        new_hdulist.writeto(output_fname, overwrite=True)
-        print(f"Updated exposure map in {os.path.basename(output_fname)}")
 
-    hdulist_mk.close()
-    hdulist_ex.close()
+def norm_data(
+    data: np.ndarray,
+    exp: np.ndarray,
+    denorm: bool = False,
+    dtype: DTypeLike = None,
+    out: np.ndarray | None = None,
+) -> np.ndarray:
+    """normalize (or denormalize) the data by the exposure map, for a single frame or a
+    stack of frames
+
+    pixels that aren't finite or have no exposure are set to NaN. The output has the data
+    type of the data, unless dtype is given. The output is written to `out` if given,
+    which can be `data` itself to normalize in place."""
 
-    return new_hdulist
+    if out is None:
+        out = np.empty_like(data, dtype=dtype)
+    finite_vals = np.isfinite(data) & np.isfinite(exp) & (exp > 0)
+    if denorm:
+        np.multiply(data, exp, out=out, where=finite_vals)
+    else:
+        np.divide(data, exp, out=out, where=finite_vals)
+    np.copyto(out, np.nan, where=~finite_vals)
+    return out
 
 
 def norm(
@@ -162,27 +741,14 @@ def norm(
     output_fname: str = "",
     denorm: bool = False,
     dry_run: bool = False,
+    dtype: DTypeLike = None,
 ) -> HDUList:
-    """normalize the data by the exposure map"""
+    """normalize the data by the exposure map (see `norm_data`)"""
     new_hdu_header = fits.PrimaryHDU(header=data_hdul[0].header)
     new_hdulist = fits.HDUList([new_hdu_header])
 
     for data_frame, exp_frame in zip(data_hdul[1:], exp_hdul[1:]):
-        new_frame = np.full_like(data_frame.data, np.nan)
-        finite_vals = (
-            np.isfinite(data_frame.data)
-            & np.isfinite(exp_frame.data)
-            & (exp_frame.data > 0)
-        )
-        if denorm:
-            new_frame[finite_vals] = (
-                data_frame.data[finite_vals] * exp_frame.data[finite_vals]
-            )
-        else:
-            new_frame[finite_vals] = (
-                data_frame.data[finite_vals] / exp_frame.data[finite_vals]
-            )
-
+        new_frame = norm_data(data_frame.data, exp_frame.data, denorm, dtype)
         new_hdu = fits.ImageHDU(new_frame, data_frame.header)
         new_hdulist.append(new_hdu)
 
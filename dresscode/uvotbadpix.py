@@ -9,7 +9,7 @@ import subprocess
 from argparse import ArgumentParser
 from typing import Optional, Sequence
 
-from dresscode.utils import load_config
+from dresscode.config import add_performance_arguments, read_config
 
 
 def main(argv: Optional[Sequence[str]] = None) -> int:
@@ -17,12 +17,13 @@ def main(argv: Optional[Sequence[str]] = None) -> int:
     parser.add_argument(
         "-c", "--config", help="path to config.txt", default="config.txt"
     )
+    add_performance_arguments(parser)
     args = parser.parse_args(argv)
 
-    config = load_config(args.config)
+    config = read_config(args.config, "uvotbadpix", args)
     # Specify the galaxy and the path to the working directory.
-    galaxy = config["galaxy"]
-    path = config["path"] + galaxy + "/working_dir/"
+    galaxy = config.galaxy
+    path = config.path + galaxy + "/working_dir/"
 
     print("Creating quality maps...")
 
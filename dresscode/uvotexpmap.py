@@ -12,7 +12,7 @@ from typing import Optional, Sequence
 import numpy as np
 from astropy.io import fits
 
-from dresscode.utils import load_config
+from dresscode.config import add_performance_arguments, read_config
 
 try:
     import importlib.resources as pkg_resources
@@ -26,12 +26,13 @@ def main(argv: Optional[Sequence[str]] = None) -> int:
     parser.add_argument(
         "-c", "--config", help="path to config.txt", default="config.txt"
     )
+    add_performance_arguments(parser)
     args = parser.parse_args(argv)
 
-    config = load_config(args.config)
+    config = read_config(args.config, "uvotexpmap", args)
     # Specify the galaxy and the path to the working directory.
-    galaxy = config["galaxy"]
-    path = config["path"] + galaxy + "/working_dir/"
+    galaxy = config.galaxy
+    path = config.path + galaxy + "/working_dir/"
 
     print("Creating exposure maps...")
 
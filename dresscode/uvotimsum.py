@@ -14,15 +14,30 @@ from __future__ import annotations
 import os
 import shutil
 import subprocess
+import tempfile
 from argparse import ArgumentParser
 from dataclasses import dataclass
+from functools import partial
 from pathlib import Path
-from typing import Optional, Sequence
+from typing import BinaryIO, Optional, Sequence
 
 import numpy as np
 from astropy.io import fits
-
-from dresscode.utils import check_filter, load_config, norm
+from numpy.typing import DTypeLike
+
+from dresscode.accumulator import update_store, write_sums
+from dresscode.coadd import PIXSIZE, coadd_frames
+from dresscode.config import add_performance_arguments, read_config
+from dresscode.utils import (
+    AsyncWriter,
+    Job,
+    check_filter,
+    norm_data,
+    replace_file,
+    run_jobs,
+    temp_fname,
+    writeto,
+)
 
 
 @dataclass(frozen=True)
@@ -80,139 +95,89 @@ def main(argv: Optional[Sequence[str]] = None) -> int:
     parser.add_argument(
         "-c", "--config", help="path to config.txt", default="config.txt"
     )
+    add_performance_arguments(parser)
     args = parser.parse_args(argv)
 
-    config = load_config(args.config)
+    config = read_config(args.config, "uvotimsum", args)
     # Specify the galaxy and the path to the working directory.
-    galaxy = config["galaxy"]
-    path = config["path"] + galaxy + "/working_dir/"
+    galaxy = config.galaxy
+    path = config.path + galaxy + "/working_dir/"
+    # optionally compute and write the summed images in a fixed precision (float32)
+    dtype = config.performance.dtype
+    # the temporary files are written to the scratch directory, if given
+    scratch_dir = config.performance.scratch_dir
+    # co-add the frames with HEASoft uvotimsum, or in Python
+    if config.performance.coadd == "native":
+        coadd = partial(coadd_frames, dtype=dtype, scratch_dir=scratch_dir)
+    else:
+        coadd = coaddframes
 
     # clear out the all / sum images
     for img_type in ["all", "sum"]:
         fname_pattern = f"{img_type}_*.img"
         [Path.unlink(f, missing_ok=True) for f in Path(path).glob(fname_pattern)]
 
-    # for diff. image types, append frames to one "all" image.
-    for filetype in FILE_TYPES_TO_SUM:
-        print(f"Appending all {filetype.name} files...")
-        files_to_append = [
-            filename
-            for filename in sorted(os.listdir(path))
-            if filename.endswith(filetype.in_file_pattern)
-            and not filename.startswith(".")
-        ]
-        for i, fname in enumerate(files_to_append):
-            filterlabel = check_filter(fname)
-            all_fname = f"{path}/all_{filterlabel}_{filetype.out_file_type}.img"
-            append_frames(path + fname, all_fname)
-            print(
-                f"Finished appending frames for {filetype.name} {i+1}/{len(files_to_append)}."
-            )
-
-    # Co-add the frames in each "total" image
-
-    any_error = False
-    for filetype in FILE_TYPES_TO_SUM:
-        if filetype.uvotimsum_method is None:
-            # skip the mask files, since we don't need to sum those
-            continue
+    # The "all" images are made, co-added and post-processed in a pool of workers, every
+    # job starts as soon as the jobs whose images it needs have finished: the co-added
+    # images of a filter are post-processed while the other filters are co-added.
+    jobs: dict[str, Job] = {}
+    coadd_jobs: dict[str, list[str]] = {filt: [] for filt in FILTER_TYPES}
 
-        print(f"Co-adding all frames of type {filetype.out_file_type}...")
+    if config.performance.incremental:
+        # update the store of co-added images of each filter with the new, changed and
+        # removed images, and write the co-added images from it
         for filt in FILTER_TYPES:
-            all_fname = f"{path}all_{filt}_{filetype.out_file_type}.img"
-            out_fname = all_fname.replace("all", "sum")
-            mask_fname = all_fname.rsplit(f"_{filt}_", 1)[0] + f"_{filt}_mk.img"
-            if os.path.isfile(all_fname):
-                error = coaddframes(
-                    all_fname, mask_fname, out_fname, filetype.uvotimsum_method
-                )
-                any_error = any_error | error
-
-    # the actual weighted summed corr factor is: F = summed_primary / summed_orig_counts
-    # open the summed primary image and divide by the summed original counts image
-    print("Calculating weighted summed corr factors...")
-    for filt in FILTER_TYPES:
-        primary_counts_sum_fname = f"{path}sum_{filt}_data.img"
-        orig_counts_sum_fname = f"{path}sum_{filt}_orig_counts.img"
-        if os.path.isfile(primary_counts_sum_fname) and os.path.isfile(
-            orig_counts_sum_fname
-        ):
-            calc_summed_corr_factor(primary_counts_sum_fname, orig_counts_sum_fname)
-
-    print("Calculating coincidence loss correction uncertainty...")
+            jobs[f"update {filt}"] = Job(update_sums, (path, filt, dtype, scratch_dir))
+            coadd_jobs[filt].append(f"update {filt}")
+    else:
+        # for diff. image types, append frames to one "all" image per filter.
+        for filetype in FILE_TYPES_TO_SUM:
+            files_to_append: dict[str, list[str]] = {}
+            for filename in sorted(os.listdir(path)):
+                if filename.endswith(
+                    filetype.in_file_pattern
+                ) and not filename.startswith("."):
+                    files_to_append.setdefault(check_filter(filename), []).append(
+                        path + filename
+                    )
+            for filterlabel, fnames in files_to_append.items():
+                all_fname = f"{path}all_{filterlabel}_{filetype.out_file_type}.img"
+                jobs[all_fname] = Job(append_frames, (fnames, all_fname, scratch_dir))
+
+        # Co-add the frames in each "total" image
+        for filetype in FILE_TYPES_TO_SUM:
+            if filetype.uvotimsum_method is None:
+                # skip the mask files, since we don't need to sum those
+                continue
+
+            for filt in FILTER_TYPES:
+                all_fname = f"{path}all_{filt}_{filetype.out_file_type}.img"
+                out_fname = all_fname.replace("all", "sum")
+                mask_fname = all_fname.rsplit(f"_{filt}_", 1)[0] + f"_{filt}_mk.img"
+                if all_fname in jobs:
+                    jobs[out_fname] = Job(
+                        coadd,
+                        (all_fname, mask_fname, out_fname, filetype.uvotimsum_method),
+                        after=tuple(
+                            fname for fname in [all_fname, mask_fname] if fname in jobs
+                        ),
+                    )
+                    coadd_jobs[filt].append(out_fname)
+
+    # post-process the co-added images of each filter
     for filt in FILTER_TYPES:
-        coicorr_unc_sq_sum_fname = f"{path}sum_{filt}_coicorr_rel_sq.img"
-        primary_counts_sum_fname = f"{path}sum_{filt}_data.img"
-        if os.path.isfile(coicorr_unc_sq_sum_fname):
-            calc_coicorr_uncertainty(coicorr_unc_sq_sum_fname, primary_counts_sum_fname)
+        jobs[f"post-process {filt}"] = Job(
+            post_process,
+            (path, filt, dtype, config.performance.keep_intermediates, scratch_dir),
+            after=tuple(coadd_jobs[filt]),
+        )
 
-    print("Calculating zero point correction factor...")
-    for filt in FILTER_TYPES:
-        primary_counts_sum_fname = f"{path}sum_{filt}_data.img"
-        zp_corr_sum_fname = f"{path}sum_{filt}_zp_corr_cts.img"
-        if os.path.isfile(zp_corr_sum_fname) and os.path.isfile(
-            primary_counts_sum_fname
-        ):
-            calc_zp_corr_factor(zp_corr_sum_fname, primary_counts_sum_fname)
-
-    print("Normalizing primary image counts by their exposure times...")
-    for filt in FILTER_TYPES:
-        sum_fname = f"{path}sum_{filt}_data.img"
-        expmap_sumfile = sum_fname.replace("_data.img", "_ex.img")
-        out_fname = sum_fname.replace("_data.img", "_nm.img")
-        if os.path.isfile(sum_fname) and os.path.isfile(expmap_sumfile):
-            with fits.open(sum_fname) as sum_hdu, fits.open(
-                expmap_sumfile
-            ) as expmap_sum_hdu:
-                norm(sum_hdu, expmap_sum_hdu, out_fname)
-
-    # combine into a single file for each filter
-    print("Saving combined images...")
-    for filt in FILTER_TYPES:
-        primary_fname = f"{path}sum_{filt}_nm.img"
-        coicorr_factor_fname = f"{path}sum_{filt}_coicorr_factor.img"
-        coicorr_unc_fname = f"{path}sum_{filt}_coicorr_unc.img"
-        zp_corr_factor_fname = f"{path}sum_{filt}_zp_corr_factor.img"
-        primary_cts_fname = f"{path}sum_{filt}_data.img"
-
-        if (
-            os.path.isfile(primary_fname)
-            and os.path.isfile(coicorr_factor_fname)
-            and os.path.isfile(coicorr_unc_fname)
-            and os.path.isfile(zp_corr_factor_fname)
-            and os.path.isfile(primary_cts_fname)
-        ):
-            with fits.open(primary_fname) as primary_hdul, fits.open(
-                coicorr_factor_fname
-            ) as coicorr_hdul, fits.open(coicorr_unc_fname) as coi_unc_hdul, fits.open(
-                zp_corr_factor_fname
-            ) as zp_corr_hdul, fits.open(
-                primary_cts_fname
-            ) as primary_cts_hdul:
-                primary = primary_hdul[1].data
-                f_coi = coicorr_hdul[1].data
-                coicorr_rel = coi_unc_hdul[1].data
-                f_zp = zp_corr_hdul[1].data
-                primary_cts = primary_cts_hdul[1].data
-
-                vals = np.isfinite(primary_cts) & (primary_cts > 0)
-                poisson_rel = np.full_like(primary_cts, np.nan)
-                poisson_rel[vals] = 1.0 / np.sqrt(primary_cts[vals])
-
-                header = primary_hdul[1].header
-                header["PLANE0"] = "primary (counts)"
-                header["PLANE1"] = "average coincidence loss correction factor"
-                header[
-                    "PLANE2"
-                ] = "relative coincidence loss correction uncertainty (fraction)"
-                header["PLANE3"] = "average zero point correction factor"
-                header["PLANE4"] = "relative Poisson noise (fraction)"
-
-                new_datacube = np.array(
-                    [primary, f_coi, coicorr_rel, f_zp, poisson_rel]
-                )
-                sum_hdu = fits.PrimaryHDU(new_datacube, header)
-                sum_hdu.writeto(path + "total_sum_" + filt + "_nm.fits", overwrite=True)
+    print(
+        f"Co-adding and post-processing the images of {len(FILTER_TYPES)} "
+        f"filters in {config.performance.workers} worker(s)..."
+    )
+    results = run_jobs(jobs, workers=config.performance.workers)
+    any_error = any(results[name] for names in coadd_jobs.values() for name in names)
 
     if not any_error:
         print("All frames successfully co-added")
@@ -222,108 +187,254 @@ def main(argv: Optional[Sequence[str]] = None) -> int:
         return 1
 
 
-def calc_summed_corr_factor(primary_counts_sum_fname: str, orig_counts_sum_fname: str):
-    """Calculate the weighted summed corr factor"""
+# the co-added images that are post-processed, by their type (see FILE_TYPES_TO_SUM)
+SUM_TYPES = ["data", "orig_counts", "coicorr_rel_sq", "zp_corr_cts", "ex"]
 
-    primary_counts_sum_hdul = fits.open(primary_counts_sum_fname)
-    orig_counts_sum_hdul = fits.open(orig_counts_sum_fname)
-    finite_vals = np.isfinite(primary_counts_sum_hdul[1].data) & (
-        orig_counts_sum_hdul[1].data > 0
-    )
-    sum_coi_corr_factor = np.full_like(primary_counts_sum_hdul[1].data, np.nan)
-    sum_coi_corr_factor[finite_vals] = (
-        primary_counts_sum_hdul[1].data[finite_vals]
-        / orig_counts_sum_hdul[1].data[finite_vals]
-    )
 
-    # todo: update the header for this data
-    new_hdu_header = fits.PrimaryHDU(header=primary_counts_sum_hdul[0].header)
-    new_hdulist = fits.HDUList([new_hdu_header])
-    new_hdu = fits.ImageHDU(sum_coi_corr_factor, primary_counts_sum_hdul[1].header)
-    new_hdulist.append(new_hdu)
-    new_fname = primary_counts_sum_fname.replace("data.img", "coicorr_factor.img")
-    new_hdulist.writeto(new_fname, overwrite=True)
+def update_sums(
+    path: str, filt: str, dtype: DTypeLike = None, scratch_dir: str | None = None
+) -> bool:
+    """Update the store of co-added images of a filter (coadd_<filt>, see
+    `dresscode.accumulator`) with the corrected images in the working directory: the
+    new images are co-added, the removed and changed images are taken out. The co-added
+    images (sum_<filt>_<type>.img) are written from the store.
+
+    Returns a bool indicating if an error occurred"""
 
-    primary_counts_sum_hdul.close()
-    orig_counts_sum_hdul.close()
+    # the files of each image by type, the images are named after their mask
+    images: dict[str, dict[str, str]] = {}
+    for filetype in FILE_TYPES_TO_SUM:
+        for filename in sorted(os.listdir(path)):
+            if (
+                filename.endswith(filetype.in_file_pattern)
+                and not filename.startswith(".")
+                and check_filter(filename) == filt
+            ):
+                name = filename[: -len(filetype.in_file_pattern)]
+                images.setdefault(name, {})[filetype.out_file_type] = path + filename
+    methods = {
+        filetype.out_file_type: filetype.uvotimsum_method
+        for filetype in FILE_TYPES_TO_SUM
+        if filetype.uvotimsum_method is not None
+    }
+
+    store_dir = f"{path}coadd_{filt}"
+    try:
+        for name, fnames in images.items():
+            missing = {"mk", *methods} - set(fnames)
+            if missing:
+                raise ValueError(f"{name} has no {', '.join(sorted(missing))} image")
+        masks = {name: fnames.pop("mk") for name, fnames in images.items()}
+        store = update_store(store_dir, images, masks, methods, scratch_dir=scratch_dir)
+        if store is not None:
+            write_sums(
+                store,
+                images,
+                {sum_type: f"{path}sum_{filt}_{sum_type}.img" for sum_type in methods},
+                dtype,
+                scratch_dir,
+            )
+    except (OSError, ValueError) as e:
+        print(f"An error has occurred in updating coadd_{filt}: {e}")
+        return True
+    return False
 
 
-def calc_coicorr_uncertainty(
-    coicorr_unc_sq_sum_fname: str, primary_counts_sum_fname: str
+def post_process(
+    path: str,
+    filt: str,
+    dtype: DTypeLike = None,
+    keep_intermediates: bool = False,
+    scratch_dir: str | None = None,
 ):
-    """Calculate coincidence loss correction uncertainty"""
+    """Calculate the corr factors, uncertainties and normalized image of the co-added
+    images of a filter, and combine them into one image (total_sum_<filt>_nm.fits)
+
+    Each co-added image is read once, the planes of the combined image are calculated in
+    memory. With keep_intermediates, the planes are also written to their own images
+    (sum_<filt>_coicorr_factor.img, _coicorr_unc, _zp_corr_factor and _nm)."""
+
+    sum_fnames = {
+        sum_type: f"{path}sum_{filt}_{sum_type}.img" for sum_type in SUM_TYPES
+    }
+    missing = [
+        os.path.basename(fname)
+        for fname in sum_fnames.values()
+        if not os.path.isfile(fname)
+    ]
+    if len(missing) == len(sum_fnames):
+        return
+    if missing:
+        print(f"Can't combine the images of {filt}, missing {', '.join(missing)}")
+        return
+
+    print(f"Calculating the combined image of {filt}...")
+    # the primary header, header and data of each co-added image
+    sums: dict[str, tuple[fits.Header, fits.Header, np.ndarray]] = {}
+    for sum_type, fname in sum_fnames.items():
+        with fits.open(fname, memmap=False) as hdulist:
+            sums[sum_type] = (hdulist[0].header, hdulist[1].header, hdulist[1].data)
+    primary_cts = sums["data"][2]
 
-    coicorr_unc_sq_hdul = fits.open(coicorr_unc_sq_sum_fname)
-    primary_counts_sum_hdul = fits.open(primary_counts_sum_fname)
-    # this is in counts but we need to convert to fraction by dividing by corrected summed counts (primary)
+    # the actual weighted summed corr factor is: F = summed_primary / summed_orig_counts
+    f_coi = summed_corr_factor_data(primary_cts, sums["orig_counts"][2], dtype)
+    coicorr_rel = coicorr_uncertainty_data(
+        sums["coicorr_rel_sq"][2], primary_cts, dtype
+    )
+    f_zp = zp_corr_factor_data(sums["zp_corr_cts"][2], primary_cts, dtype)
+    # normalize the primary image counts by their exposure times
+    primary = norm_data(primary_cts, sums["ex"][2], dtype=dtype)
+    poisson_rel = poisson_noise_data(primary_cts)
+
+    # the images are written in the background, while the next images are calculated
+    with AsyncWriter(scratch_dir=scratch_dir) as writer:
+        if keep_intermediates:
+            # with the headers of the co-added images they are calculated from
+            for data, sum_type, suffix in [
+                (f_coi, "data", "coicorr_factor"),
+                (coicorr_rel, "coicorr_rel_sq", "coicorr_unc"),
+                (f_zp, "zp_corr_cts", "zp_corr_factor"),
+                (primary, "data", "nm"),
+            ]:
+                primary_header, header, _ = sums[sum_type]
+                new_hdulist = fits.HDUList(
+                    [
+                        fits.PrimaryHDU(header=primary_header),
+                        fits.ImageHDU(data, header),
+                    ]
+                )
+                writeto(new_hdulist, f"{path}sum_{filt}_{suffix}.img", writer)
+
+        # combine into a single file
+        header = sums["data"][1].copy()
+        header["PLANE0"] = "primary (counts)"
+        header["PLANE1"] = "average coincidence loss correction factor"
+        header["PLANE2"] = "relative coincidence loss correction uncertainty (fraction)"
+        header["PLANE3"] = "average zero point correction factor"
+        header["PLANE4"] = "relative Poisson noise (fraction)"
+
+        new_datacube = np.array(
+            [primary, f_coi, coicorr_rel, f_zp, poisson_rel], dtype=dtype
+        )
+        sum_hdu = fits.PrimaryHDU(new_datacube, header)
+        writeto(sum_hdu, path + "total_sum_" + filt + "_nm.fits", writer)
+    print(f"Saved the combined image of {filt}")
 
-    # we summed squares, square root the summed uncertainties
-    new_data = np.sqrt(coicorr_unc_sq_hdul[1].data) / primary_counts_sum_hdul[1].data
-
-    # todo: update the header for this data
-    new_hdu_header = fits.PrimaryHDU(header=coicorr_unc_sq_hdul[0].header)
-    new_hdulist = fits.HDUList([new_hdu_header])
-    new_hdu = fits.ImageHDU(new_data, coicorr_unc_sq_hdul[1].header)
-    new_hdulist.append(new_hdu)
-    new_fname = coicorr_unc_sq_sum_fname.replace(
-        "coicorr_rel_sq.img", "coicorr_unc.img"
+
+def summed_corr_factor_data(
+    primary_cts: np.ndarray, orig_counts: np.ndarray, dtype: DTypeLike = None
+) -> np.ndarray:
+    """The weighted summed corr factor: the summed primary image divided by the summed
+    original counts"""
+
+    finite_vals = np.isfinite(primary_cts) & (orig_counts > 0)
+    sum_coi_corr_factor = np.full_like(primary_cts, np.nan, dtype=dtype)
+    sum_coi_corr_factor[finite_vals] = (
+        primary_cts[finite_vals] / orig_counts[finite_vals]
     )
-    new_hdulist.writeto(new_fname, overwrite=True)
+    return sum_coi_corr_factor
 
-    coicorr_unc_sq_hdul.close()
 
+def coicorr_uncertainty_data(
+    coicorr_unc_sq: np.ndarray, primary_cts: np.ndarray, dtype: DTypeLike = None
+) -> np.ndarray:
+    """The relative coincidence loss correction uncertainty, from the summed squared
+    uncertainties (in counts)"""
 
-def calc_zp_corr_factor(zp_corr_sum_fname: str, primary_counts_sum_fname: str):
-    """Calculate the average zero point correction factor"""
+    # this is in counts but we need to convert to fraction by dividing by corrected summed counts (primary)
 
-    # todo: pass hdul instead of fname to avoid file load
+    # we summed squares, square root the summed uncertainties
+    new_data = np.sqrt(coicorr_unc_sq) / primary_cts
+    if dtype is not None:
+        new_data = new_data.astype(dtype, copy=False)
+    return new_data
 
-    # take the summed zero point corr. factor _counts_ and convert back to a factor
 
-    primary_counts_sum_hdul = fits.open(primary_counts_sum_fname)
-    zp_corr_sum_hdul = fits.open(zp_corr_sum_fname)
+def zp_corr_factor_data(
+    zp_corr_cts: np.ndarray, primary_cts: np.ndarray, dtype: DTypeLike = None
+) -> np.ndarray:
+    """The average zero point correction factor, from the summed zero point correction
+    counts"""
 
-    finite_vals = np.isfinite(primary_counts_sum_hdul[1].data) & (
-        zp_corr_sum_hdul[1].data > 0
-    )
-    sum_zp_corr_factor = np.full_like(zp_corr_sum_hdul[1].data, np.nan)
+    # take the summed zero point corr. factor _counts_ and convert back to a factor
+    finite_vals = np.isfinite(primary_cts) & (zp_corr_cts > 0)
+    sum_zp_corr_factor = np.full_like(zp_corr_cts, np.nan, dtype=dtype)
     sum_zp_corr_factor[finite_vals] = (
-        zp_corr_sum_hdul[1].data[finite_vals]
-        / primary_counts_sum_hdul[1].data[finite_vals]
+        zp_corr_cts[finite_vals] / primary_cts[finite_vals]
     )
-
-    # todo: update the header for this data
-    new_hdu_header = fits.PrimaryHDU(header=zp_corr_sum_hdul[0].header)
-    new_hdulist = fits.HDUList([new_hdu_header])
-    new_hdu = fits.ImageHDU(sum_zp_corr_factor, zp_corr_sum_hdul[1].header)
-    new_hdulist.append(new_hdu)
-    new_fname = zp_corr_sum_fname.replace("_zp_corr_cts.img", "_zp_corr_factor.img")
-    new_hdulist.writeto(new_fname, overwrite=True)
-
-    primary_counts_sum_hdul.close()
-    zp_corr_sum_hdul.close()
+    return sum_zp_corr_factor
 
 
-def append_frames(fname: str, all_fname: str):
-    """Copy the first image of a filter and type into new image
-    OR append frames, depending on whether it is the first image or not"""
+def poisson_noise_data(primary_cts: np.ndarray) -> np.ndarray:
+    """The relative Poisson noise of the summed primary image (in counts)"""
 
-    # If the "total" image of this type and this filter does not yet exist, create it.
-    if not os.path.isfile(all_fname):
-        shutil.copyfile(fname, all_fname)
-        print(f"File {os.path.basename(all_fname)} has been created.")
-    else:
-        path = os.path.dirname(fname) + "/"
+    vals = np.isfinite(primary_cts) & (primary_cts > 0)
+    poisson_rel = np.full_like(primary_cts, np.nan)
+    poisson_rel[vals] = 1.0 / np.sqrt(primary_cts[vals])
+    return poisson_rel
 
-        with fits.open(fname) as hdulist:
-            for j in range(1, len(hdulist)):
-                infile = f"{fname}+{j}"
-                subprocess.call(f"ftappend {infile} {all_fname}", cwd=path, shell=True)
 
+def append_frames(
+    fnames: Sequence[str], all_fname: str, scratch_dir: str | None = None
+):
+    """Write the images of a filter and type to one "all" image: a copy of the first
+    image, followed by the frames of the other images
+
+    The headers and data of the frames are copied byte for byte from the images, as
+    ftappend copies them, so the "all" image is the same as the one made by copying the
+    first image and running ftappend on every frame of the other images. It is written
+    in one pass, to a temporary file that is renamed when it is complete."""
+
+    tmp_fname = temp_fname(all_fname, scratch_dir)
+    try:
+        with open(tmp_fname, "wb") as all_file:
+            with open(fnames[0], "rb") as image_file:
+                shutil.copyfileobj(image_file, all_file)
+            print(f"File {os.path.basename(all_fname)} has been created.")
+
+            for fname in fnames[1:]:
+                with fits.open(fname) as hdulist, open(fname, "rb") as image_file:
+                    for hdu in hdulist[1:]:
+                        info = hdu.fileinfo()
+                        image_file.seek(info["hdrLoc"])
+                        copy_bytes(
+                            image_file,
+                            all_file,
+                            info["datLoc"] + info["datSpan"] - info["hdrLoc"],
+                        )
                 print(
-                    f"Frame {os.path.basename(infile)} (frame {j}/{len(hdulist) - 1}) "
+                    f"Frames of {os.path.basename(fname)} ({len(hdulist) - 1} frames) "
                     f"appended to {os.path.basename(all_fname)}."
                 )
+        replace_file(tmp_fname, all_fname)
+    finally:
+        if os.path.exists(tmp_fname):
+            os.remove(tmp_fname)
+
+
+def copy_bytes(src: BinaryIO, dst: BinaryIO, n_bytes: int, chunk_size: int = 2**20):
+    """Copy n_bytes from the current position of src to dst, in chunks"""
+
+    while n_bytes > 0:
+        chunk = src.read(min(chunk_size, n_bytes))
+        if not chunk:
+            raise EOFError(f"{src.name} ends {n_bytes} bytes before the end of an HDU")
+        dst.write(chunk)
+        n_bytes -= len(chunk)
+
+
+def pfiles_env(pfiles_dir: str) -> dict[str, str]:
+    """The environment of a HEASoft task with pfiles_dir as its user parameter file
+    directory
+
+    A task rewrites its user parameter file when it runs, so tasks that run in parallel
+    can't share one. The system parameter files are those of PFILES, or of HEADAS."""
+    pfiles = os.environ.get("PFILES", "")
+    if ";" in pfiles:
+        syspfiles = pfiles.split(";", 1)[1]
+    else:
+        syspfiles = pfiles or os.path.join(os.environ.get("HEADAS", ""), "syspfiles")
+    return {**os.environ, "PFILES": f"{pfiles_dir};{syspfiles}"}
 
 
 def coaddframes(allfile: str, maskfile: str, outfile: str, method: str) -> bool:
@@ -338,6 +449,9 @@ def coaddframes(allfile: str, maskfile: str, outfile: str, method: str) -> bool:
     )
 
     # Open the terminal output file and run uvotimsum with the specified parameters.
+    # Every run gets its own parameter file directory, the images can be co-added in
+    # parallel (see pfiles_env).
+    pfiles_dir = tempfile.mkdtemp(prefix="pfiles_")
     with open(terminal_output_file, "w") as terminal:
         ret_code = subprocess.call(
             "uvotimsum infile="
@@ -346,12 +460,14 @@ def coaddframes(allfile: str, maskfile: str, outfile: str, method: str) -> bool:
             + outfile
             + " method="
             + method
-            + " pixsize=0.00027888888381462 exclude=DEFAULT maskfile="
+            + f" pixsize={PIXSIZE} exclude=DEFAULT maskfile="
             + maskfile,
             cwd=path,
             shell=True,
             stdout=terminal,
+            env=pfiles_env(pfiles_dir),
         )
+    shutil.rmtree(pfiles_dir, ignore_errors=True)
 
     # error checking
     with open(terminal_output_file) as fh:
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+"""Benchmark the image kernels of dresscode.utils on UVOT-sized frames
+
+Synthetic multi-frame sky images, masks and exposure maps are written to a temporary
+directory, at 1024x1024 (2x2 binning) and 2048x2048 (1x1 binning) by default. Each frame
+has the NaN footprint of a real frame: a rotated square field of view (NaN outside) with
+masked stars inside. Each kernel is timed (best of `--repeat` runs) on the frames read
+into memory, and its peak memory is measured with tracemalloc in a separate run. The
+results are printed and written to a JSON file, and can be compared with the results of
+an earlier run to catch regressions:
+
+    python tests/benchmark_utils.py -o benchmark.json --compare benchmark_1.0.0.json
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import platform
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Optional, Sequence
+
+import astropy
+import numpy as np
+from astropy.io import fits
+
+from dresscode import utils
+
+SIZES = [1024, 2048]
+
+# radius of the 9x9 box of the coincidence loss correction
+RADIUS = 4
+
+
+def footprint(size: int, rng: np.random.Generator) -> np.ndarray:
+    """rotated square field of view, covering ~60% of the frame"""
+
+    y, x = (
+        np.mgrid[:size, :size]
+        - size / 2
+        + rng.uniform(-0.05, 0.05, 2)[:, None, None] * size
+    )
+    angle = rng.uniform(0, np.pi / 2)
+    u = x * np.cos(angle) + y * np.sin(angle)
+    v = -x * np.sin(angle) + y * np.cos(angle)
+    half_side = 0.39 * size
+    return (np.abs(u) < half_side) & (np.abs(v) < half_side)
+
+
+def write_frames(working_dir: Path, size: int, n_frames: int, seed: int = 0) -> dict:
+    """write a synthetic sky image, mask and exposure map with n_frames frames each"""
+
+    rng = np.random.default_rng(seed)
+    header = fits.Header({"DEADC": 0.984, "FRAMTIME": 0.0110322})
+    hduls = {key: fits.HDUList([fits.PrimaryHDU()]) for key in ["sk", "mk", "ex"]}
+    for _ in range(n_frames):
+        fov = footprint(size, rng)
+
+        # vignetting-like exposure, NaN outside the field of view, very low at the edge
+        y, x = np.mgrid[:size, :size] / size - 0.5
+        exp = 700.0 * (1 - 0.3 * (x**2 + y**2))
+        exp[~fov] = np.nan
+        edge = fov & ~np.roll(fov, 3, axis=0)
+        exp[edge] = 0.5
+
+        # masked stars
+        mask = fov.astype(np.int16)
+        for cy, cx in rng.integers(0, size, (size // 64, 2)):
+            r = rng.integers(2, 12)
+            mask[max(cy - r, 0) : cy + r, max(cx - r, 0) : cx + r] = 0
+
+        sky = rng.poisson(0.02 * np.nan_to_num(exp)).astype(np.float32)
+
+        hduls["sk"].append(fits.ImageHDU(sky, header))
+        hduls["mk"].append(fits.ImageHDU(mask, header))
+        hduls["ex"].append(fits.ImageHDU(exp.astype(np.float32), header))
+
+    fnames = {}
+    for key, hdul in hduls.items():
+        fnames[key] = str(working_dir / f"bench{size}_um2_{key}_corr.img")
+        hdul.writeto(fnames[key], overwrite=True)
+    return fnames
+
+
+def read(fname: str) -> fits.HDUList:
+    """the frames of a file, read into memory, with the file closed (so no memory maps
+    are left open between the runs)"""
+
+    with fits.open(fname, memmap=False) as hdul:
+        return fits.HDUList([hdu.copy() for hdu in hdul])
+
+
+def kernels(fnames: dict, radius: int) -> dict[str, Callable[[], object]]:
+    """the kernels to benchmark, on the frames in the files"""
+
+    sky_hdul, mask_hdul, exp_hdul = (read(fnames[key]) for key in ["sk", "mk", "ex"])
+    masked_hdul = utils.apply_mask(sky_hdul, mask_hdul, "", dry_run=True)
+    # the input of the windowed kernels in the coincidence loss correction
+    norm_frames = [
+        frame.data for frame in utils.norm(masked_hdul, exp_hdul, dry_run=True)[1:]
+    ]
+
+    def each_frame(kernel):
+        # the output of a frame is dropped before the next, as in the corrections
+        for data in norm_frames:
+            kernel(data, radius)
+
+    return {
+        "windowed_sum": lambda: each_frame(utils.windowed_sum),
+        "windowed_std": lambda: each_frame(utils.windowed_std),
+        "windowed_finite_vals": lambda: each_frame(utils.windowed_finite_vals),
+        "apply_mask": lambda: utils.apply_mask(sky_hdul, mask_hdul, "", dry_run=True),
+        "norm": lambda: utils.norm(masked_hdul, exp_hdul, dry_run=True),
+        # reads the mask and exposure map from disk
+        "update_mask": lambda: utils.update_mask(
+            fnames["mk"], fnames["ex"], "", dry_run=True
+        ),
+    }
+
+
+def close(result: object):
+    """close the output of a kernel, if it is an HDUList (e.g. the memory maps of the
+    mask read by update_mask)"""
+
+    if isinstance(result, fits.HDUList):
+        result.close()
+
+
+def benchmark(func: Callable[[], object], repeat: int) -> tuple[float, float]:
+    """best time (s) of repeat runs and peak memory (MB) of the kernel"""
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        close(func())
+        times.append(time.perf_counter() - start)
+
+    # numpy reports its allocations to tracemalloc, measured in a separate run since
+    # tracing slows down the kernel
+    tracemalloc.start()
+    close(func())
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return min(times), peak / 1e6
+
+
+def compare(results: list[dict], baseline: list[dict], tolerance: float) -> list[str]:
+    """the kernels whose throughput dropped, or peak memory rose, by more than tolerance"""
+
+    baseline_results = {(res["kernel"], res["size"]): res for res in baseline}
+    regressions = []
+    for res in results:
+        base = baseline_results.get((res["kernel"], res["size"]))
+        if base is None:
+            continue
+        if res["mpix_per_s"] < base["mpix_per_s"] * (1 - tolerance):
+            regressions.append(
+                f"{res['kernel']} ({res['size']}x{res['size']}): "
+                f"{res['mpix_per_s']:.1f} MP/s, was {base['mpix_per_s']:.1f} MP/s"
+            )
+        if res["peak_mb"] > base["peak_mb"] * (1 + tolerance):
+            regressions.append(
+                f"{res['kernel']} ({res['size']}x{res['size']}): "
+                f"{res['peak_mb']:.1f} MB peak memory, was {base['peak_mb']:.1f} MB"
+            )
+    return regressions
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--sizes", nargs="+", type=int, default=SIZES, help="frame sizes (pixels)"
+    )
+    parser.add_argument("--frames", type=int, default=4, help="frames per image")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per kernel")
+    parser.add_argument("--radius", type=int, default=RADIUS, help="window radius")
+    parser.add_argument(
+        "-o", "--output", default="benchmark.json", help="results file (JSON)"
+    )
+    parser.add_argument("--compare", help="results file of an earlier run (JSON)")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="relative change that counts as a regression (default: 0.2)",
+    )
+    args = parser.parse_args(argv)
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for size in args.sizes:
+            fnames = write_frames(Path(tmp_dir), size, args.frames)
+            mpix = args.frames * size**2 / 1e6
+            for kernel, func in kernels(fnames, args.radius).items():
+                seconds, peak_mb = benchmark(func, args.repeat)
+                results.append(
+                    {
+                        "kernel": kernel,
+                        "size": size,
+                        "frames": args.frames,
+                        "seconds": seconds,
+                        "mpix_per_s": mpix / seconds,
+                        "peak_mb": peak_mb,
+                    }
+                )
+                print(
+                    f"{kernel:>22} {size:>5}x{size:<5} {mpix / seconds:8.1f} MP/s "
+                    f"{peak_mb:8.1f} MB peak"
+                )
+
+    with open(args.output, "w") as f:
+        json.dump(
+            {
+                "date": datetime.now().isoformat(timespec="seconds"),
+                "python": platform.python_version(),
+                "numpy": np.__version__,
+                "astropy": astropy.__version__,
+                "machine": platform.machine(),
+                "radius": args.radius,
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+    print(f"Benchmark results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f)["results"], args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
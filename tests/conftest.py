@@ -1,5 +1,6 @@
 import tempfile
 from pathlib import Path
+from typing import Callable
 
 import numpy as np
 import pytest
@@ -54,3 +55,76 @@ def final_fits_path(tmp_path: Path):
         hdu.writeto(fits_path)
 
     yield tmp_path
+
+
+GALAXY = "NGC0000"
+
+
+def write_uvot_files(working_dir: Path, seed: int = 0):
+    """write synthetic corrected sky images, with their mask, exposure and large scale
+    sensitivity maps, as they are before dc-corrections"""
+    rng = np.random.default_rng(seed)
+    shape = (64, 64)
+    for obs_id, filt in [("sw00000000001", "um2"), ("sw00000000002", "uw1")]:
+        header = fits.Header(
+            {
+                "DEADC": 0.984,
+                "FRAMTIME": 0.0110322,
+                "DATE-OBS": "2012-05-06T10:00:00",
+                "ASPCORR": "DIRECT",
+                # sky coordinates, with the pixel size of the co-added images
+                "CTYPE1": "RA---TAN",
+                "CTYPE2": "DEC--TAN",
+                "CRVAL1": 24.174,
+                "CRVAL2": 15.783,
+                "CRPIX1": 32.5,
+                "CRPIX2": 32.5,
+                "CDELT1": -0.00027888888381462,
+                "CDELT2": 0.00027888888381462,
+            }
+        )
+        sk_hdul, mk_hdul, ex_hdul, lss_hdul = (
+            fits.HDUList([fits.PrimaryHDU(header=header)]) for _ in range(4)
+        )
+        for _ in range(2):
+            exposure = np.full(shape, 700, dtype=np.float32)
+            exposure[:, :4] = np.nan
+            exposure[10, 10] = 0.5
+            rate = rng.gamma(1.0, 0.05, shape)
+            rate[30:34, 30:34] = 2.0  # bright source
+            sk_hdul.append(
+                fits.ImageHDU(rng.poisson(rate * 700).astype(np.float32), header)
+            )
+            mask = np.ones(shape, dtype=np.int16)
+            mask[50:55, 20:25] = 0
+            mk_hdul.append(fits.ImageHDU(mask, header))
+            ex_hdul.append(fits.ImageHDU(exposure, header))
+            lss = rng.normal(1.0, 0.02, shape).astype(np.float32)
+            lss_hdul.append(fits.ImageHDU(lss, header))
+
+        for hdul, file_type in zip(
+            [sk_hdul, mk_hdul, ex_hdul, lss_hdul], ["sk", "mk", "ex", "lss"]
+        ):
+            hdul.writeto(working_dir / f"{obs_id}_{filt}_{file_type}_corr.img")
+
+
+@pytest.fixture
+def make_config(tmp_path_factory) -> Callable[..., Path]:
+    """factory for a config file pointing to a working dir with synthetic images,
+    extra options are added to the performance section of the config file"""
+
+    def _make_config(**options) -> Path:
+        path = tmp_path_factory.mktemp("data")
+        working_dir = path / GALAXY / "working_dir"
+        working_dir.mkdir(parents=True)
+        write_uvot_files(working_dir)
+
+        config_fname = path / "config.txt"
+        lines = [f"path = {path}/", f"galaxy = {GALAXY}"]
+        if options:
+            lines.append("[performance]")
+            lines += [f"{key} = {value}" for key, value in options.items()]
+        config_fname.write_text("\n".join(lines) + "\n")
+        return config_fname
+
+    return _make_config
@@ -0,0 +1,73 @@
+from __future__ import annotations
+
+from pathlib import Path
+
+import numpy as np
+import pytest
+from test_coadd import SHAPE, frame_header, write_all
+
+from dresscode import accumulator, coadd
+
+METHODS = {"data": "grid", "ex": "expmap"}
+
+
+def write_image(tmp_path: Path, name: str, shift: tuple[int, int], value: float):
+    """write the data, exposure map and mask of an image with one frame"""
+    header = frame_header(shift)
+    fnames = {
+        sum_type: write_all(
+            tmp_path / f"{name}_{sum_type}.img",
+            [(np.full(SHAPE, value, dtype=np.float32), header)],
+        )
+        for sum_type in METHODS
+    }
+    mask_fname = write_all(
+        tmp_path / f"{name}_mk.img", [(np.ones(SHAPE, dtype=np.int16), header)]
+    )
+    return fnames, mask_fname
+
+
+def test_update_store(tmp_path: Path):
+    """Asserts the grid grows to cover new images, and removing all but the first image
+    gives back the sums of the first image"""
+
+    store_dir = str(tmp_path / "coadd_um2")
+    images, masks = {}, {}
+    images["a"], masks["a"] = write_image(tmp_path, "a", (0, 0), 1.0)
+    first = accumulator.update_store(store_dir, images, masks, METHODS)
+    first_sums = {sum_type: data.copy() for sum_type, data in first.sums.items()}
+
+    images["b"], masks["b"] = write_image(tmp_path, "b", (-4, 6), 2.0)
+    images["c"], masks["c"] = write_image(tmp_path, "c", (3, -2), 5.0)
+    store = accumulator.update_store(store_dir, images, masks, METHODS)
+    assert set(store.images) == {"a", "b", "c"}
+    # the same grid as when the images are co-added at once
+    grid_wcs, grid_shape = coadd.sky_grid(
+        [
+            (coadd.frame_wcs(frame_header(shift)), SHAPE)
+            for shift in [(0, 0), (-4, 6), (3, -2)]
+        ]
+    )
+    assert store.shape == grid_shape
+    np.testing.assert_allclose(store.grid_wcs.wcs.crpix, grid_wcs.wcs.crpix)
+    assert store.sums["data"].sum() == pytest.approx((1.0 + 2.0 + 5.0) * np.prod(SHAPE))
+
+    # the store is read back
+    loaded = accumulator.load_store(store_dir)
+    assert loaded.images == store.images
+    np.testing.assert_array_equal(loaded.sums["ex"], store.sums["ex"])
+
+    del images["b"], images["c"]
+    store = accumulator.update_store(store_dir, images, masks, METHODS)
+    x0, y0 = (store.grid_wcs.wcs.crpix - first.grid_wcs.wcs.crpix).astype(int)
+    region = np.s_[y0 : y0 + first.shape[0], x0 : x0 + first.shape[1]]
+    for sum_type, data in first_sums.items():
+        np.testing.assert_allclose(store.sums[sum_type][region], data, atol=1e-12)
+        # the pixels that were only covered by the removed images are 0
+        outside = store.sums[sum_type].copy()
+        outside[region] = 0
+        assert not outside.any()
+
+    images.clear()
+    assert accumulator.update_store(store_dir, images, masks, METHODS) is None
+    assert not Path(store_dir).exists()
@@ -0,0 +1,38 @@
+import json
+
+import benchmark_utils
+import numpy as np
+
+
+def test_benchmark_utils(tmp_path):
+    output = tmp_path / "benchmark.json"
+    args = ["--sizes", "64", "--frames", "2", "--repeat", "1", "-o", str(output)]
+    assert benchmark_utils.main(args) == 0
+
+    results = json.loads(output.read_text())["results"]
+    assert {res["kernel"] for res in results} == {
+        "windowed_sum",
+        "windowed_std",
+        "windowed_finite_vals",
+        "apply_mask",
+        "norm",
+        "update_mask",
+    }
+    assert all(res["mpix_per_s"] > 0 and res["peak_mb"] > 0 for res in results)
+
+    # a 2x faster or leaner baseline is a regression, a 10% one is not
+    for factor, n_regressions in [(1.1, 0), (2, 1)]:
+        baseline = [dict(res) for res in results]
+        baseline[0]["mpix_per_s"] *= factor
+        baseline[1]["peak_mb"] /= factor
+        assert len(benchmark_utils.compare(results, baseline, 0.2)) == 2 * n_regressions
+
+
+def test_read(tmp_path):
+    """Asserts the frames are read into memory and the files are closed"""
+
+    fnames = benchmark_utils.write_frames(tmp_path, 64, 2)
+    hdul = benchmark_utils.read(fnames["sk"])
+    assert len(hdul) == 3
+    assert all(not isinstance(hdu.data, np.memmap) for hdu in hdul[1:])
+    assert hdul.fileinfo(0) is None
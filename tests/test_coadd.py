@@ -0,0 +1,288 @@
+from __future__ import annotations
+
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pytest
+from astropy.io import fits
+from astropy.wcs import WCS
+
+from dresscode import coadd, uvotimsum
+
+SHAPE = (20, 30)
+
+
+def frame_header(shift: tuple[int, int] = (0, 0), aspcorr: str = "DIRECT"):
+    """header of a frame, shifted by (rows, columns) pixels on the sky"""
+    return fits.Header(
+        {
+            "ASPCORR": aspcorr,
+            "EXPOSURE": 100.0,
+            "CTYPE1": "RA---TAN",
+            "CTYPE2": "DEC--TAN",
+            "CRVAL1": 24.174,
+            "CRVAL2": 15.783,
+            "CRPIX1": 10.0 + shift[1],
+            "CRPIX2": 8.0 + shift[0],
+            "CDELT1": -coadd.PIXSIZE,
+            "CDELT2": coadd.PIXSIZE,
+        }
+    )
+
+
+def write_all(fname: Path, frames: list[tuple[np.ndarray, fits.Header]]) -> str:
+    hdul = fits.HDUList([fits.PrimaryHDU()])
+    hdul += [fits.ImageHDU(data, header) for data, header in frames]
+    hdul.writeto(fname)
+    return str(fname)
+
+
+@pytest.fixture
+def frames_fnames(tmp_path: Path):
+    """an "all" image and exposure map with 3 frames, the second shifted by (2, 3)
+    pixels, the third not aspect corrected, and their mask"""
+    headers = [
+        frame_header(),
+        frame_header(shift=(2, 3)),
+        frame_header(aspcorr="NONE"),
+    ]
+    sky = [np.zeros(SHAPE, dtype=np.float32) for _ in headers]
+    # a source at the same sky position in the first two frames
+    sky[0][5, 7] = 1000
+    sky[1][7, 10] = 500
+    sky[0][15, 20] = 10
+    sky[2][:] = 1e6
+    exposure = [np.full(SHAPE, 100, dtype=np.float32) for _ in headers]
+    for exp in exposure:
+        exp[:, 0] = np.nan
+    masks = [np.ones(SHAPE, dtype=np.int16) for _ in headers]
+    masks[1][5, 15] = 0
+
+    return (
+        write_all(tmp_path / "all_um2_data.img", list(zip(sky, headers))),
+        write_all(tmp_path / "all_um2_ex.img", list(zip(exposure, headers))),
+        write_all(tmp_path / "all_um2_mk.img", list(zip(masks, headers))),
+    )
+
+
+def test_coadd_grid(frames_fnames):
+    sky_fname, _, mask_fname = frames_fnames
+    hdul = coadd.coadd(sky_fname, mask_fname, "grid")
+
+    data, header = hdul[1].data, hdul[1].header
+    assert data.dtype == np.float32
+    assert header["NFRAMES"] == 2
+    assert header["EXPOSURE"] == 200.0
+    # the grid covers both frames
+    assert data.shape == (SHAPE[0] + 2, SHAPE[1] + 3)
+    # the counts are kept, the frame that isn't aspect corrected is excluded
+    assert data.sum() == pytest.approx(1510)
+
+    # the source is in one pixel
+    x, y = WCS(header).world_to_pixel(WCS(frame_header()).pixel_to_world(7, 5))
+    assert data[int(np.round(y)), int(np.round(x))] == pytest.approx(1500)
+
+
+def test_coadd_expmap(frames_fnames):
+    _, exp_fname, mask_fname = frames_fnames
+    hdul = coadd.coadd(exp_fname, mask_fname, "expmap", dtype=np.float64)
+
+    data = hdul[1].data
+    assert data.dtype == np.float64
+    # both frames in the overlap, one at the edges, none outside of the frames
+    assert data[10, 10] == pytest.approx(200)
+    assert data[0, 10] == pytest.approx(100)
+    assert data[0, 31] == 0
+    # the masked pixel of the second frame, in the overlap
+    x, y = WCS(hdul[1].header).world_to_pixel(
+        WCS(frame_header(shift=(2, 3))).pixel_to_world(15, 5)
+    )
+    assert data[int(np.round(y)), int(np.round(x))] == pytest.approx(100)
+
+
+def test_coadd_frames_error(frames_fnames, tmp_path: Path):
+    sky_fname, _, _ = frames_fnames
+    mask_fname = write_all(
+        tmp_path / "all_um2_mk_short.img",
+        [(np.ones(SHAPE, dtype=np.int16), frame_header())],
+    )
+    out_fname = str(tmp_path / "sum_um2_data.img")
+    assert coadd.coadd_frames(sky_fname, mask_fname, out_fname, "grid")
+    assert not os.path.exists(out_fname)
+
+
+def test_coaddframes_pfiles(frames_fnames, tmp_path: Path, monkeypatch):
+    sky_fname, _, mask_fname = frames_fnames
+    monkeypatch.setenv("PFILES", "/home/user/pfiles;/heasoft/syspfiles")
+    pfiles = []
+
+    def call(cmd, cwd, shell, stdout, env):
+        pfiles.append(env["PFILES"])
+        assert os.path.isdir(env["PFILES"].split(";")[0])
+        stdout.write("created output image\nall checksums are valid\n")
+        return 0
+
+    monkeypatch.setattr(uvotimsum.subprocess, "call", call)
+    for i in range(2):
+        out_fname = str(tmp_path / f"sum_um2_{i}.img")
+        assert not uvotimsum.coaddframes(sky_fname, mask_fname, out_fname, "grid")
+
+    # every run has its own user parameter files, which are removed afterwards
+    user_pfiles = [p.split(";")[0] for p in pfiles]
+    assert len(set(user_pfiles)) == 2
+    assert not any(os.path.exists(p) for p in user_pfiles)
+    assert all(p.endswith(";/heasoft/syspfiles") for p in pfiles)
+
+
+# uvotimsum's co-added images of the reference frames, see `reference_fnames`
+REFERENCE_DIR = Path(__file__).parent / "data"
+REFERENCE_SHAPE = (40, 50)
+# the largest difference between the native and uvotimsum images on the pixels inside
+# all frames, as a fraction of the peak: a grid offset of 0.5 pixel, or an extra
+# cloud-in-cell blur of the sources, is several times larger
+REFERENCE_ATOL = 0.02
+
+
+@pytest.fixture
+def reference_fnames(tmp_path: Path):
+    """an "all" image and exposure map with 4 frames, shifted by fractions of a pixel,
+    the last not aspect corrected, and their mask, with extended sources (gaussians with
+    a sigma of 2 pixels) at the same sky positions in every frame"""
+
+    shifts = [(0.0, 0.0), (2.4, 3.7), (-1.3, 0.6), (0.0, 0.0)]
+    headers = [frame_header(shift) for shift in shifts[:-1]]
+    headers.append(frame_header(aspcorr="NONE"))
+    y, x = np.indices(REFERENCE_SHAPE, dtype=np.float64)
+    sky = []
+    for dy, dx in shifts:
+        data = 2.0 + 0.01 * (x - dx)
+        for (y0, x0), flux in [((15.2, 20.3), 5000), ((25.7, 33.1), 2000)]:
+            r2 = (y - y0 - dy) ** 2 + (x - x0 - dx) ** 2
+            data += flux / (2 * np.pi * 4.0) * np.exp(-r2 / (2 * 4.0))
+        sky.append(data.astype(np.float32))
+    sky[-1][:] = 1e6
+    exposure = [np.full(REFERENCE_SHAPE, 100, dtype=np.float32) for _ in headers]
+    masks = [np.ones(REFERENCE_SHAPE, dtype=np.int16) for _ in headers]
+    masks[1][30:33, 8:11] = 0
+
+    return (
+        write_all(tmp_path / "all_um2_data.img", list(zip(sky, headers))),
+        write_all(tmp_path / "all_um2_ex.img", list(zip(exposure, headers))),
+        write_all(tmp_path / "all_um2_mk.img", list(zip(masks, headers))),
+    )
+
+
+def coadd_on_grid(
+    allfile: str, maskfile: str, method: str, header: fits.Header
+) -> tuple[np.ndarray, np.ndarray]:
+    """The native co-addition of the frames on the grid of a co-added image (header),
+    and the pixels of the grid that are inside all frames and away from masked pixels"""
+
+    grid_wcs = WCS(header)
+    grid_shape = (header["NAXIS2"], header["NAXIS1"])
+    total = np.zeros(grid_shape)
+    footprint = np.ones(grid_shape, dtype=bool)
+    with fits.open(allfile) as all_hdul, fits.open(maskfile) as mask_hdul:
+        for frame, mask_frame in zip(all_hdul[1:], mask_hdul[1:]):
+            if coadd.is_excluded(frame.header):
+                continue
+            wcs = coadd.frame_wcs(frame.header)
+            values = coadd.frame_values(frame.data, mask_frame.data, wcs, method)
+            coadd.deposit(values, wcs, grid_wcs, grid_shape, out=total)
+            # a grid pixel is covered by (unmasked) frame pixels with weights summing
+            # to 1, the pixels at the edges and around the masked pixels are less
+            coverage = coadd.deposit(
+                (mask_frame.data != 0).astype(float), wcs, grid_wcs, grid_shape
+            )
+            footprint &= np.abs(coverage - 1) < 1e-6
+            # and at least a pixel away from them
+            footprint[1:-1, 1:-1] &= (
+                footprint[:-2, 1:-1]
+                & footprint[2:, 1:-1]
+                & footprint[1:-1, :-2]
+                & footprint[1:-1, 2:]
+            )
+    return total, footprint
+
+
+def assert_coadd_matches(
+    reference_fname: str, allfile: str, maskfile: str, method: str
+):
+    """Asserts the native co-addition matches a uvotimsum image per pixel, on the grid
+    of the uvotimsum image and the pixels inside all frames"""
+
+    with fits.open(reference_fname) as hdul:
+        reference, header = hdul[1].data.astype(np.float64), hdul[1].header
+    native, footprint = coadd_on_grid(allfile, maskfile, method, header)
+    assert footprint.sum() > 500
+    np.testing.assert_allclose(
+        native[footprint],
+        reference[footprint],
+        rtol=0,
+        atol=REFERENCE_ATOL * reference[footprint].max(),
+    )
+
+
+@pytest.mark.parametrize("method", ["grid", "expmap"])
+def test_coadd_uvotimsum_reference(reference_fnames, method: str):
+    """Asserts the native co-addition matches the stored uvotimsum images of the
+    reference frames (see `test_coadd_uvotimsum`, which stores them)"""
+
+    reference_fname = REFERENCE_DIR / f"uvotimsum_um2_{method}.img"
+    if not reference_fname.exists():
+        pytest.skip(
+            f"{reference_fname.name} is missing, run test_coadd_uvotimsum with HEASoft"
+            " and DC_STORE_REFERENCE=1 to store it"
+        )
+    sky_fname, exp_fname, mask_fname = reference_fnames
+    all_fname = sky_fname if method == "grid" else exp_fname
+    assert_coadd_matches(str(reference_fname), all_fname, mask_fname, method)
+
+
+def test_coadd_reference_offset(reference_fnames, tmp_path: Path):
+    """Asserts the comparison with the uvotimsum images fails for a grid that is offset
+    by half a pixel, or for sources that are blurred"""
+
+    sky_fname, _, mask_fname = reference_fnames
+    hdul = coadd.coadd(sky_fname, mask_fname, "grid")
+    coadd_fname = str(tmp_path / "sum_um2_grid.img")
+    hdul.writeto(coadd_fname)
+    assert_coadd_matches(coadd_fname, sky_fname, mask_fname, "grid")
+
+    hdul[1].header["CRPIX1"] += 0.5
+    hdul.writeto(coadd_fname, overwrite=True)
+    with pytest.raises(AssertionError):
+        assert_coadd_matches(coadd_fname, sky_fname, mask_fname, "grid")
+
+    hdul[1].header["CRPIX1"] -= 0.5
+    data = hdul[1].data
+    data[1:-1, 1:-1] = (
+        data[1:-1, 1:-1] * 0.5
+        + (data[:-2, 1:-1] + data[2:, 1:-1] + data[1:-1, :-2] + data[1:-1, 2:]) / 8
+    )
+    hdul.writeto(coadd_fname, overwrite=True)
+    with pytest.raises(AssertionError):
+        assert_coadd_matches(coadd_fname, sky_fname, mask_fname, "grid")
+
+
+@pytest.mark.skipif(
+    os.getenv("CI") == "true",
+    reason="skip on CI, where we don't have uvotimsum installed",
+)
+@pytest.mark.parametrize("method", ["grid", "expmap"])
+def test_coadd_uvotimsum(reference_fnames, tmp_path: Path, method: str):
+    """Asserts the native co-addition matches uvotimsum, with DC_STORE_REFERENCE=1 the
+    uvotimsum images are stored for `test_coadd_uvotimsum_reference`"""
+
+    # todo: we could run these tests inside our docker image in CI
+    sky_fname, exp_fname, mask_fname = reference_fnames
+    all_fname = sky_fname if method == "grid" else exp_fname
+    out_fname = str(tmp_path / f"sum_um2_{method}.img")
+    assert not uvotimsum.coaddframes(all_fname, mask_fname, out_fname, method)
+    if os.getenv("DC_STORE_REFERENCE") == "1":
+        REFERENCE_DIR.mkdir(exist_ok=True)
+        shutil.copyfile(out_fname, REFERENCE_DIR / f"uvotimsum_um2_{method}.img")
+
+    assert_coadd_matches(out_fname, all_fname, mask_fname, method)
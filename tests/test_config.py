@@ -0,0 +1,101 @@
+import re
+from argparse import ArgumentParser
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from dresscode.config import (
+    PROFILE_PARSERS,
+    PerformanceProfile,
+    add_performance_arguments,
+    read_config,
+)
+
+CONFIG = """path = /data/SWIFT_data
+galaxy = NGC0628
+
+# the default profile
+[performance]
+dtype = float32
+threads = 2
+
+[performance.corrections]
+threads = 8
+keep_intermediates = false
+"""
+
+
+@pytest.fixture
+def config_fname(tmp_path):
+    config_fname = tmp_path / "config.txt"
+    config_fname.write_text(CONFIG)
+    return str(config_fname)
+
+
+def test_read_config(config_fname):
+    config = read_config(config_fname, "uvotimsum")
+    assert config.path == "/data/SWIFT_data/"
+    assert config.galaxy == "NGC0628"
+    assert config.performance == PerformanceProfile(
+        dtype=np.dtype(np.float32), threads=2
+    )
+
+    # the step section overrides the performance section
+    performance = read_config(config_fname, "corrections").performance
+    assert performance.threads == 8
+    assert performance.dtype == np.float32
+    assert not performance.keep_intermediates
+
+
+def test_command_line_overrides(config_fname):
+    parser = ArgumentParser()
+    add_performance_arguments(parser)
+
+    args = parser.parse_args([])
+    assert read_config(config_fname, "corrections", args).performance.threads == 8
+
+    args = parser.parse_args(
+        ["--threads", "3", "--dtype", "float64", "--keep-intermediates"]
+    )
+    performance = read_config(config_fname, "corrections", args).performance
+    assert performance.threads == 3
+    assert performance.dtype == np.float64
+    assert performance.keep_intermediates
+
+
+@pytest.mark.parametrize(
+    "config",
+    [
+        "galaxy = NGC0628\n",
+        "path = /data/\ngalaxy = NGC0628\nthreads = 2\n",
+        "path = /data/\ngalaxy = NGC0628\n[performance]\nthread = 2\n",
+        "path = /data/\ngalaxy = NGC0628\n[performance]\nthreads = 0\n",
+        "path = /data/\ngalaxy = NGC0628\n[performance]\ndtype = int16\n",
+        "path = /data/\ngalaxy = NGC0628\n[performance]\nprefetch = -1\n",
+        "path = /data/\ngalaxy = NGC0628\n[performance]\ncoadd = swarp\n",
+        "path = /data/\ngalaxy = NGC0628\n[performance.corrections2]\n",
+    ],
+)
+def test_invalid_config(config, tmp_path):
+    config_fname = tmp_path / "config.txt"
+    config_fname.write_text(config)
+    with pytest.raises(ValueError):
+        read_config(str(config_fname), "corrections")
+
+
+def test_config_example(tmp_path):
+    """Asserts the example configuration documents every setting and can be read"""
+
+    example = (Path(__file__).parents[1] / "config.txt.example").read_text()
+    # uncomment the settings and sections
+    config = re.sub(r"^# (\w+ = |\[)", r"\1", example, flags=re.MULTILINE)
+    config = config.replace("/scratch/dresscode", str(tmp_path))
+    config_fname = tmp_path / "config.txt"
+    config_fname.write_text(config)
+
+    assert set(PROFILE_PARSERS) <= set(re.findall(r"^(\w+) = ", config, re.MULTILINE))
+    corrections = read_config(str(config_fname), "corrections").performance
+    assert corrections.threads == 8 and corrections.prefetch == 4
+    uvotimsum = read_config(str(config_fname), "uvotimsum").performance
+    assert uvotimsum.coadd == "native" and uvotimsum.workers == 15
@@ -0,0 +1,482 @@
+from __future__ import annotations
+
+import json
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+import pytest
+from astropy.io import fits
+from conftest import GALAXY
+
+from dresscode import corrections, utils
+from dresscode.config import PerformanceProfile
+
+
+@pytest.fixture
+def norm_hdul() -> fits.HDUList:
+    """count rate frames with the headers needed for the corrections"""
+
+    header = fits.Header(
+        {"DEADC": 0.984, "FRAMTIME": 0.0110322, "DATE-OBS": "2012-05-06T10:00:00"}
+    )
+    hdul = fits.HDUList([fits.PrimaryHDU(header=header)])
+    for _ in range(3):
+        data = np.random.gamma(1.0, 0.05, (60, 50))
+        data[np.random.random(data.shape) < 0.1] = np.nan
+        data[:5] = np.nan
+        hdul.append(fits.ImageHDU(data, header))
+    return hdul
+
+
+def coicorr_factor_reference(data, moments, alpha, ft):
+    """the full-frame coincidence loss correction, with a temporary array per step"""
+
+    window_pixels, total_flux, std = moments.count, moments.total, moments.std()
+    total_counts = ft * total_flux
+    total_counts_min = ft * (total_flux - window_pixels * std)
+    total_counts_max = ft * (total_flux + window_pixels * std)
+    f = corrections.polynomial(total_counts)
+    f_min = corrections.polynomial(total_counts_min)
+    f_max = corrections.polynomial(total_counts_max)
+    high_flux = alpha * total_counts_max >= 1.0
+    total_counts_max[high_flux] = 0.99 / alpha
+    Ctheory = -np.log1p(-alpha * total_counts) / (alpha * ft)
+    Ctheory_min = -np.log1p(-alpha * total_counts_min) / (alpha * ft)
+    Ctheory_max = -np.log1p(-alpha * total_counts_max) / (alpha * ft)
+    corrfactor = (Ctheory * f) / total_flux
+    corrfactor_min = (Ctheory_min * f_min) / (total_flux - window_pixels * std)
+    corrfactor_max = (Ctheory_max * f_max) / (total_flux + window_pixels * std)
+    new_data = corrfactor * data
+    new_data_min = corrfactor_min * data
+    new_data_max = corrfactor_max * data
+    coicorr_unc = np.maximum(
+        np.abs(new_data - new_data_min), np.abs(new_data_max - new_data)
+    )
+    coicorr_rel = coicorr_unc / new_data
+    coicorr_rel[coicorr_unc == 0.0] = 0.0
+    return new_data, corrfactor, coicorr_rel, high_flux
+
+
+@pytest.mark.filterwarnings("ignore::RuntimeWarning")
+def test_coicorr_factor(norm_hdul: fits.HDUList):
+    """Asserts the blockwise coincidence loss correction is identical to the full-frame
+    expressions"""
+
+    data = norm_hdul[1].data
+    data[30:35, 10:15] = 80.0  # too bright for the uncertainty
+    moments = utils.windowed_moments(data, 4)
+    expected = coicorr_factor_reference(data, moments, 0.984, 0.0110322)
+    result = corrections.coicorr_factor(data, moments, 0.984, 0.0110322)
+    assert expected[3].any()
+    for expected_plane, plane in zip(expected, result):
+        assert np.array_equal(expected_plane, plane, equal_nan=True)
+
+
+@pytest.mark.parametrize("alpha", [0.9, 0.95, 0.984, 1.0])
+def test_coicorr_lut_error(alpha):
+    """Asserts the documented maximum error of the coincidence loss lookup table"""
+
+    lut = corrections.coicorr_lut(alpha)
+    counts = np.random.default_rng(0).uniform(lut.x_min, lut.x_max, 1_000_000)
+    counts[-1000:] = np.linspace(lut.x_max - 0.01, lut.x_max, 1000)
+    expected = -np.log1p(-alpha * counts) * corrections.polynomial(counts)
+    expected /= alpha * counts
+    interpolated = np.empty_like(counts)
+    outside = lut(counts, interpolated)
+    assert not outside.any()
+    assert (
+        np.max(np.abs(interpolated / expected - 1)) < corrections.COICORR_LUT_MAX_ERROR
+    )
+
+
+@pytest.mark.filterwarnings("ignore::RuntimeWarning")
+def test_coicorr_factor_lut(norm_hdul: fits.HDUList):
+    """Asserts the coincidence loss correction with the lookup table is within the
+    documented error, also for zero and high fluxes"""
+
+    data = norm_hdul[1].data
+    data[30:35, 10:15] = 80.0  # too bright for the uncertainty
+    data[40:55, 30:45] = 0.0
+    moments = utils.windowed_moments(data, 4)
+    expected = corrections.coicorr_factor(data, moments, 0.984, 0.0110322)
+    result = corrections.coicorr_factor(data, moments, 0.984, 0.0110322, lut=True)
+    assert np.array_equal(expected[3], result[3])
+    for expected_plane, plane in zip(expected[:2], result[:2]):
+        assert np.array_equal(np.isnan(expected_plane), np.isnan(plane))
+        assert np.nanmax(np.abs(plane / expected_plane - 1)) < (
+            corrections.COICORR_LUT_MAX_ERROR
+        )
+
+
+def test_coicorr_tiled(norm_hdul: fits.HDUList, tmp_path: Path):
+    """Asserts the tiled coincidence loss correction is bit-identical"""
+
+    fname = str(tmp_path / "test_um2_sk_corr.img")
+    coi_hdul, _, corrfactor_hdul, coicorr_unc_hdul = corrections.coicorr(
+        norm_hdul, fname
+    )
+    tiled = corrections.coicorr(norm_hdul, fname, tile_rows=7)
+
+    for full_hdul, tiled_hdul in zip(
+        [coi_hdul, corrfactor_hdul, coicorr_unc_hdul], [tiled[0], tiled[2], tiled[3]]
+    ):
+        for full_frame, tiled_frame in zip(full_hdul[1:], tiled_hdul[1:]):
+            assert np.array_equal(full_frame.data, tiled_frame.data, equal_nan=True)
+
+
+def test_coicorr_tiled_memory():
+    """Asserts the tiled coincidence loss correction holds little more than its
+    outputs in memory"""
+
+    data = np.random.default_rng(1).gamma(1.0, 0.05, (512, 512))
+    outputs = data.size * (3 * 8 + 1)
+    tracemalloc.start()
+    corrections.coicorr_frame(data, 0.984, 0.0110322, tile_rows=16)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    assert peak < 1.5 * outputs
+
+
+@pytest.mark.parametrize(
+    "options",
+    [{"threads": 3}, {"workers": 2}, {"prefetch": 2}, {"prefetch": 1, "threads": 2}],
+)
+def test_corrections_parallel(make_config, capsys, options):
+    """Asserts correcting the frames in a pool of threads, or the images in a pool of
+    processes, or reading the frames ahead gives the serial output"""
+
+    serial_config = make_config()
+    parallel_config = make_config(**options)
+    assert corrections.main(["-c", str(serial_config)]) == 0
+    capsys.readouterr()
+    assert corrections.main(["-c", str(parallel_config)]) == 0
+    output = capsys.readouterr().out
+    assert "Corrected image 1/2." in output and "Corrected image 2/2." in output
+
+    serial_dir = serial_config.parent / GALAXY / "working_dir"
+    parallel_dir = parallel_config.parent / GALAXY / "working_dir"
+    fnames = sorted(f.name for f in serial_dir.glob("*.img"))
+    assert fnames == sorted(f.name for f in parallel_dir.glob("*.img"))
+    for fname in fnames:
+        with fits.open(serial_dir / fname) as serial, fits.open(
+            parallel_dir / fname
+        ) as parallel:
+            assert len(serial) == len(parallel)
+            for serial_frame, parallel_frame in zip(serial, parallel):
+                assert serial_frame.header == parallel_frame.header
+                if serial_frame.data is not None:
+                    assert np.array_equal(
+                        serial_frame.data, parallel_frame.data, equal_nan=True
+                    )
+
+
+@pytest.mark.parametrize("options", [{}, {"prefetch": 2}, {"workers": 2}])
+def test_corrections_error(make_config, capsys, options):
+    """Asserts an image that can't be corrected is reported, with its output, and the
+    other images are still corrected, in serial and in parallel"""
+
+    config = make_config(**options)
+    working_dir = config.parent / GALAXY / "working_dir"
+    # the second frame of the first image can't be corrected
+    with fits.open(working_dir / "sw00000000001_um2_sk_corr.img", "update") as hdul:
+        del hdul[2].header["DEADC"]
+
+    assert corrections.main(["-c", str(config)]) == 1
+    output = capsys.readouterr().out
+    error = output.index("An error has occurred in correcting sw00000000001_um2")
+    assert "KeyError" in output[error:]
+    assert "Applying the corrections frame by frame..." in output[:error]
+    assert "Corrected image 1/2." in output
+    assert "1/2 images could not be corrected." in output
+
+    assert (working_dir / "sw00000000002_uw1_sk_corr_zp_cts.img").exists()
+    manifest = json.loads((working_dir / corrections.MANIFEST_FNAME).read_text())
+    assert list(manifest) == ["sw00000000002_uw1_sk_corr.img"]
+
+
+INTERMEDIATES = [
+    "_sk_corr_mk.img",
+    "_sk_corr_nm.img",
+    "_sk_corr_coi.img",
+    "_sk_corr_coi_corrfactor.img",
+    "_sk_corr_coi_coicorr_unc.img",
+    "_sk_corr_coi_lss.img",
+    "_sk_corr_coi_lss_zp.img",
+]
+PRODUCTS = [
+    "_mk_corr_new.img",
+    "_sk_corr_coi_lss_zp_dn.img",
+    "_sk_corr_coi_lss_zp_dn_oc.img",
+    "_sk_corr_coicorr_unc_sq_cts.img",
+    "_sk_corr_zp_cts.img",
+]
+
+
+def test_corrections_intermediates(make_config):
+    """Asserts only the images needed by uvotimsum are written, unless the intermediate
+    images are kept, and that the images are the same"""
+
+    config = make_config()
+    debug_config = make_config()
+    assert corrections.main(["-c", str(config)]) == 0
+    assert corrections.main(["-c", str(debug_config), "--keep-intermediates"]) == 0
+
+    working_dir = config.parent / GALAXY / "working_dir"
+    debug_dir = debug_config.parent / GALAXY / "working_dir"
+    prefix = "sw00000000001_um2"
+    for suffix in PRODUCTS:
+        with fits.open(working_dir / (prefix + suffix)) as hdul, fits.open(
+            debug_dir / (prefix + suffix)
+        ) as debug_hdul:
+            for frame, debug_frame in zip(hdul[1:], debug_hdul[1:]):
+                assert np.array_equal(frame.data, debug_frame.data, equal_nan=True)
+    for suffix in INTERMEDIATES:
+        assert not (working_dir / (prefix + suffix)).exists()
+        assert (debug_dir / (prefix + suffix)).exists()
+
+
+def test_corrections_incremental(make_config, capsys):
+    """Asserts a re-run only corrects the images whose inputs have changed or whose
+    outputs are missing, or all images with --force"""
+
+    config = make_config()
+    working_dir = config.parent / GALAXY / "working_dir"
+    assert corrections.main(["-c", str(config)]) == 0
+    assert (working_dir / corrections.MANIFEST_FNAME).exists()
+    capsys.readouterr()
+
+    assert corrections.main(["-c", str(config)]) == 0
+    output = capsys.readouterr().out
+    assert "Skipping 2/2 images" in output and "Corrected image" not in output
+
+    # a changed input, a missing output
+    lss_fname = working_dir / "sw00000000001_um2_lss_corr.img"
+    with fits.open(lss_fname, mode="update") as hdul:
+        hdul[1].data *= 1.01
+    (working_dir / "sw00000000002_uw1_sk_corr_zp_cts.img").unlink()
+    assert corrections.main(["-c", str(config)]) == 0
+    output = capsys.readouterr().out
+    assert "Skipping" not in output and "Corrected image 2/2." in output
+
+    # the settings that change the output
+    assert corrections.main(["-c", str(config), "--dtype", "float32"]) == 0
+    assert "Corrected image 2/2." in capsys.readouterr().out
+
+    assert corrections.main(["-c", str(config), "--dtype", "float32", "--force"]) == 0
+    output = capsys.readouterr().out
+    assert "Skipping" not in output and "Corrected image 2/2." in output
+
+
+def test_save_manifest(tmp_path: Path):
+    """Asserts the manifest is replaced at once, through a hidden temporary file that
+    is removed if the manifest can't be written"""
+
+    corrections.save_manifest(str(tmp_path), {"image": {"outputs": []}})
+    assert [f.name for f in tmp_path.iterdir()] == [corrections.MANIFEST_FNAME]
+
+    with pytest.raises(TypeError):
+        corrections.save_manifest(str(tmp_path), {"image": {"outputs": object()}})
+    assert [f.name for f in tmp_path.iterdir()] == [corrections.MANIFEST_FNAME]
+    manifest = json.loads((tmp_path / corrections.MANIFEST_FNAME).read_text())
+    assert manifest == {"image": {"outputs": []}}
+
+
+def test_corrections_incremental_intermediates(make_config, capsys):
+    """Asserts a re-run with --keep-intermediates writes the intermediate images of the
+    images that were corrected without them"""
+
+    config = make_config()
+    working_dir = config.parent / GALAXY / "working_dir"
+    assert corrections.main(["-c", str(config)]) == 0
+    prefix = "sw00000000001_um2"
+    assert not any(
+        (working_dir / (prefix + suffix)).exists() for suffix in INTERMEDIATES
+    )
+    capsys.readouterr()
+
+    assert corrections.main(["-c", str(config), "--keep-intermediates"]) == 0
+    output = capsys.readouterr().out
+    assert "Skipping" not in output and "Corrected image 2/2." in output
+    assert all((working_dir / (prefix + suffix)).exists() for suffix in INTERMEDIATES)
+
+    # the intermediate images aren't needed without --keep-intermediates
+    assert corrections.main(["-c", str(config)]) == 0
+    assert "Skipping 2/2 images" in capsys.readouterr().out
+
+
+def correct_image_by_stage(fname: str):
+    """the chain of corrections, one correction of all frames at a time"""
+
+    mask_fname = fname.replace("_sk_corr.img", "_mk_corr.img")
+    exp_fname = fname.replace("_sk_corr.img", "_ex_corr.img")
+    new_mask_hdul = utils.update_mask(
+        mask_fname, exp_fname, mask_fname.replace(".img", "_new.img")
+    )
+    with fits.open(fname) as unmasked_hdul, fits.open(exp_fname) as exp_hdul:
+        masked_hdul = utils.apply_mask(
+            unmasked_hdul, new_mask_hdul, fname.replace(".img", "_mk.img")
+        )
+        norm_hdul = utils.norm(masked_hdul, exp_hdul, fname.replace(".img", "_nm.img"))
+        coi_hdul, coi_fname, corrfactor_hdul, coicorr_unc_hdul = corrections.coicorr(
+            norm_hdul, fname
+        )
+        lss_hdul, lss_fname = corrections.lsscorr(coi_hdul, coi_fname)
+        zp_fname = lss_fname.replace(".img", "_zp.img")
+        zp_hdul = corrections.zeropoint(
+            lss_hdul, zp_fname, *corrections.ZEROPOINT_PARAMS[utils.check_filter(fname)]
+        )
+        cts_fname = zp_fname.replace(".img", "_dn.img")
+        cts_hdul = corrections.convert_to_cts(zp_hdul, exp_hdul, cts_fname)
+        corrections.rem_corr_factor(
+            cts_hdul, corrfactor_hdul, cts_fname.replace(".img", "_oc.img")
+        )
+        corrections.coicorr_uncert_cts(
+            cts_hdul, coicorr_unc_hdul, fname.replace(".img", "_coicorr_unc_sq_cts.img")
+        )
+        corrections.zp_corr_cts(cts_hdul, fname.replace(".img", "_zp_cts.img"))
+
+
+@pytest.mark.filterwarnings("ignore::RuntimeWarning")
+def test_correct_image_streaming(make_config):
+    """Asserts streaming the frames through the chain of corrections writes the same
+    files as applying the corrections to all frames one correction at a time"""
+
+    fname = "sw00000000001_um2_sk_corr.img"
+    stage_dir = make_config().parent / GALAXY / "working_dir"
+    stream_dir = make_config().parent / GALAXY / "working_dir"
+    correct_image_by_stage(str(stage_dir / fname))
+    corrections.correct_image(
+        str(stream_dir / fname), PerformanceProfile(keep_intermediates=True)
+    )
+
+    for output_fname in corrections.output_fnames(fname, keep_intermediates=True):
+        assert (stream_dir / output_fname).read_bytes() == (
+            stage_dir / output_fname
+        ).read_bytes()
+
+
+def write_frames(
+    working_dir: Path, n_frames: int, shape=(256, 256), footprint: bool = False
+) -> str:
+    """write a sky image with n_frames frames, and its mask, exposure and large scale
+    sensitivity map, optionally with the exposure only in part of the frames"""
+
+    rng = np.random.default_rng(1)
+    header = fits.Header(
+        {"DEADC": 0.984, "FRAMTIME": 0.0110322, "DATE-OBS": "2012-05-06T10:00:00"}
+    )
+    frames = {
+        "sk": rng.poisson(35, shape).astype(np.float32),
+        "mk": np.ones(shape, dtype=np.int16),
+        "ex": np.full(shape, 700, dtype=np.float32),
+        "lss": np.ones(shape, dtype=np.float32),
+    }
+    if footprint:
+        frames["ex"][: shape[0] // 4] = np.nan
+        frames["ex"][:, shape[1] // 2 :] = np.nan
+        frames["mk"][shape[0] // 2 :, : shape[1] // 8] = 0
+        frames["sk"][100:104, 20:24] = 5000  # bright source
+    for file_type, data in frames.items():
+        hdul = fits.HDUList(
+            [fits.PrimaryHDU(header=header)]
+            + [fits.ImageHDU(data, header) for _ in range(n_frames)]
+        )
+        hdul.writeto(working_dir / f"sw00000000001_um2_{file_type}_corr.img")
+    return str(working_dir / "sw00000000001_um2_sk_corr.img")
+
+
+@pytest.mark.filterwarnings("ignore::RuntimeWarning")
+def test_correct_image_cropped(tmp_path: Path):
+    """Asserts correcting the bounding box of the finite pixels of the frames writes the
+    same images as correcting the full frames (the NaNs outside the bounding box of the
+    intermediate images can differ in sign)"""
+
+    stage_dir, crop_dir = tmp_path / "stage", tmp_path / "crop"
+    for working_dir in [stage_dir, crop_dir]:
+        working_dir.mkdir()
+        fname = write_frames(working_dir, 2, footprint=True)
+    correct_image_by_stage(fname.replace(str(crop_dir), str(stage_dir)))
+    corrections.correct_image(fname, PerformanceProfile(keep_intermediates=True))
+
+    basename = Path(fname).name
+    for output_fname in corrections.output_fnames(basename, keep_intermediates=True):
+        with fits.open(crop_dir / output_fname) as crop_hdul, fits.open(
+            stage_dir / output_fname
+        ) as stage_hdul:
+            assert len(crop_hdul) == len(stage_hdul)
+            for crop_hdu, stage_hdu in zip(crop_hdul, stage_hdul):
+                assert crop_hdu.header == stage_hdu.header
+                if crop_hdu.data is not None:
+                    np.testing.assert_array_equal(crop_hdu.data, stage_hdu.data)
+
+
+def test_read_frames(tmp_path: Path):
+    """Asserts the frames are read into memory, so the reading is counted in the read
+    stage and not in the corrections that use the data"""
+
+    fname = write_frames(tmp_path, 2)
+    frames = list(corrections.read_frames(fname))
+    assert len(frames) == 2
+    for frame in frames:
+        for data in (frame.sky, frame.mask, frame.exp, frame.lss):
+            assert not isinstance(data, np.memmap) and data.flags.owndata
+
+
+def test_correct_image_memory(tmp_path: Path):
+    """Asserts the peak memory of the corrections doesn't grow with the number of
+    frames"""
+
+    peaks = []
+    for n_frames in [2, 8]:
+        working_dir = tmp_path / str(n_frames)
+        working_dir.mkdir()
+        fname = write_frames(working_dir, n_frames)
+        tracemalloc.start()
+        corrections.correct_image(fname)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+    assert peaks[1] < 1.2 * peaks[0]
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_corrections_stats(make_config, workers):
+    """Asserts the time, bytes read and written and peak memory of the stages of every
+    image are written to the stats file"""
+
+    config = make_config(workers=workers)
+    assert corrections.main(["-c", str(config)]) == 0
+
+    working_dir = config.parent / GALAXY / "working_dir"
+    stats = json.loads((working_dir / corrections.STATS_FNAME).read_text())
+    assert stats["workers"] == workers and stats["wall"] > 0
+    assert sorted(stats["images"]) == [
+        "sw00000000001_um2_sk_corr.img",
+        "sw00000000002_uw1_sk_corr.img",
+    ]
+    for fname, image in stats["images"].items():
+        assert set(image["stages"]) == {
+            "read",
+            "update_mask",
+            "apply_mask",
+            "norm",
+            "coicorr",
+            "lsscorr",
+            "zeropoint",
+            "convert_to_cts",
+            "rem_corr_factor",
+            "coicorr_uncert_cts",
+            "zp_corr_cts",
+            "write",
+        }
+        assert image["stages"]["coicorr"]["calls"] == 2
+        assert image["stages"]["coicorr"]["peak_rss"] > 0
+        # the sky image, mask, exposure map and lss map of two 64x64 frames
+        assert image["stages"]["read"]["bytes_read"] == 2 * 64 * 64 * (4 + 2 + 4 + 4)
+        assert image["stages"]["write"]["bytes_written"] == sum(
+            (working_dir / output_fname).stat().st_size
+            for output_fname in corrections.output_fnames(fname)
+        )
+    assert stats["stages"]["coicorr"]["calls"] == 4
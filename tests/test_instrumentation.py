@@ -0,0 +1,51 @@
+from __future__ import annotations
+
+import time
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from dresscode.instrumentation import (
+    ImageStats,
+    PeakMemory,
+    current_rss,
+    print_stats,
+    write_stats,
+)
+
+
+@pytest.mark.skipif(
+    current_rss() is None,
+    reason="the memory of the process can only be sampled on Linux",
+)
+def test_stage_peak_rss():
+    """Asserts the peak memory of a stage is that of the process while it ran"""
+
+    stats = ImageStats()
+    with stats.stage("small"):
+        pass
+    with stats.stage("large"):
+        data = np.ones(50_000_000 // 8)
+        # held for a few samples
+        time.sleep(10 * PeakMemory.interval)
+        del data
+    with stats.stage("small"):
+        pass
+
+    small, large = stats.stages["small"], stats.stages["large"]
+    assert small.calls == 2 and small.peak_rss > 0
+    assert large.peak_rss > small.peak_rss + 40e6
+
+
+def test_print_stats(tmp_path: Path, capsys):
+    """Asserts the peak memory of every stage is printed"""
+
+    stats = ImageStats()
+    with stats.stage("norm"):
+        pass
+    print_stats(write_stats(str(tmp_path / "stats.json"), {"image": stats.to_dict()}))
+    header, norm, _ = capsys.readouterr().out.splitlines()
+    assert header.split()[-2:] == ["peak", "(MB)"]
+    assert norm.split()[0] == "norm"
+    assert float(norm.split()[-1]) == round(stats.stages["norm"].peak_rss / 1e6)
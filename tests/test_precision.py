@@ -0,0 +1,75 @@
+"""Precision audit of the float32 compute mode (`dtype = float32` in the config file)
+
+Runs the python side of the pipeline (dc-corrections, the post-processing of
+dc-uvotimsum and dc-calibration) on synthetic images in float32 and float64, and
+compares the final images. The co-addition itself (HEASoft uvotimsum) is replaced by a
+plain sum of the frames, since the synthetic frames share the same grid.
+"""
+
+from __future__ import annotations
+
+from pathlib import Path
+
+import numpy as np
+import pytest
+from astropy.io import fits
+from conftest import GALAXY
+
+from dresscode import calibration, corrections, uvotimsum
+
+# maximum relative difference between the float32 and float64 final images, per plane
+FLOAT32_RTOL = {
+    "primary": 1e-5,
+    "coincidence loss correction factor": 1e-5,
+    "coincidence loss correction uncertainty": 1e-4,
+    "zero point correction factor": 1e-5,
+    "Poisson noise": 1e-5,
+}
+
+
+def sum_frames(allfile: str, maskfile: str, outfile: str, method: str) -> bool:
+    """stand-in for uvotimsum: sum the (aligned) frames, excluding masked pixels"""
+    with fits.open(allfile) as all_hdul, fits.open(maskfile) as mask_hdul:
+        total = sum(
+            np.where(mask_frame.data.astype(bool), frame.data, 0)
+            for frame, mask_frame in zip(all_hdul[1:], mask_hdul[1:])
+        )
+        fits.HDUList(
+            [
+                fits.PrimaryHDU(header=all_hdul[0].header),
+                fits.ImageHDU(total, all_hdul[1].header),
+            ]
+        ).writeto(outfile, overwrite=True)
+    return False
+
+
+def run_pipeline(config_fname: Path) -> Path:
+    assert corrections.main(["-c", str(config_fname)]) == 0
+    assert uvotimsum.main(["-c", str(config_fname)]) == 0
+    assert calibration.main(["-c", str(config_fname)]) == 0
+    return config_fname.parent / GALAXY / "working_dir"
+
+
+def test_float32_precision(make_config, monkeypatch):
+    monkeypatch.setattr(uvotimsum, "coaddframes", sum_frames)
+
+    path_64 = run_pipeline(make_config(dtype="float64"))
+    path_32 = run_pipeline(make_config(dtype="float32"))
+
+    for filt in ["um2", "uw1"]:
+        final_fname = f"{GALAXY}_final_{filt}_Jy.fits"
+        with fits.open(path_64 / final_fname) as hdul_64, fits.open(
+            path_32 / final_fname
+        ) as hdul_32:
+            assert hdul_32[0].data.dtype == np.dtype(">f4")
+            for data_64, data_32, (plane, rtol) in zip(
+                hdul_64[0].data, hdul_32[0].data, FLOAT32_RTOL.items()
+            ):
+                assert np.array_equal(np.isnan(data_64), np.isnan(data_32)), plane
+                assert data_32 == pytest.approx(data_64, rel=rtol, nan_ok=True), plane
+
+    # the intermediate products are written in float32 too
+    with fits.open(
+        path_32 / "sw00000000001_um2_sk_corr_coi_lss_zp_dn.img"
+    ) as primary_cts_hdul:
+        assert primary_cts_hdul[1].data.dtype == np.dtype(">f4")
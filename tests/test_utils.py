@@ -1,7 +1,9 @@
 from __future__ import annotations
 
+import errno
 import os
 import subprocess
+import threading
 
 import numpy as np
 import pytest
@@ -129,7 +131,7 @@ def test_sum_nan_data():
 
 
 def test_sum_compare_loop_vs_window():
-    """Asserts our iteration version matches the convolve version"""
+    """Asserts our iteration version matches the summed-area table version"""
 
     data = np.random.random((3, 3))
     output_loop = windowed_sum_loop(data, 1)
@@ -153,6 +155,31 @@ def test_sum_compare_loop_vs_window():
     assert np.allclose(output_loop, output_stacked, equal_nan=True)
 
 
+@pytest.mark.parametrize("radius", [1, 4, 12, 60])
+def test_summed_area_table_vs_loop(radius: int):
+    """Asserts the summed-area table versions match the iteration versions for
+    windows smaller and larger than the array, with nan's and zero-filled edges"""
+
+    data = np.random.random((45, 50))
+    data[np.random.random(data.shape) < 0.2] = np.nan
+    data[:, :5] = np.nan
+
+    assert np.allclose(
+        windowed_sum_loop(data, radius),
+        utils.windowed_sum(data, radius),
+        equal_nan=True,
+    )
+    assert np.array_equal(
+        windowed_finite_vals_loop(data, radius),
+        utils.windowed_finite_vals(data, radius),
+    )
+    assert np.allclose(
+        windowed_std_loop(data, radius),
+        utils.windowed_std(data, radius),
+        equal_nan=True,
+    )
+
+
 # STD COUNT RATES TESTS
 
 
@@ -226,6 +253,58 @@ def test_windowed_finite_vals_larger_arr():
     assert np.array_equal(output_loop, test_output)
 
 
+def test_windowed_moments():
+    """Asserts the fused moments match the separate windowed functions"""
+
+    data = np.random.random((45, 50))
+    data[np.random.random(data.shape) < 0.2] = np.nan
+
+    moments = utils.windowed_moments(data, 4)
+
+    assert np.array_equal(moments.count, utils.windowed_finite_vals(data, 4))
+    assert np.allclose(moments.total, windowed_sum_loop(data, 4), equal_nan=True)
+    assert np.allclose(
+        moments.total_sq, windowed_sum_loop(data * data, 4), equal_nan=True
+    )
+    assert np.allclose(moments.std(), windowed_std_loop(data, 4), equal_nan=True)
+
+
+def test_windowed_stack():
+    """Asserts a stack of frames gives the same result as the frames one by one"""
+
+    stack = np.random.random((4, 45, 50))
+    stack[np.random.random(stack.shape) < 0.2] = np.nan
+
+    output_sum = utils.windowed_sum(stack, 4)
+    output_std = utils.windowed_std(stack, 4)
+    for frame, frame_sum, frame_std in zip(stack, output_sum, output_std):
+        assert np.array_equal(frame_sum, utils.windowed_sum(frame, 4), equal_nan=True)
+        assert np.array_equal(frame_std, utils.windowed_std(frame, 4), equal_nan=True)
+
+
+@pytest.mark.parametrize("tile_rows", [1, 7, 16, 45, 100])
+def test_windowed_tiled(tile_rows: int):
+    """Asserts processing the rows in tiles is bit-identical to the full frame"""
+
+    data = np.random.random((45, 50))
+    data[np.random.random(data.shape) < 0.2] = np.nan
+
+    for radius in [1, 4, 30]:
+        full = utils.windowed_moments(data, radius)
+        tiled = utils.windowed_moments(data, radius, tile_rows=tile_rows)
+        for full_plane, tiled_plane in zip(full, tiled):
+            assert np.array_equal(full_plane, tiled_plane, equal_nan=True)
+        for rows, tile in utils.windowed_moment_tiles(data, radius, tile_rows):
+            assert tile.total.shape == (rows.stop - rows.start, data.shape[1])
+            for full_plane, tile_plane in zip(full, tile):
+                assert np.array_equal(full_plane[rows], tile_plane, equal_nan=True)
+        assert np.array_equal(
+            utils.windowed_std(data, radius),
+            utils.windowed_std(data, radius, tile_rows=tile_rows),
+            equal_nan=True,
+        )
+
+
 @pytest.fixture
 def updated_mask_fname(mask_fname, exp_fname):
     new_mask_fname = mask_fname.replace(".img", "_new.img")
@@ -242,6 +321,157 @@ def data_masked_fname(data_fname: str, updated_mask_fname: str) -> str:
     return output_fname
 
 
+def test_finite_bbox():
+    arr = np.full((20, 30), np.nan)
+    arr[5:8, 10:12] = 1.0
+    arr[9, 3] = 0.0
+
+    region = utils.finite_bbox(arr, margin=2)
+    assert region == (slice(3, 12), slice(1, 14))
+    assert np.array_equal(
+        utils.paste(arr[region], arr.shape, region), arr, equal_nan=True
+    )
+    assert utils.finite_bbox(arr, margin=20) == (slice(0, 20), slice(0, 30))
+    assert utils.finite_bbox(np.full((5, 5), np.nan)) == (slice(None), slice(None))
+
+
+def test_lazy_frames(mask_fname, exp_fname):
+    with utils.LazyFrames(mask_fname, exp_fname) as frames:
+        assert len(frames) == 3
+        assert frames.primary_headers[0]["EX_DATA"] == "example header"
+
+        n_frames = 0
+        previous = None
+        for mk_frame, ex_frame in frames:
+            if previous is not None:
+                # the previous frames have been released
+                assert "data" not in previous[0].__dict__
+                assert "data" not in previous[1].__dict__
+            assert mk_frame.data.shape == ex_frame.data.shape == (10, 10)
+            previous = (mk_frame, ex_frame)
+            n_frames += 1
+        assert n_frames == 3
+
+
+def test_prefetch():
+    read = []
+
+    def items():
+        for i in range(10):
+            read.append(i)
+            yield i
+        raise OSError("read error")
+
+    frames = utils.prefetch(items(), depth=2)
+    assert [next(frames) for _ in range(5)] == list(range(5))
+    # at most depth items are read ahead of the caller
+    assert len(read) <= 5 + 2 + 1
+    with pytest.raises(OSError, match="read error"):
+        list(frames)
+
+    # the background thread stops when the caller stops
+    frames = utils.prefetch(items(), depth=1)
+    assert next(frames) == 0
+    frames.close()
+    with pytest.raises(ValueError):
+        next(utils.prefetch(items(), depth=0))
+
+
+def test_async_writer(tmp_path):
+    hdul = fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(np.random.random((10, 10)))])
+    hdul.writeto(tmp_path / "expected.img")
+
+    with utils.AsyncWriter(threads=2, depth=1) as writer:
+        for i in range(4):
+            writer.writeto(hdul, str(tmp_path / f"{i}.img"))
+        frame_writer = utils.FrameWriter(
+            str(tmp_path / "frames.img"), hdul[0].header, writer
+        )
+        frame_writer.append(hdul[1].data, hdul[1].header)
+        frame_writer.close()
+
+    expected = (tmp_path / "expected.img").read_bytes()
+    for fname in [f"{i}.img" for i in range(4)] + ["frames.img"]:
+        assert (tmp_path / fname).read_bytes() == expected
+    # no temporary files are left
+    assert sorted(utils.listdir_nohidden(tmp_path)) == sorted(os.listdir(tmp_path))
+
+    # errors are raised when waiting for the writes
+    writer = utils.AsyncWriter()
+    writer.writeto(hdul, str(tmp_path / "missing_dir" / "0.img"))
+    with pytest.raises(FileNotFoundError):
+        writer.close()
+
+
+def test_scratch_dir(tmp_path, monkeypatch):
+    """Asserts the temporary files are written to the scratch directory, also when it is
+    on another file system than the images"""
+
+    scratch_dir, out_dir = tmp_path / "scratch", tmp_path / "out"
+    scratch_dir.mkdir()
+    out_dir.mkdir()
+    hdul = fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(np.random.random((10, 10)))])
+
+    frame_writer = utils.FrameWriter(
+        str(out_dir / "frames.img"), hdul[0].header, scratch_dir=str(scratch_dir)
+    )
+    frame_writer.append(hdul[1].data, hdul[1].header)
+    assert len(list(scratch_dir.glob(".frames.img.*.tmp"))) == 1
+    assert not os.listdir(out_dir)
+    frame_writer.close()
+
+    # renaming a file to another file system fails, it is copied next to the image
+    os_replace = os.replace
+
+    def replace(src, dst):
+        if os.path.dirname(src) != os.path.dirname(dst):
+            raise OSError(errno.EXDEV, "Invalid cross-device link")
+        os_replace(src, dst)
+
+    monkeypatch.setattr(os, "replace", replace)
+    with utils.AsyncWriter(scratch_dir=str(scratch_dir)) as writer:
+        writer.writeto(hdul, str(out_dir / "0.img"))
+
+    for fname in ["frames.img", "0.img"]:
+        with fits.open(out_dir / fname) as written:
+            np.testing.assert_array_equal(written[1].data, hdul[1].data)
+    assert not os.listdir(scratch_dir)
+    assert sorted(os.listdir(out_dir)) == ["0.img", "frames.img"]
+
+
+def test_run_jobs():
+    started = []
+    # the two jobs without dependencies run at the same time
+    barrier = threading.Barrier(2, timeout=10)
+
+    def job(key, *args):
+        started.append(key)
+        if key in "ab":
+            barrier.wait()
+        return key + "".join(args)
+
+    jobs = {
+        "c": utils.Job(job, ("c", "x"), after=("a", "b")),
+        "a": utils.Job(job, ("a",)),
+        "b": utils.Job(job, ("b",)),
+        "d": utils.Job(job, ("d",), after=("c",)),
+    }
+    assert utils.run_jobs(jobs, workers=2) == {"a": "a", "b": "b", "c": "cx", "d": "d"}
+    assert started[2:] == ["c", "d"]
+
+    def fail():
+        raise RuntimeError("job failed")
+
+    with pytest.raises(RuntimeError):
+        utils.run_jobs({"a": utils.Job(fail), "b": utils.Job(job, ("b",), ("a",))})
+    with pytest.raises(ValueError):
+        utils.run_jobs({"a": utils.Job(job, ("a",), after=("b",))})
+    with pytest.raises(ValueError):
+        utils.run_jobs(
+            {"a": utils.Job(job, ("a",), ("b",)), "b": utils.Job(job, ("b",), ("a",))}
+        )
+
+
 def test_update_mask(mask_fname, exp_fname):
     new_mask_fname = mask_fname.replace(".img", "_new.img")
     new_mask = utils.update_mask(mask_fname, exp_fname, new_mask_fname, dry_run=True)
@@ -264,6 +494,60 @@ def test_apply_mask(data_fname, mask_fname):
     assert data[1, 1] == data_hdulist[1].data[1, 1]
 
 
+def test_apply_mask_norm_mixed_shapes():
+    """frames with different shapes are masked and normalized one by one, in order"""
+
+    shapes = [(10, 10), (20, 20), (10, 10)]
+    data_hdul = fits.HDUList([fits.PrimaryHDU()])
+    mask_hdul = fits.HDUList([fits.PrimaryHDU()])
+    exp_hdul = fits.HDUList([fits.PrimaryHDU()])
+    for shape in shapes:
+        data_hdul.append(fits.ImageHDU(np.random.random(shape)))
+        mask_hdul.append(
+            fits.ImageHDU((np.random.random(shape) > 0.2).astype(np.uint8))
+        )
+        exp_hdul.append(fits.ImageHDU(np.random.random(shape) * 10))
+
+    masked = utils.apply_mask(data_hdul, mask_hdul, "", dry_run=True)
+    normed = utils.norm(masked, exp_hdul, dry_run=True)
+
+    for i in range(1, len(shapes) + 1):
+        expected = utils.apply_mask_data(data_hdul[i].data, mask_hdul[i].data)
+        assert np.array_equal(masked[i].data, expected, equal_nan=True)
+        expected = utils.norm_data(expected, exp_hdul[i].data)
+        assert np.array_equal(normed[i].data, expected, equal_nan=True)
+
+
+def test_out_params():
+    """Asserts writing into an output buffer (or in place) gives the same results"""
+
+    data = np.random.random((2, 10, 10))
+    data[0, 2, 2] = np.nan
+    mask = (np.random.random(data.shape) > 0.2).astype(np.uint8)
+    exp = 8 * np.ones(data.shape, dtype=np.float32)
+    exp[:, 1, 1] = 0
+    exp[:, 3, 3] = np.nan
+
+    masked = utils.apply_mask_data(data, mask)
+    normed = utils.norm_data(masked, exp)
+    denormed = utils.norm_data(normed, exp, denorm=True)
+
+    out = np.empty_like(data)
+    assert utils.apply_mask_data(data, mask, out=out) is out
+    assert np.array_equal(out, masked, equal_nan=True)
+    assert utils.norm_data(out, exp, out=out) is out
+    assert np.array_equal(out, normed, equal_nan=True)
+    utils.norm_data(out, exp, denorm=True, out=out)
+    assert np.array_equal(out, denormed, equal_nan=True)
+
+    orig_mask = mask.copy()
+    new_mask = utils.update_mask_data(mask, exp)
+    assert np.array_equal(mask, orig_mask)
+    assert utils.update_mask_data(mask, exp, out=mask) is mask
+    assert np.array_equal(mask, new_mask)
+    assert not mask[:, 1, 1].any() and not mask[:, 3, 3].any()
+
+
 def norm_farith(fname: str, exp_fname: str):
     """normalize an image by its exposure map
 
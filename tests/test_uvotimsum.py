@@ -0,0 +1,220 @@
+from __future__ import annotations
+
+import os
+from pathlib import Path
+
+import numpy as np
+import pytest
+from astropy.io import fits
+from conftest import GALAXY
+
+from dresscode import corrections, utils, uvotimsum
+
+
+def write_image(fname: Path, n_frames: int, seed: int) -> Path:
+    """write an image with n_frames frames, each with its own header"""
+    rng = np.random.default_rng(seed)
+    hdul = fits.HDUList([fits.PrimaryHDU(header=fits.Header({"OBS_ID": seed}))])
+    for i in range(n_frames):
+        header = fits.Header({"EXTNAME": f"um2{i}", "EXPOSURE": 100.0 + i})
+        header.add_history(f"frame {i} of image {seed}")
+        hdul.append(fits.ImageHDU(rng.random((7, 9)).astype(np.float32), header))
+    hdul.writeto(fname)
+    return fname
+
+
+def test_append_frames(tmp_path: Path):
+    """Asserts the "all" image has the first image and the frames of the other images,
+    with the same headers (byte for byte) and data"""
+
+    fnames = [
+        write_image(tmp_path / f"sw0000000000{seed}_um2_ex_corr.img", n_frames, seed)
+        for seed, n_frames in [(1, 2), (2, 3), (3, 1)]
+    ]
+    all_fname = tmp_path / "all_um2_ex.img"
+    uvotimsum.append_frames([str(fname) for fname in fnames], str(all_fname))
+
+    with fits.open(fnames[0]) as first_hdul:
+        expected = [(hdu.header, hdu.data) for hdu in first_hdul]
+    for fname in fnames[1:]:
+        with fits.open(fname) as hdul:
+            expected += [(hdu.header, hdu.data) for hdu in hdul[1:]]
+
+    with fits.open(all_fname) as all_hdul:
+        all_hdul.verify("exception")
+        assert len(all_hdul) == len(expected) == 7
+        for hdu, (header, data) in zip(all_hdul, expected):
+            assert hdu.header.tostring() == header.tostring()
+            assert np.array_equal(hdu.data, data)
+
+    # the first image is copied as it is, the frames are appended to it
+    assert all_fname.read_bytes().startswith(fnames[0].read_bytes())
+    assert not list(tmp_path.glob(".*.tmp"))
+
+
+def test_uvotimsum_native(make_config):
+    """Asserts dc-uvotimsum co-adds the frames in Python with `coadd = native`"""
+
+    config_fname = make_config(coadd="native")
+    assert corrections.main(["-c", str(config_fname)]) == 0
+    assert uvotimsum.main(["-c", str(config_fname)]) == 0
+
+    working_dir = config_fname.parent / GALAXY / "working_dir"
+    for filt in ["um2", "uw1"]:
+        assert (working_dir / f"total_sum_{filt}_nm.fits").exists()
+
+    # the frames share the same grid, the counts of the unmasked pixels are summed
+    with fits.open(working_dir / "all_um2_data.img") as all_hdul, fits.open(
+        working_dir / "all_um2_mk.img"
+    ) as mask_hdul, fits.open(working_dir / "sum_um2_data.img") as sum_hdul:
+        expected = sum(
+            np.where(mask_frame.data != 0, frame.data, 0)
+            for frame, mask_frame in zip(all_hdul[1:], mask_hdul[1:])
+        )
+        assert sum_hdul[1].header["NFRAMES"] == 2
+        np.testing.assert_allclose(sum_hdul[1].data, expected, rtol=1e-6, atol=1e-6)
+
+
+def test_uvotimsum_workers(make_config):
+    """Asserts co-adding the images in parallel gives the same final images"""
+
+    final_images = []
+    for workers in [1, 3]:
+        config_fname = make_config(coadd="native", workers=workers)
+        assert corrections.main(["-c", str(config_fname)]) == 0
+        assert uvotimsum.main(["-c", str(config_fname)]) == 0
+        working_dir = config_fname.parent / GALAXY / "working_dir"
+        final_images.append(
+            [
+                fits.getdata(working_dir / f"total_sum_{filt}_nm.fits")
+                for filt in ["um2", "uw1"]
+            ]
+        )
+
+    for data_serial, data_parallel in zip(*final_images):
+        np.testing.assert_array_equal(data_serial, data_parallel)
+
+
+def test_uvotimsum_intermediates(make_config):
+    """Asserts the planes of the combined image are only written to their own images
+    with keep_intermediates"""
+
+    suffixes = ["nm", "coicorr_factor", "coicorr_unc", "zp_corr_factor"]
+    for keep_intermediates in [False, True]:
+        config_fname = make_config(
+            coadd="native", keep_intermediates=str(keep_intermediates).lower()
+        )
+        assert corrections.main(["-c", str(config_fname)]) == 0
+        assert uvotimsum.main(["-c", str(config_fname)]) == 0
+        working_dir = config_fname.parent / GALAXY / "working_dir"
+
+        cube = fits.getdata(working_dir / "total_sum_um2_nm.fits")
+        assert cube.shape[0] == 5
+        plane_fnames = [working_dir / f"sum_um2_{suffix}.img" for suffix in suffixes]
+        if not keep_intermediates:
+            assert not any(fname.exists() for fname in plane_fnames)
+            continue
+        # primary, coincidence loss correction factor and uncertainty, zero point
+        # correction factor
+        for plane, fname in zip(cube, plane_fnames):
+            np.testing.assert_array_equal(plane, fits.getdata(fname, 1))
+
+
+def copy_image(working_dir: Path, name: str, new_name: str, shift: int, scale: float):
+    """copy the corrected files of an image, shifted by (shift, -shift) pixels on the sky,
+    with the values scaled"""
+    for fname in working_dir.glob(f"{name}_*"):
+        with fits.open(fname) as hdul:
+            for hdu in hdul:
+                hdu.header["CRPIX1"] -= shift
+                hdu.header["CRPIX2"] += shift
+                if hdu.data is not None and "_mk_" not in fname.name:
+                    hdu.data = hdu.data * scale
+            hdul.writeto(
+                working_dir / fname.name.replace(name, new_name), overwrite=True
+            )
+
+
+def test_uvotimsum_incremental(make_config):
+    """Asserts the incremental co-addition gives the same co-added images as co-adding
+    all images, when images are added, replaced and removed"""
+
+    config_fname = make_config(coadd="native")
+    assert corrections.main(["-c", str(config_fname)]) == 0
+    working_dir = config_fname.parent / GALAXY / "working_dir"
+
+    def run(incremental: bool) -> tuple[dict[str, np.ndarray], fits.Header]:
+        argv = ["-c", str(config_fname)] + (["--incremental"] if incremental else [])
+        assert uvotimsum.main(argv) == 0
+        sums = {
+            sum_type: fits.getdata(working_dir / f"sum_um2_{sum_type}.img")
+            for sum_type in uvotimsum.SUM_TYPES
+        }
+        return sums, fits.getheader(working_dir / "sum_um2_data.img", 1)
+
+    def assert_same(incremental, full):
+        assert incremental[0]["data"].shape == full[0]["data"].shape
+        for key in ["CRPIX1", "CRPIX2", "NFRAMES"]:
+            assert incremental[1][key] == full[1][key]
+        for sum_type, data in full[0].items():
+            np.testing.assert_allclose(
+                incremental[0][sum_type], data, rtol=1e-6, atol=1e-4
+            )
+
+    first = run(incremental=True)
+    assert (working_dir / "coadd_um2" / "sums.fits").exists()
+    assert_same(first, run(incremental=False))
+
+    # a new image, partly outside of the grid
+    copy_image(working_dir, "sw00000000001_um2", "sw00000000003_um2", 5, 2.0)
+    added = run(incremental=True)
+    assert added[1]["NFRAMES"] == 4
+    assert_same(added, run(incremental=False))
+
+    # the image is corrected again
+    copy_image(working_dir, "sw00000000001_um2", "sw00000000003_um2", 5, 3.0)
+    assert_same(run(incremental=True), run(incremental=False))
+
+    # the image is removed, the grid keeps its size
+    for fname in working_dir.glob("sw00000000003_um2_*"):
+        fname.unlink()
+    removed = run(incremental=True)
+    assert removed[1]["NFRAMES"] == 2
+    assert len(list((working_dir / "coadd_um2").glob("sw*.fits"))) == 1
+    x0 = int(removed[1]["CRPIX1"] - first[1]["CRPIX1"])
+    y0 = int(removed[1]["CRPIX2"] - first[1]["CRPIX2"])
+    ny, nx = first[0]["data"].shape
+    region = np.s_[y0 : y0 + ny, x0 : x0 + nx]
+    for sum_type, data in first[0].items():
+        np.testing.assert_allclose(
+            removed[0][sum_type][region], data, rtol=1e-6, atol=1e-4
+        )
+        outside = removed[0][sum_type].copy()
+        outside[region] = 0
+        assert not outside.any()
+
+
+@pytest.mark.parametrize("incremental", [False, True])
+def test_uvotimsum_scratch_dir(make_config, tmp_path: Path, monkeypatch, incremental):
+    """Asserts the corrected and co-added images are written through the scratch
+    directory"""
+
+    renamed = []
+
+    def replace_file(tmp_fname: str, fname: str):
+        renamed.append((tmp_fname, fname))
+        os.replace(tmp_fname, fname)
+
+    monkeypatch.setattr(utils, "replace_file", replace_file)
+    monkeypatch.setattr(uvotimsum, "replace_file", replace_file)
+    config_fname = make_config(
+        coadd="native", scratch_dir=tmp_path, incremental=str(incremental).lower()
+    )
+    assert corrections.main(["-c", str(config_fname)]) == 0
+    assert uvotimsum.main(["-c", str(config_fname)]) == 0
+
+    written = {os.path.basename(fname) for _, fname in renamed}
+    assert "sw00000000001_um2_sk_corr_coi_lss_zp_dn.img" in written
+    assert {"sum_um2_data.img", "total_sum_um2_nm.fits"} <= written
+    assert all(os.path.dirname(tmp_fname) == str(tmp_path) for tmp_fname, _ in renamed)
+    assert not os.listdir(tmp_path)